@@ -0,0 +1,48 @@
+#!/usr/bin/env python
+# coding=utf-8
+"""Latency of run('true') on remote host: plain ssh (with multiplexing) vs agent.
+
+Usage:
+  $ python benchmarks/bench_agent.py user@host[:port] [runs]
+
+"""
+
+# This file is part of https://github.com/Friz-zy/factory
+
+from __future__ import with_statement
+
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from factory.api import run, envs, set_connect_env, set_common_env, hide
+from factory import context_managers
+
+
+def measure(host, runs, use_agent):
+    context_managers.connects.clear()
+    with set_common_env(use_agent=use_agent):
+        with set_connect_env(host):
+            with hide('stdout'):
+                # warm up connect
+                run('true')
+                start = time.time()
+                for i in xrange(runs):
+                    run('true')
+                elapsed = time.time() - start
+            if envs.connect.agent is not None:
+                envs.connect.agent.close()
+    return elapsed / runs * 1000
+
+
+def main():
+    host = sys.argv[1]
+    runs = int(sys.argv[2]) if len(sys.argv) > 2 else 100
+    print "plain ssh: %7.3f ms per run('true')" % measure(host, runs, False)
+    print "agent:     %7.3f ms per run('true')" % measure(host, runs, True)
+
+
+if __name__ == '__main__':
+    main()
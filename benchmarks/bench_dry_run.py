@@ -0,0 +1,37 @@
+#!/usr/bin/env python
+# coding=utf-8
+"""Wall time of dry run of many commands with a few distinct binaries on one host.
+
+Usage:
+  $ python benchmarks/bench_dry_run.py [commands]
+
+"""
+
+# This file is part of https://github.com/Friz-zy/factory
+
+from __future__ import with_statement
+
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from factory.api import run, set_connect_env, set_common_env, hide
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+    binaries = ['echo', 'ls', 'cat', 'grep', 'sed', 'mkdir', 'cp', 'chmod', 'touch', 'uname']
+    commands = ['%s x' % binaries[i % len(binaries)] for i in range(count)]
+    with set_common_env(dry_run=True):
+        with set_connect_env('localhost'):
+            with hide():
+                start = time.time()
+                for command in commands:
+                    run(command)
+    print '%s dry commands: %6.3f s' % (count, time.time() - start)
+
+
+if __name__ == '__main__':
+    main()
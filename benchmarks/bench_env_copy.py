@@ -0,0 +1,57 @@
+#!/usr/bin/env python
+# coding=utf-8
+"""Memory and time of envs copies for greenlets of 1000 hosts.
+
+main, run_tasks_on_host, run_task and run() copy envs.common and envs.connect
+for every greenlet, this benchmark repeats these copies for each host
+with full dict copies as before and with copy-on-write copies.
+
+Usage:
+  $ python benchmarks/bench_env_copy.py [hosts]
+
+"""
+
+# This file is part of https://github.com/Friz-zy/factory
+
+import os
+import sys
+import time
+from copy import copy
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from factory.state import AttributedDict, envs
+
+# host, task, in_loop, out_loop, err_loop
+COPIES_PER_HOST = 5
+
+
+def full_copy(env):
+    return AttributedDict(dict(env.__dict__))
+
+
+def measure(hosts, copier):
+    connect = AttributedDict({'user': 'user', 'host': 'host', 'port': 22, 'con_args': ''})
+    envs_of_greenlets = []
+    start = time.time()
+    for i in xrange(hosts):
+        for j in xrange(COPIES_PER_HOST):
+            envs_of_greenlets.append((copier(envs.common), copier(connect)))
+    elapsed = time.time() - start
+    storages = {}
+    for common, connect in envs_of_greenlets:
+        for env in (common, connect):
+            storages[id(env.__dict__)] = sys.getsizeof(env.__dict__)
+    return elapsed, sum(storages.values())
+
+
+def main():
+    hosts = int(sys.argv[1]) if len(sys.argv) > 1 else 1000
+    for name, copier in (('full copies', full_copy), ('copy-on-write', copy)):
+        elapsed, size = measure(hosts, copier)
+        print '%-14s %d hosts: %8.2f ms, %8.1f KiB of env storages' % (
+            name, hosts, elapsed * 1000, size / 1024.0)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,57 @@
+#!/usr/bin/env python
+# coding=utf-8
+"""Time of loading of big ini inventory and of resolving of patterns.
+
+Usage:
+  $ python benchmarks/bench_inventory.py [hosts]
+
+"""
+
+# This file is part of https://github.com/Friz-zy/factory
+
+from __future__ import with_statement
+
+import os
+import sys
+import time
+import shutil
+import tempfile
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from factory.api import envs, set_common_env
+from factory.inventory import load_inventory, resolve_hosts
+
+
+def timed(title, function, *args):
+    start = time.time()
+    result = function(*args)
+    print '%-32s %8.2f ms' % (title, (time.time() - start) * 1000)
+    return result
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 50000
+    directory = tempfile.mkdtemp()
+    try:
+        filename = os.path.join(directory, 'hosts')
+        with open(filename, 'w') as f:
+            for group in ('web', 'db', 'cache', 'queue', 'worker'):
+                f.write('[%s]\n' % group)
+                for i in range(count // 5):
+                    f.write('%s%s.example.com\n' % (group, i))
+                f.write('[%s:vars]\nrole=%s\n' % (group, group))
+            f.write('[prod:children]\nweb\ndb\n')
+        with set_common_env(home_directory=directory):
+            timed('parse %s hosts' % count, load_inventory, filename)
+            inventory = timed('load %s hosts from cache' % count, load_inventory, filename)
+            for pattern in ('all', 'web', 'web1*:!web13.example.com', 'prod:&db*', '~worker[0-9]+7\\.'):
+                hosts = timed('select %s' % pattern, inventory.select, pattern)
+                print '  %s hosts' % len(hosts)
+            timed('connection strings of all', resolve_hosts, 'all')
+    finally:
+        shutil.rmtree(directory)
+
+
+if __name__ == '__main__':
+    main()
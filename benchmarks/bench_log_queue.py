@@ -0,0 +1,59 @@
+#!/usr/bin/env python
+# coding=utf-8
+"""Wall time of big output of parallel commands: direct logging vs log queue.
+
+Output goes into temporary file, so each flush is write into file;
+with --null it goes into /dev/null and only overhead of queue is measured.
+
+Usage:
+  $ python benchmarks/bench_log_queue.py [lines] [commands] [--null]
+
+"""
+
+# This file is part of https://github.com/Friz-zy/factory
+
+from __future__ import with_statement
+
+import os
+import sys
+import time
+import tempfile
+import gevent
+from copy import copy
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from factory.api import run, set_connect_env, envs
+from factory import log
+
+
+def run_all(lines, count):
+    common, connect = envs.common, envs.connect
+    def job():
+        envs.common, envs.connect = copy(common), copy(connect)
+        with set_connect_env('localhost'):
+            run('seq 1 %s' % lines)
+    start = time.time()
+    gevent.joinall([gevent.spawn(job) for i in range(count)])
+    return time.time() - start
+
+
+def main():
+    lines = int(sys.argv[1]) if len(sys.argv) > 1 and sys.argv[1].isdigit() else 20000
+    count = int(sys.argv[2]) if len(sys.argv) > 2 and sys.argv[2].isdigit() else 4
+    stdout = sys.stdout
+    sys.stdout = open(os.devnull, 'w') if '--null' in sys.argv else tempfile.TemporaryFile()
+    try:
+        direct = run_all(lines, count)
+        envs.common.log_queue = True
+        log.start_queue_logging()
+        queued = run_all(lines, count)
+        log.stop_queue_logging()
+    finally:
+        sys.stdout = stdout
+    print '%s x %s lines, direct: %6.3f s' % (count, lines, direct)
+    print '%s x %s lines, queue:  %6.3f s' % (count, lines, queued)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,82 @@
+#!/usr/bin/env python
+# coding=utf-8
+"""Throughput of reading command output: byte-at-a-time loop vs chunked reader.
+
+Usage:
+  $ python benchmarks/bench_out_loop.py [megabytes]
+
+"""
+
+# This file is part of https://github.com/Friz-zy/factory
+
+from __future__ import with_statement
+
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+import gevent
+from gevent.socket import wait_read, timeout
+from factory.api import run, envs, set_connect_env, hide
+from factory import operations
+
+
+def legacy_out_loop(p, common_env, connect_env, err=False):
+    """out_loop as it was before chunked reading: one read(1) per byte."""
+    line = ''
+    char = ' '
+    sumout = ''
+    stdout = p.stderr if err else p.stdout
+    prefix = 'err: ' if err else 'out: '
+    envs.common = common_env
+    envs.connect = connect_env
+    while char or p.poll() is None:
+        try:
+            wait_read(stdout.fileno(), 0.01)
+            char = stdout.read(1)
+            ready = True
+        except (gevent.Timeout, timeout):
+            ready = False
+            char = ''
+        if ready:
+            if char:
+                sumout += char
+                if char not in ('\n', '\r'):
+                    line += char
+                elif line:
+                    operations.write_message_to_log(line, prefix)
+                    line = ''
+            elif line:
+                operations.write_message_to_log(line, prefix)
+                line = ''
+        elif line:
+            operations.write_message_to_log(line, prefix)
+            line = ''
+    return sumout
+
+
+def measure(megabytes):
+    command = 'head -c %d /dev/zero | tr "\\0" "x" | fold -w 79' % (megabytes * 1024 * 1024)
+    start = time.time()
+    out = run(command)
+    elapsed = time.time() - start
+    return len(out) / 1024.0 / 1024 / elapsed
+
+
+def main():
+    megabytes = int(sys.argv[1]) if len(sys.argv) > 1 else 16
+    chunked = operations.out_loop
+    with set_connect_env('localhost'):
+        with hide('stdout'):
+            operations.out_loop = legacy_out_loop
+            before = measure(megabytes)
+            operations.out_loop = chunked
+            after = measure(megabytes)
+    print 'byte-at-a-time: %8.2f MB/s' % before
+    print 'chunked:        %8.2f MB/s' % after
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,47 @@
+#!/usr/bin/env python
+# coding=utf-8
+"""Time of parsing of cli tasks by parse_functions.
+
+Registry has built-in operations and number of dummy tasks like big factfile.
+
+Usage:
+  $ python benchmarks/bench_parse_functions.py [tokens] [tasks]
+
+"""
+
+# This file is part of https://github.com/Friz-zy/factory
+
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from factory import main, operations
+from factory.state import envs
+
+
+def main_():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 10000
+    extra = int(sys.argv[2]) if len(sys.argv) > 2 else 1000
+    envs.common.functions.register_module(operations)
+    for i in range(extra):
+        envs.common.functions['task_%s' % i] = len
+    kinds = (
+        ['run', 'echo 1'],
+        ['run:echo 2,use_sudo=True'],
+        ['run', 'echo 3', 'use_sudo=True', 'timeout=5'],
+    )
+    tokens = []
+    while len(tokens) < count:
+        tokens.extend(kinds[len(tokens) % len(kinds)])
+    tokens = tokens[:count]
+    start = time.time()
+    tasks = main.parse_functions(tokens)
+    print '%s tokens, %s tasks, %s functions: %.3f s' % (
+        len(tokens), len(tasks), len(envs.common.functions), time.time() - start
+    )
+
+
+if __name__ == '__main__':
+    main_()
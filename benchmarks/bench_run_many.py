@@ -0,0 +1,40 @@
+#!/usr/bin/env python
+# coding=utf-8
+"""Wall time of short commands: one run() per command vs run_many in one session.
+
+Usage:
+  $ python benchmarks/bench_run_many.py [commands]
+
+"""
+
+# This file is part of https://github.com/Friz-zy/factory
+
+from __future__ import with_statement
+
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from factory.api import run, run_many, set_connect_env, hide
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 30
+    commands = ['echo %s' % i for i in range(count)]
+    with set_connect_env('localhost'):
+        with hide('stdout'):
+            start = time.time()
+            for command in commands:
+                run(command, freturn=True)
+            single = time.time() - start
+            start = time.time()
+            run_many(commands)
+            many = time.time() - start
+    print '%s x run():   %6.3f s' % (count, single)
+    print 'run_many():   %6.3f s' % many
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,61 @@
+#!/usr/bin/env python
+# coding=utf-8
+"""Overhead of debug logging in run('true') and in one hot path call.
+
+Controller cpu time per run('true') is measured, waiting for the child isn't counted.
+
+Usage:
+  $ python benchmarks/bench_run_overhead.py [runs]
+
+"""
+
+# This file is part of https://github.com/Friz-zy/factory
+
+from __future__ import with_statement
+
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from factory.api import run, logging, set_connect_env, hide
+
+
+def measure(runs, level):
+    logging.root.setLevel(level)
+    start = sum(os.times()[:2])
+    for i in xrange(runs):
+        run('true')
+    return (sum(os.times()[:2]) - start) / runs * 1000
+
+
+def main():
+    runs = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+    with set_connect_env('localhost'):
+        with hide('stdout'):
+            # warm up
+            measure(runs // 10 or 1, logging.INFO)
+            info = measure(runs, logging.INFO)
+            debug = measure(runs, logging.DEBUG)
+            logging.root.setLevel(logging.INFO)
+    print "run('true') cpu time with INFO level:  %6.3f ms" % info
+    print "run('true') cpu time with DEBUG level: %6.3f ms" % debug
+
+    setup = '\n'.join((
+        'from factory.api import logging, envs',
+        'logger = logging.getLogger("bench")',
+        'common, connect = envs.common, envs.connect',
+    ))
+    ungated = timeit.timeit(
+        "logger.debug('arguments for executing and another locals: %s', locals())",
+        setup, number=100000)
+    gated = timeit.timeit(
+        "if logger.isEnabledFor(logging.DEBUG): logger.debug('arguments for executing and another locals: %s', locals())",
+        setup, number=100000)
+    print 'disabled logger.debug(locals()) call:  %6.3f us' % (ungated * 10)
+    print 'the same call behind isEnabledFor:     %6.3f us' % (gated * 10)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,86 @@
+#!/usr/bin/env python
+# coding=utf-8
+"""Startup time of fact: wall time of cli calls and import time of modules.
+
+Like python -X importtime of python 3: with --imports it prints
+cumulative import time of each module imported by factory.main and by main().
+
+Usage:
+  $ python benchmarks/bench_startup.py [calls]
+  $ python benchmarks/bench_startup.py --imports [cli arguments]
+
+"""
+
+# This file is part of https://github.com/Friz-zy/factory
+
+import os
+import sys
+import time
+import subprocess
+
+ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+MAIN = os.path.join(ROOT, 'factory', 'main.py')
+
+
+def importtime(argv):
+    import __builtin__
+    original = __builtin__.__import__
+    times = []
+    depth = [0]
+
+    def timed_import(name, *args, **kwargs):
+        if name in sys.modules:
+            return original(name, *args, **kwargs)
+        depth[0] += 1
+        start = time.time()
+        try:
+            return original(name, *args, **kwargs)
+        finally:
+            depth[0] -= 1
+            times.append((depth[0], name, time.time() - start))
+
+    __builtin__.__import__ = timed_import
+    sys.path.insert(0, os.path.join(ROOT, 'factory'))
+    sys.argv = ['fact'] + argv
+    start = time.time()
+    try:
+        import main
+        main.main()
+    except SystemExit:
+        pass
+    finally:
+        __builtin__.__import__ = original
+    total = time.time() - start
+    sys.stdout = sys.__stdout__
+    for level, name, seconds in times:
+        if level <= 1:
+            sys.stderr.write('import time: %8.1f ms | %s%s\n' % (seconds * 1000, '  ' * level, name))
+    sys.stderr.write('total:       %8.1f ms\n' % (total * 1000))
+
+
+def wall(command, calls):
+    with open(os.devnull, 'w') as devnull:
+        times = []
+        for i in range(calls):
+            start = time.time()
+            subprocess.call(command, stdout=devnull, stderr=devnull, cwd=ROOT)
+            times.append(time.time() - start)
+    return sorted(times)[len(times) // 2]
+
+
+def main():
+    if '--imports' in sys.argv:
+        argv = sys.argv[sys.argv.index('--imports') + 1:]
+        return importtime(argv or ['--help'])
+    calls = int(sys.argv[1]) if len(sys.argv) > 1 else 10
+    for title, command in (
+        ('python', [sys.executable, '-c', 'pass']),
+        ('import factory.main', [sys.executable, '-c', 'import sys; sys.path.insert(0, "factory"); import main']),
+        ('fact --help', [sys.executable, MAIN, '--help']),
+        ('fact -n true', [sys.executable, MAIN, '-n', 'true']),
+    ):
+        print '%-20s median of %s calls: %7.1f ms' % (title, calls, wall(command, calls) * 1000)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,289 @@
+#!/usr/bin/env python
+# coding=utf-8
+"""Long-lived helper on host for commands without new ssh channel and shell per call.
+
+Agent is small python script that is sent to host via ssh stdin once
+per connect (see set_connect_env and envs.common.use_agent).
+Then controller and agent exchange json lines over ssh stdin and stdout:
+  request: {"id": int, "op": str, "args": dict}
+  response: {"id": int, "result": ...} or {"id": int, "error": str}
+Agent processes each request in own thread and controller waits
+for response by id, so requests of all greenlets are multiplexed over one pipe.
+Binary data (output of commands, content of files) is base64 encoded.
+
+"""
+
+# This file is part of https://github.com/Friz-zy/factory
+
+import os
+import json
+import base64
+from itertools import count
+import gevent
+from gevent.event import AsyncResult
+from gevent.lock import Semaphore
+from gevent.subprocess import Popen, PIPE
+from main import logging, envs
+
+
+# executed on host by python 2 or 3
+AGENT_SOURCE = r'''
+import os, sys, json, base64, signal, hashlib, threading, subprocess
+inp = getattr(sys.stdin, 'buffer', sys.stdin)
+out = getattr(sys.stdout, 'buffer', sys.stdout)
+lock = threading.Lock()
+
+def b64(data):
+    return base64.b64encode(data).decode('ascii')
+
+def op_ping():
+    return 'pong'
+
+def op_run(command, input='', timeout=None, err_to_out=False):
+    stderr = subprocess.STDOUT if err_to_out else subprocess.PIPE
+    # own session for killing command with all its children
+    p = subprocess.Popen(command, shell=True, stdin=subprocess.PIPE,
+                         stdout=subprocess.PIPE, stderr=stderr, preexec_fn=os.setsid)
+    killed = []
+    def kill():
+        killed.append(True)
+        try:
+            os.killpg(p.pid, signal.SIGKILL)
+        except OSError:
+            pass
+    timer = threading.Timer(timeout, kill) if timeout else None
+    if timer:
+        timer.start()
+    o, e = p.communicate(base64.b64decode(input))
+    if timer:
+        timer.cancel()
+    return [b64(o), b64(e or b''), 124 if killed else p.returncode]
+
+def op_read(path):
+    with open(os.path.expanduser(path), 'rb') as f:
+        return b64(f.read())
+
+def op_write(path, data, mode=None):
+    path = os.path.expanduser(path)
+    with open(path, 'wb') as f:
+        f.write(base64.b64decode(data))
+    if mode is not None:
+        os.chmod(path, mode)
+    return True
+
+def op_stat(path):
+    try:
+        st = os.stat(os.path.expanduser(path))
+    except OSError:
+        return None
+    return {'size': st.st_size, 'mtime': st.st_mtime, 'mode': st.st_mode,
+            'isdir': os.path.isdir(os.path.expanduser(path))}
+
+def op_hash(path):
+    sha = hashlib.sha256()
+    with open(os.path.expanduser(path), 'rb') as f:
+        for block in iter(lambda: f.read(65536), b''):
+            sha.update(block)
+    return sha.hexdigest()
+
+def handle(line):
+    request = json.loads(line.decode('utf-8'))
+    try:
+        response = {'id': request['id'],
+                    'result': globals()['op_' + request['op']](**request.get('args', {}))}
+    except Exception as e:
+        response = {'id': request['id'], 'error': '%s: %s' % (type(e).__name__, e)}
+    data = (json.dumps(response) + '\n').encode('utf-8')
+    with lock:
+        out.write(data)
+        out.flush()
+
+for line in iter(inp.readline, b''):
+    thread = threading.Thread(target=handle, args=(line,))
+    thread.daemon = True
+    thread.start()
+'''
+
+# python reads agent source from first line of stdin
+BOOTSTRAP = ('import sys,json;'
+             'exec(json.loads(getattr(sys.stdin,"buffer",sys.stdin).readline().decode("utf-8")))')
+
+
+# seconds of waiting for response after timeout of command on host
+RESPONSE_GRACE = 2
+
+
+class AgentError(Exception):
+    """Agent has failed or has returned error."""
+    pass
+
+
+class AgentTimeout(AgentError):
+    """Agent hasn't responded in time."""
+    pass
+
+
+class Agent(object):
+    """Connection to agent on host.
+
+    Args:
+      p (Popen object): ssh process with agent
+
+    """
+    def __init__(self, p):
+        self.p = p
+        self.ids = count()
+        self.results = {}
+        self.lock = Semaphore()
+        self.reader = gevent.spawn(self.read_loop)
+
+    @property
+    def alive(self):
+        """True if agent is running."""
+        return not self.reader.ready()
+
+    def read_loop(self):
+        """Loop for agent stdout: set results of requests by id."""
+        try:
+            for line in iter(self.p.stdout.readline, ''):
+                response = json.loads(line)
+                result = self.results.pop(response['id'], None)
+                if result is None:
+                    continue
+                if 'error' in response:
+                    result.set_exception(AgentError(response['error']))
+                else:
+                    result.set(response['result'])
+        finally:
+            # agent is finished, nobody will answer
+            for result in self.results.values():
+                result.set_exception(AgentError('agent has been finished'))
+            self.results.clear()
+
+    def request(self, op, deadline=None, **args):
+        """Send request to agent and wait for response.
+
+        Args:
+          op (str): operation: ping, run, read, write, stat or hash
+          deadline (int or float): seconds of waiting, default is None that means forever
+          **args (dict): arguments of operation
+
+        Return:
+          result of operation
+
+        Raises:
+          AgentError: if agent isn't running or operation has failed
+          AgentTimeout: if deadline is expired
+
+        """
+        if not self.alive:
+            raise AgentError('agent is not running')
+        id = next(self.ids)
+        result = self.results[id] = AsyncResult()
+        try:
+            with self.lock:
+                self.p.stdin.write(json.dumps({'id': id, 'op': op, 'args': args}) + '\n')
+                self.p.stdin.flush()
+        except (IOError, OSError) as e:
+            self.results.pop(id, None)
+            raise AgentError("can't write to agent: %s" % e)
+        timer = gevent.Timeout(deadline)
+        timer.start()
+        try:
+            return result.get()
+        except gevent.Timeout as e:
+            if e is not timer:
+                raise
+            raise AgentTimeout('no response for %s in %s seconds' % (op, deadline))
+        finally:
+            timer.cancel()
+            self.results.pop(id, None)
+
+    def run(self, command, input='', timeout=None, err_to_out=False):
+        """Execute command on host via agent.
+
+        Command is killed by agent after timeout,
+        controller waits RESPONSE_GRACE seconds more for response.
+
+        Return:
+          tuple: sumout, sumerr, status like run with freturn=True
+
+        Raises:
+          AgentTimeout: if agent hasn't responded in time
+
+        """
+        out, err, status = self.request(
+            'run', deadline=timeout + RESPONSE_GRACE if timeout else None,
+            command=command, input=base64.b64encode(input),
+            timeout=timeout, err_to_out=err_to_out
+        )
+        return base64.b64decode(out), base64.b64decode(err), status
+
+    def read(self, path):
+        """Return content of file on host."""
+        return base64.b64decode(self.request('read', path=path))
+
+    def write(self, path, data, mode=None):
+        """Write content to file on host."""
+        return self.request('write', path=path, data=base64.b64encode(data), mode=mode)
+
+    def stat(self, path):
+        """Return dict with size, mtime, mode and isdir of path on host, None if it doesn't exist."""
+        return self.request('stat', path=path)
+
+    def hash(self, path):
+        """Return sha256 of file on host."""
+        return self.request('hash', path=path)
+
+    def close(self):
+        """Stop agent."""
+        from operations import kill_process
+        try:
+            self.p.stdin.close()
+        except (IOError, OSError):
+            pass
+        self.reader.join(timeout=1)
+        if self.p.poll() is None:
+            kill_process(self.p)
+        self.reader.kill()
+
+
+def start_agent():
+    """Start agent on host of envs.connect via ssh.
+
+    Return:
+      Agent class object, None if agent can't be started in envs.common.agent_timeout seconds
+
+    """
+    from operations import ssh_command
+    logger = envs.connect.logger
+    command = ssh_command(
+        '%s -c %s' % (envs.common.agent_python, "'" + BOOTSTRAP + "'"), tty=False
+    )
+    logger.debug('starting agent: %s', command)
+    try:
+        with open(os.devnull, 'w') as devnull:
+            p = Popen(command, stdin=PIPE, stdout=PIPE, stderr=devnull)
+        p.stdin.write(json.dumps(AGENT_SOURCE) + '\n')
+        p.stdin.flush()
+    except (IOError, OSError):
+        logger.warning("can't start agent, used plain ssh", exc_info=True)
+        return None
+    agent = Agent(p)
+    try:
+        agent.request('ping', deadline=envs.common.agent_timeout)
+    except AgentError:
+        logger.warning("can't start agent, used plain ssh")
+        agent.close()
+        return None
+    logger.debug('agent is started')
+    return agent
+
+
+def close_agents():
+    """Stop agents of all connects."""
+    from context_managers import connects
+    for connect in connects.values():
+        agent = connect.get('agent')
+        if agent is not None and agent.alive:
+            agent.close()
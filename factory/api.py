@@ -4,7 +4,10 @@
 
 # This file is part of https://github.com/Friz-zy/factory
 
-from operations import push, pull, put, get, run, sudo, local, open_shell, run_script, check_is_root
+from operations import push, pull, put, get, run, run_many, sudo, local, open_shell, run_script, check_is_root
 from context_managers import set_common_env, set_connect_env, show, hide, settings
-from main import logging, envs, stdin_queue, stdin_loop
+from main import logging, envs, stdin_queue, stdin_loop, setup_logging
+from decorators import depends, task
 env = envs.common
+
+setup_logging()
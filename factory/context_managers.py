@@ -112,8 +112,9 @@ def set_common_env(*args, **kwargs):
       'interactive': True}
 
     """
-    logging.debug('initializing of set_common_env')
-    logging.debug('arguments and another locals: %s', locals())
+    if logging.root.isEnabledFor(logging.DEBUG):
+        logging.debug('initializing of set_common_env')
+        logging.debug('arguments and another locals: %s', locals())
     try:
         dict={}
         if args:
@@ -163,7 +164,11 @@ def set_connect_env(connect_string, con_args=''):
       port (str): port for connect
       con_args (str): options for ssh
       logger (logging.logger object): logger object for this connect
+      control_args (list): ssh options for ControlMaster socket, empty for localhost
+      agent (Agent class object): long-lived helper on host if envs.common.use_agent is True, else None
+      facts (dict): uid, uname and hostname of host, cached in envs.common.facts_file
       check_is_root (bool): True if connected as root, else False
+      vars (dict): variables of host from inventory without host, user and port
 
     Returns:
       envs.connect object with most of all atributes
@@ -173,20 +178,25 @@ def set_connect_env(connect_string, con_args=''):
       >>> from api import *
       >>> with set_connect_env('user@host:port', '') as connect_env:
       ...     connect_env.__dict__ # doctest: +NORMALIZE_WHITESPACE
-      user@host in: id -u
+      user@host in: echo uid=$(id -u); echo uname=$(uname -s); echo hostname=$(uname -n)
       user@host err: Bad port 'port'
       <BLANKLINE>
-      {'check_is_root': False,
+      {'agent': None,
+      'check_is_root': False,
       'connect_string': 'user@host:port',
+      'control_args': [...],
+      'facts': {},
       'con_args': '',
       'host': 'host',
       'user': 'user',
       'logger': ...,
-      'port': 'port'}
+      'port': 'port',
+      'vars': {}}
 
     """
-    logging.debug('initializing of set_connect_env')
-    logging.debug('arguments and another locals: %s', locals())
+    if logging.root.isEnabledFor(logging.DEBUG):
+        logging.debug('initializing of set_connect_env')
+        logging.debug('arguments and another locals: %s', locals())
     try:
         # save envs.connect that was before
         old_dict = {}
@@ -238,9 +248,41 @@ def set_connect_env(connect_string, con_args=''):
                     error.addFilter(WithoutOneLevelLogs(logging.INFO))
                     error.setFormatter(logging.Formatter('%(name)s %(message)s'))
                     envs.connect.logger.addHandler(error)
-            from operations import check_is_root
-            with hide('stdout'):
-                envs.connect.check_is_root = check_is_root()
+                # json lines log of host
+                if envs.common.host_logs_dir:
+                    from log import host_log_handler
+                    handler = host_log_handler(cs)
+                    if handler is not None:
+                        envs.connect.logger.addHandler(handler)
+                        if envs.common.host_logs_only:
+                            envs.connect.logger.propagate = False
+                # one writer for all loggers
+                if envs.common.log_queue:
+                    from log import queue_logger
+                    queue_logger(envs.connect.logger)
+            from operations import gather_facts, control_master_args
+            from facts import load_facts, save_facts
+            envs.connect.agent = None
+            if envs.connect.host in envs.common.localhost:
+                envs.connect.control_args = []
+            else:
+                envs.connect.control_args = control_master_args()
+                if envs.common.use_agent:
+                    from agent import start_agent
+                    envs.connect.agent = start_agent()
+            facts = load_facts(cs)
+            if facts is None:
+                with hide('stdout'):
+                    facts = gather_facts()
+                if facts:
+                    save_facts(cs, facts)
+            envs.connect.facts = facts or {}
+            envs.connect.check_is_root = envs.connect.facts.get('uid') == 0
+            # variables of host from inventory
+            envs.connect.vars = {}
+            if envs.common.inventory:
+                from inventory import connect_variables
+                envs.connect.vars = connect_variables(envs.connect.connect_string)
             logging.debug('envs.connect: %s', envs.connect)
             connects[cs] = envs.connect.__dict__
             yield envs.connect
@@ -259,8 +301,9 @@ class OnlyOneLevelLogs(object):
           level (logging level): only this level will be caught
 
         """
-        logging.debug('initializing of OnlyOneLevelLogs class')
-        logging.debug('arguments for __init__ and another locals: %s', locals())
+        if logging.root.isEnabledFor(logging.DEBUG):
+            logging.debug('initializing of OnlyOneLevelLogs class')
+            logging.debug('arguments for __init__ and another locals: %s', locals())
         self.level = level
 
     def filter(self, record):
@@ -270,7 +313,8 @@ class OnlyOneLevelLogs(object):
           record (logging record): record that will be filtered
 
         """
-        return record.levelno == self.level and envs.common.interactive
+        # output of hosts is collapsed into summary in aggregate mode
+        return record.levelno == self.level and envs.common.interactive and not envs.common.aggregate
 
 
 class WithoutOneLevelLogs(object):
@@ -282,8 +326,9 @@ class WithoutOneLevelLogs(object):
           level (logging level): only this level will not be caught
 
         """
-        logging.debug('initializing of WithoutOneLevelLogs class')
-        logging.debug('arguments for __init__ and another locals: %s', locals())
+        if logging.root.isEnabledFor(logging.DEBUG):
+            logging.debug('initializing of WithoutOneLevelLogs class')
+            logging.debug('arguments for __init__ and another locals: %s', locals())
         self.level = level
 
     def filter(self, record):
@@ -0,0 +1,55 @@
+#!/usr/bin/env python
+# coding=utf-8
+"""Decorators for tasks from factfile."""
+
+# This file is part of https://github.com/Friz-zy/factory
+
+
+def task(function):
+    """Mark function as task, so it is registered even if it is imported into factfile.
+
+    Args:
+      function (function): task
+
+    Return:
+      function: the same function with task attribute
+
+    Examples:
+      >>> @task
+      ... def deploy():
+      ...     pass
+      >>> deploy.task
+      True
+
+    """
+    function.task = True
+    return function
+
+
+def depends(*names):
+    """Declare tasks that must be finished before decorated task on the same host.
+
+    Names are stored in depends attribute of function,
+    so it can be set without decorator too: task.depends = ['update'].
+    Dependencies are used by main.run_tasks_on_host: with --parallel
+    independent tasks are executed concurrently and each task waits only for its dependencies.
+    Dependencies that are not given in command line are executed without arguments.
+
+    Args:
+      *names (str): names of tasks from envs.common.functions
+
+    Return:
+      function: decorator
+
+    Examples:
+      >>> @depends('update', 'upload_config')
+      ... def restart():
+      ...     pass
+      >>> restart.depends
+      ('update', 'upload_config')
+
+    """
+    def decorator(function):
+        function.depends = tuple(getattr(function, 'depends', ())) + names
+        return function
+    return decorator
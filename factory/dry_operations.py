@@ -7,6 +7,12 @@
   Yes, i know, that separate module will be required more time energy for back
   compability with original operations
 
+  Probes of host like 'which echo' and 'test -e path' are executed once per run.
+  Probes that are requested at the same time by parallel tasks of host
+  or by tasks of parallel hosts are executed in one shell session of each host, see Prober.
+  Task needs result of probe right away, so each new probe of serial task
+  is still one session.
+
 """
 
 # This file is part of https://github.com/Friz-zy/factory
@@ -15,10 +21,135 @@ from __future__ import with_statement
 
 import os
 import re
-from main import envs
+import gevent
+from gevent.event import AsyncResult
+from main import logging, envs
+import operations
 from operations import write_message_to_log, run, command_patching_for_sudo
+from operations import UNCHANGED, is_unchanged, local_checksums, write_output_to_log
+from context_managers import hide
+
+
+class Prober(object):
+    """Probes of one host like 'which echo' or 'test -e path', memoized for whole run.
+
+    Probes that aren't known yet are collected from greenlets of host
+    that are waiting for them at the same time and executed by run_many in one shell session:
+    first greenlet yields to others and then executes all collected probes.
+
+    """
+    def __init__(self):
+        self.results = {}
+        self.pending = {}
+        self.queue = []
+
+    def resolve(self, probes, timeout=None):
+        """Return list of tuples of sumout, sumerr and status for probes.
+
+        Args:
+          probes (list): commands like 'which echo'
+          timeout (int or float): seconds before killing of batch, default is envs.common.command_timeout
+
+        """
+        collector = False
+        for probe in probes:
+            if probe not in self.results and probe not in self.pending:
+                # greenlet that starts new batch executes it
+                collector = collector or not self.queue
+                self.pending[probe] = AsyncResult()
+                self.queue.append(probe)
+        if collector:
+            # probes of another greenlets of host are collected into the same batch
+            gevent.sleep(0)
+            batch, self.queue = self.queue, []
+            self.execute(batch, timeout)
+        results = []
+        for probe in probes:
+            if probe not in self.results:
+                self.results[probe] = self.pending[probe].get()
+            results.append(self.results[probe])
+        return results
+
+    def execute(self, batch, timeout=None):
+        from operations import run_many
+        try:
+            # batch is written into log file, output of each probe is written by dry run
+            with hide('stdout'):
+                results = run_many(batch, force=True, timeout=timeout)
+        except Exception as e:
+            for probe in batch:
+                self.pending.pop(probe).set_exception(e)
+            raise
+        for probe, result in zip(batch, results):
+            self.results[probe] = result
+            self.pending.pop(probe).set(result)
+
+
+probers = {}
+
+
+def prober():
+    """Return Prober of envs.connect host."""
+    key = envs.connect.connect_string
+    if key not in probers:
+        probers[key] = Prober()
+    return probers[key]
+
+
+def reset_probes():
+    """Forget results of probes, they are valid only during one run."""
+    probers.clear()
+
+
+def probe(commands, err_to_out=False, timeout=None):
+    """Execute probes via Prober and write them to log like one command.
+
+    Args:
+      commands (list): probes like 'which echo'
+      err_to_out (bool): redirect stderr to stdout if True, default is False
+      timeout (int or float): seconds before killing of batch, default is envs.common.command_timeout
 
-def run(command, use_sudo=False, user='', group='', freturn=False, err_to_out=False, input=None, use_which=True, sumout='', sumerr='', status=0):
+    Return:
+      tuple: sumout, sumerr and status of last probe like run with freturn=True
+
+    """
+    # run overridden by user executes probes itself
+    run = operations.load_runtime_operation('run')
+    if run is not operations.run:
+        return run(''.join('%s; ' % c for c in commands), freturn=True, err_to_out=err_to_out,
+                   force=True, timeout=timeout)
+    write_message_to_log(''.join('%s; ' % c for c in commands), 'in: ')
+    sumout, sumerr, status = '', '', 0
+    for out, err, status in prober().resolve(commands, timeout):
+        sumout += out
+        if err_to_out:
+            sumout += err
+        else:
+            sumerr += err
+    write_output_to_log(sumout, sumerr)
+    return sumout, sumerr, status
+
+
+class CommandStream(object):
+    """Iterator over fake stdout with interface of operations.CommandStream.
+
+    Status and sumerr attributes are fake ones, close does nothing.
+
+    """
+    def __init__(self, sumout, sumerr, status):
+        self.chunks = [sumout] if sumout else []
+        self.status = status
+        self.sumerr = sumerr
+
+    def __iter__(self):
+        return iter(self.chunks)
+
+    def close(self):
+        """Nothing to wait for, fake command is finished."""
+        pass
+
+
+def run(command, use_sudo=False, user='', group='', freturn=False, err_to_out=False, input=None, use_which=True, sumout='', sumerr='', status=0, timeout=None, stream=False, out_file=None):
     """Dummy executing command on host via ssh or subprocess.
 
     If use_which is not False, original run command will be executed with 'which' command,
@@ -37,8 +168,12 @@ def run(command, use_sudo=False, user='', group='', freturn=False, err_to_out=Fa
       sumout (str): fake string that contained all stdout messages, default is ''
       sumerr (str): fake string that contained all stderr, default is ''
       status (int): fake return code of command, default is 0
+      timeout (int or float): seconds before killing of 'which' command, default is envs.common.command_timeout
+      stream (bool): return CommandStream over fake stdout instead of str, default is False
+      out_file (file object or int): write fake stdout into file object or file descriptor
 
     Return:
+      CommandStream if stream is True: iterator over fake stdout with fake status and sumerr
       str if freturn is False: string that contained all stdout messages
       tuple if freturn is True:
         string that contained all stdout messages
@@ -47,8 +182,9 @@ def run(command, use_sudo=False, user='', group='', freturn=False, err_to_out=Fa
 
     """
     logger = envs.connect.logger
-    logger.debug('executing dry-run function')
-    logger.debug('arguments for executing and another locals: %s', locals())
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug('executing dry-run function')
+        logger.debug('arguments for executing and another locals: %s', locals())
 
     original_command = command
     command = command_patching_for_sudo(command, use_sudo, user, group)
@@ -62,25 +198,26 @@ def run(command, use_sudo=False, user='', group='', freturn=False, err_to_out=Fa
             st = command.find(original_command)
             command = command[:st] + '|' + command[st:]
 
-        ncommand = ''
+        probes = []
         command = re.split('\\&|\\||\\;', command)
         for part in command:
-            ncommand += '{0} {1}; '.format(
+            probes.append('{0} {1}'.format(
                 envs.common.which_binary,
                 re.findall(r"[\w']+", part)[0]
-            )
-
-        # import current run implementation
-        try:
-            run = envs.common.functions['run']
-        except KeyError:
-            from operations import run
+            ))
 
+        # probes are memoized and batched per host
         if not (sumout and sumerr and status):
-            sumout, sumerr, status = run(ncommand, freturn=True, err_to_out=err_to_out, force=True)
+            sumout, sumerr, status = probe(probes, err_to_out, timeout)
         else:
-            run(ncommand, err_to_out=err_to_out, force=True)
-
+            probe(probes, err_to_out, timeout)
+
+    if stream:
+        return CommandStream(sumout, sumerr, status)
+    if out_file is not None:
+        from operations import file_sink
+        file_sink(out_file)(sumout)
+        sumout = ''
     if freturn:
         logger.debug('return sumout %s, sumerr %s, status %s', sumout, sumerr, status)
         return (sumout, sumerr, status)
@@ -88,7 +225,7 @@ def run(command, use_sudo=False, user='', group='', freturn=False, err_to_out=Fa
     return sumout
 
 
-def push(src, dst='~/', pull=False, use_test=True, status=0):
+def push(src, dst='~/', pull=False, use_test=True, status=0, cache=None):
     """Dummy copying file or directory.
 
     If use_test is not False, original run command will be executed with 'test' command,
@@ -101,16 +238,26 @@ def push(src, dst='~/', pull=False, use_test=True, status=0):
       use_test (bool): tries to run 'test -e' for each file, default is True
         works only for unix
       status (int): fake return code of command, default is 0
+      cache (bool): report that push will be skipped if host already has the same content,
+        default is envs.common.upload_cache
 
     Return:
       int that mean return code of command:
         exception? 0 : errno on localhost
         status of subprocess with scp
+        UNCHANGED if push will be skipped
 
     """
     logger = envs.connect.logger
-    logger.debug('executing push function')
-    logger.debug('arguments for executing and another locals: %s', locals())
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug('executing push function')
+        logger.debug('arguments for executing and another locals: %s', locals())
+    if cache is None:
+        cache = envs.common.upload_cache
+    if cache and not pull and os.path.exists(src):
+        if is_unchanged(src, dst, local_checksums(src)):
+            write_message_to_log('\'%s\' is unchanged' % dst, 'dry-out: ')
+            return UNCHANGED
     if envs.connect.host in envs.common.localhost:
         logger.debug('used shutil.copy*')
         for p in (src, dst):
@@ -130,12 +277,7 @@ def push(src, dst='~/', pull=False, use_test=True, status=0):
         return status
 
     else:
-        logger.debug('used factory.run')
-        # import current run implementation
-        try:
-            run = envs.common.functions['run']
-        except KeyError:
-            from operations import run
+        logger.debug('used probes')
         if pull:
             if use_test:
                 command = '{0} {1}'.format(
@@ -143,9 +285,9 @@ def push(src, dst='~/', pull=False, use_test=True, status=0):
                     src
                 )
                 if not status:
-                    o, e, status = run(command, freturn=True, force=True)
+                    o, e, status = probe([command])
                 else:
-                    run(command, force=True)
+                    probe([command])
             if os.path.isfile(dst):
                 logger.debug('os.path.isfile(dst) is True, used shutil.copy2')
                 write_message_to_log('file \'%s\' is exists' % dst, 'dry-out: ')
@@ -171,13 +313,13 @@ def push(src, dst='~/', pull=False, use_test=True, status=0):
                     envs.common.test_binary,
                     dst
                 )
-                run(command, force=True)
+                probe([command])
             if not os.path.exists(src) and not status:
                 return 2 # errno.ENOENT
             return status
 
 
-def run_script(local_file, binary=None, freturn=False, err_to_out=False, input=None, use_which=True, sumout='', sumerr='', status=0):
+def run_script(local_file, binary=None, freturn=False, err_to_out=False, input=None, use_which=True, sumout='', sumerr='', status=0, timeout=None):
     """Dummy excecuting script.
 
     If use_which is not False, original run command will be executed with 'which' command,
@@ -194,6 +336,7 @@ def run_script(local_file, binary=None, freturn=False, err_to_out=False, input=N
       sumout (str): fake string that contained all stdout messages, default is ''
       sumerr (str): fake string that contained all stderr, default is ''
       status (int): fake return code of command, default is 0
+      timeout (int or float): seconds before killing of 'which' command, default is envs.common.command_timeout
 
 
     Return:
@@ -207,8 +350,9 @@ def run_script(local_file, binary=None, freturn=False, err_to_out=False, input=N
     host_string = ''.join((envs.connect.user,
                            '@',
                            envs.connect.host))
-    logger.debug('executing run_script function')
-    logger.debug('arguments for executing and another locals: %s', locals())
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug('executing run_script function')
+        logger.debug('arguments for executing and another locals: %s', locals())
 
     if os.path.isfile(local_file):
         logger.debug('os.path.isfile(local_file) is True, used shutil.copy2')
@@ -238,4 +382,4 @@ def run_script(local_file, binary=None, freturn=False, err_to_out=False, input=N
 
     # open new connect
     logger.debug('run command: %s', command)
-    return run(command, err_to_out=err_to_out, use_which=use_which, sumout=sumout, sumerr=sumerr, status=status)
+    return run(command, err_to_out=err_to_out, use_which=use_which, sumout=sumout, sumerr=sumerr, status=status, timeout=timeout)
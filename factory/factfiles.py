@@ -0,0 +1,126 @@
+#!/usr/bin/env python
+# coding=utf-8
+"""Loading of factfiles and fabfiles with cache of compiled code.
+
+Code objects are stored by marshal in envs.common.code_cache_dir
+(default is join(envs.common.home_directory, 'code')), one file per source path
+with magic number of python, mtime, size and sha1 of source.
+Code is reused without reading of source if mtime and size are the same
+and without compilation if sha1 of source is the same.
+
+Fabfiles are executed as is: FabricImporter from sys.meta_path
+returns factory modules for fabric imports like from fabric.api import run.
+
+"""
+
+# This file is part of https://github.com/Friz-zy/factory
+
+from __future__ import with_statement
+
+import os
+import sys
+import imp
+import marshal
+import hashlib
+import tempfile
+from main import logging, envs
+
+
+class FabricImporter(object):
+    """Import hook: fabric and fabric.* are factory and factory.* modules."""
+    def find_module(self, fullname, path=None):
+        if fullname == 'fabric' or fullname.startswith('fabric.'):
+            return self
+        return None
+
+    def load_module(self, fullname):
+        if fullname not in sys.modules:
+            name = 'factory' + fullname[len('fabric'):]
+            __import__(name)
+            sys.modules[fullname] = sys.modules[name]
+        return sys.modules[fullname]
+
+
+def install_fabric_importer():
+    """Add FabricImporter to sys.meta_path once."""
+    if not any(isinstance(i, FabricImporter) for i in sys.meta_path):
+        sys.meta_path.append(FabricImporter())
+
+
+def cache_file(filename):
+    """Return path to cache of compiled code of source file."""
+    directory = envs.common.code_cache_dir or os.path.join(envs.common.home_directory, 'code')
+    key = hashlib.sha1(os.path.abspath(filename)).hexdigest()
+    return os.path.join(os.path.expanduser(directory), key + '.code')
+
+
+def read_cache(filename):
+    """Return tuple of magic, mtime, size, sha1 and code from cache, None if it can't be read."""
+    try:
+        with open(filename, 'rb') as f:
+            return marshal.load(f)
+    except (IOError, EOFError, ValueError, TypeError):
+        return None
+
+
+def write_cache(filename, data):
+    """Atomically rewrite cache file."""
+    directory = os.path.dirname(filename)
+    try:
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        fd, temp = tempfile.mkstemp(dir=directory, prefix='.' + os.path.basename(filename))
+        with os.fdopen(fd, 'wb') as f:
+            marshal.dump(data, f)
+        os.rename(temp, filename)
+    except (IOError, OSError):
+        logging.warning("can't write code cache %s", filename, exc_info=True)
+
+
+def compile_source(filename):
+    """Return code object of source file, cached if envs.common.code_cache.
+
+    Args:
+      filename (str): path to python source
+
+    Return:
+      code object
+
+    """
+    st = os.stat(filename)
+    cache = cache_file(filename) if envs.common.code_cache else None
+    cached = read_cache(cache) if cache else None
+    if cached and cached[0] == imp.get_magic() and cached[1:3] == (st.st_mtime, st.st_size):
+        logging.debug('code of %s from cache %s', filename, cache)
+        return cached[4]
+    with open(filename, 'rU') as f:
+        source = f.read()
+    sha = hashlib.sha1(source).hexdigest()
+    if cached and cached[0] == imp.get_magic() and cached[3] == sha:
+        # file is touched but not changed
+        code = cached[4]
+    else:
+        logging.debug('compiling %s', filename)
+        code = compile(source, filename, 'exec')
+    if cache:
+        write_cache(cache, (imp.get_magic(), st.st_mtime, st.st_size, sha, code))
+    return code
+
+
+def load_source(name, filename):
+    """Execute source file as module like imp.load_source, but with code cache.
+
+    Args:
+      name (str): name of module, for example 'factfile'
+      filename (str): path to python source
+
+    Return:
+      module object
+
+    """
+    code = compile_source(filename)
+    module = imp.new_module(name)
+    module.__file__ = filename
+    sys.modules[name] = module
+    exec code in module.__dict__
+    return module
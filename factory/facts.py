@@ -0,0 +1,206 @@
+#!/usr/bin/env python
+# coding=utf-8
+"""Persistent cache of cheap host facts like uid, uname and hostname.
+
+Facts are stored in json file envs.common.facts_file
+(default is join(envs.common.home_directory, 'facts.json'))
+as {connect_string: {'time': timestamp, 'facts': {...}}},
+so each new fact invocation doesn't pay one more ssh round trip per host
+for checking uid.
+
+File is read once per run and new facts are written once by flush_facts
+at the end of run (main calls it, atexit for api usage): they are merged
+into current content of file under lock, so parallel runs keep facts of each other.
+
+"""
+
+# This file is part of https://github.com/Friz-zy/factory
+
+from __future__ import with_statement
+
+import os
+import json
+import time
+import atexit
+import tempfile
+from main import logging, envs
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+
+# facts of current run: cache is content of file, changed are not written facts
+cache = None
+cache_filename = None
+changed = {}
+
+
+def facts_file():
+    """Return path to facts cache file."""
+    return envs.common.facts_file or os.path.join(envs.common.home_directory, 'facts.json')
+
+
+def read_json(filename):
+    """Read json file.
+
+    Args:
+      filename (str): path to file
+
+    Return:
+      dict: content of file, empty if file can't be read
+
+    """
+    try:
+        with open(filename, 'r') as f:
+            return json.load(f)
+    except (IOError, ValueError):
+        return {}
+
+
+def write_json(filename, data):
+    """Atomically rewrite json file.
+
+    Args:
+      filename (str): path to file
+      data (dict): content of file
+
+    """
+    directory = os.path.dirname(filename) or '.'
+    try:
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        fd, temp = tempfile.mkstemp(dir=directory, prefix='.' + os.path.basename(filename))
+        with os.fdopen(fd, 'w') as f:
+            json.dump(data, f)
+        os.rename(temp, filename)
+    except (IOError, OSError):
+        logging.warning("can't write %s", filename, exc_info=True)
+
+
+def merge_json(filename, changed):
+    """Update json file by changed entries under lock, so parallel runs keep entries of each other.
+
+    Args:
+      filename (str): path to file
+      changed (dict): new entries
+
+    """
+    lock = None
+    try:
+        if fcntl is not None:
+            directory = os.path.dirname(filename) or '.'
+            if not os.path.isdir(directory):
+                os.makedirs(directory)
+            lock = open(filename + '.lock', 'a')
+            fcntl.flock(lock, fcntl.LOCK_EX)
+    except (IOError, OSError):
+        logging.debug("can't lock %s", filename, exc_info=True)
+    try:
+        data = read_json(filename)
+        data.update(changed)
+        write_json(filename, data)
+    finally:
+        if lock is not None:
+            lock.close()
+
+
+def read_facts():
+    """Read all cached facts.
+
+    Return:
+      dict: {connect_string: {'time': timestamp, 'facts': dict}}, empty if cache can't be read
+
+    """
+    return read_json(facts_file())
+
+
+def write_facts(cache):
+    """Atomically rewrite facts cache file.
+
+    Args:
+      cache (dict): {connect_string: {'time': timestamp, 'facts': dict}}
+
+    """
+    write_json(facts_file(), cache)
+
+
+def cached_facts():
+    """Return facts of file, it's read once per run."""
+    global cache, cache_filename
+    if cache is None or cache_filename != facts_file():
+        flush_facts()
+        cache_filename = facts_file()
+        cache = read_json(cache_filename)
+    return cache
+
+
+def reset_facts():
+    """Write changed facts and forget content of file, next run reads it again."""
+    global cache
+    flush_facts()
+    cache = None
+
+
+def load_facts(connect_string):
+    """Return cached facts for connect string.
+
+    Args:
+      connect_string (str): user@host:port
+
+    Return:
+      dict: facts, None if cache is disabled, expired or envs.common.refresh_facts is True
+
+    """
+    if not envs.common.facts_cache or envs.common.refresh_facts:
+        return None
+    entry = cached_facts().get(connect_string)
+    if not entry or time.time() - entry.get('time', 0) > envs.common.facts_ttl:
+        return None
+    logging.debug('cached facts for %s: %s', connect_string, entry['facts'])
+    return entry['facts']
+
+
+def save_facts(connect_string, facts):
+    """Save facts for connect string, they are written by flush_facts.
+
+    Args:
+      connect_string (str): user@host:port
+      facts (dict): facts for saving
+
+    """
+    if not envs.common.facts_cache:
+        return
+    entry = {'time': time.time(), 'facts': facts}
+    cached_facts()[connect_string] = entry
+    changed[connect_string] = entry
+
+
+def flush_facts():
+    """Merge changed facts into facts file once."""
+    if not changed:
+        return
+    merge_json(cache_filename, changed)
+    changed.clear()
+
+
+atexit.register(flush_facts)
+
+
+def invalidate_facts(connect_string=None):
+    """Remove facts of connect string or all facts from cache.
+
+    Args:
+      connect_string (str): user@host:port, all facts will be removed if None
+
+    """
+    global cache
+    flush_facts()
+    data = read_facts()
+    if connect_string is None:
+        data = {}
+    else:
+        data.pop(connect_string, None)
+    write_facts(data)
+    cache = None
@@ -0,0 +1,512 @@
+#!/usr/bin/env python
+# coding=utf-8
+"""Inventory of hosts: groups, variables and patterns.
+
+Inventory is loaded from files given by --inventory (-i) or envs.common.inventory:
+  ini file:
+    web1 port=2222
+    [web]
+    web[01:20]
+    web21 user=deploy host=10.0.0.21
+    [web:vars]
+    role=frontend
+    [prod:children]
+    web
+  json or yaml file with groups like output of ansible dynamic inventory:
+    {"web": {"hosts": ["web1", "web2"], "vars": {"role": "frontend"}, "children": []},
+     "db": ["db1", "db2"],
+     "_meta": {"hostvars": {"web1": {"port": 2222}}}}
+  executable file: dynamic inventory script, it is executed with --list
+    and prints json like json file
+
+Hosts before any group of ini file are in 'ungrouped' group, all hosts are in 'all' group.
+
+Then --host (-H) is pattern of hosts instead of connection strings,
+default is 'all'. Pattern is names of groups or hosts separated by ':' or ',':
+  web*:!web13 - hosts and groups that match web*, without web13
+  web:&prod - hosts of web that are in prod too
+  ~web\\d+ - regular expression
+
+Variables of host are variables of 'all', of its groups (parents before children)
+and of host. host, user and port variables form connection string of host
+and other variables are envs.connect.vars, see set_connect_env.
+
+Parsed files are cached by marshal in join(envs.common.home_directory, 'inventory')
+and reparsed only if mtime or size of file is changed.
+Output of scripts is cached for envs.common.inventory_script_ttl seconds.
+
+"""
+
+# This file is part of https://github.com/Friz-zy/factory
+
+from __future__ import with_statement
+
+import os
+import re
+import json
+import time
+import marshal
+import hashlib
+import tempfile
+import fnmatch
+from itertools import izip, count
+from subprocess import Popen, PIPE
+from main import logging, envs
+
+
+class InventoryError(Exception):
+    """Inventory can't be loaded."""
+    pass
+
+
+class Inventory(object):
+    """Hosts, groups and variables.
+
+    Attributes:
+      hosts (list): names of hosts in order of appearance
+      index (dict): {name: position in hosts}
+      groups (dict): {group: list of names of hosts}, without hosts of children
+      children (dict): {group: list of child groups}
+      group_vars (dict): {group: dict of variables}
+      host_vars (dict): {name: dict of variables}
+      names (dict): {connection string: name}
+
+    """
+    def __init__(self):
+        self.hosts = []
+        self.index = {}
+        self.groups = {'all': [], 'ungrouped': []}
+        self.children = {}
+        self.group_vars = {}
+        self.host_vars = {}
+        self.names = {}
+        self.members = {}
+        self.text = None
+        self._host_groups = None
+        self._parents = None
+        self._connection_vars = None
+
+    def changed(self):
+        """Drop indexes that are built on demand."""
+        self.members = {}
+        self.text = None
+        self._host_groups = None
+        self._parents = None
+        self._connection_vars = None
+
+    def add_host(self, name, group=None, vars=None):
+        self.add_group(group or 'ungrouped', [name])
+        if vars:
+            self.host_vars.setdefault(name, {}).update(vars)
+
+    def add_group(self, group, hosts=(), vars=None, children=()):
+        # list comprehensions instead of add_host for each host of big groups
+        new = [name for name in hosts if name not in self.index]
+        if len(set(new)) != len(new):
+            seen = set()
+            new = [name for name in new if not (name in seen or seen.add(name))]
+        self.index.update(izip(new, count(len(self.hosts))))
+        self.hosts.extend(new)
+        members = self.groups.setdefault(group, [])
+        # ungrouped are hosts without groups, see group_members
+        if group != 'ungrouped':
+            members.extend(hosts)
+        if vars:
+            self.group_vars.setdefault(group, {}).update(vars)
+        for child in children:
+            self.groups.setdefault(child, [])
+            self.children.setdefault(group, [])
+            if child not in self.children[group]:
+                self.children[group].append(child)
+        self.changed()
+
+    @property
+    def host_groups(self):
+        """{name: list of groups}, without parent groups."""
+        if self._host_groups is None:
+            self._host_groups = {}
+            for group, members in self.groups.iteritems():
+                for name in members:
+                    groups = self._host_groups.setdefault(name, [])
+                    if group not in groups:
+                        groups.append(group)
+        return self._host_groups
+
+    def update(self, data):
+        """Add groups and hosts from normalized data, see normalize."""
+        for group, spec in data['groups']:
+            self.add_group(group, spec['hosts'], spec['vars'], spec['children'])
+        for name, vars in data['hostvars'].iteritems():
+            self.add_host(name, vars=vars)
+
+    def group_members(self, group, seen=()):
+        """Return set of hosts of group and its children."""
+        if group == 'all':
+            return set(self.hosts)
+        if group == 'ungrouped':
+            return set(self.hosts).difference(self.host_groups)
+        members = self.members.get(group)
+        if members is None:
+            members = set(self.groups.get(group, ()))
+            for child in self.children.get(group, ()):
+                if child not in seen:
+                    members |= self.group_members(child, seen + (group,))
+            self.members[group] = members
+        return members
+
+    def match(self, term):
+        """Return set of hosts of one term of pattern."""
+        if term in ('all', '*'):
+            return set(self.hosts)
+        if term in self.groups:
+            return self.group_members(term)
+        if term in self.index:
+            return set([term])
+        if term.startswith('~'):
+            # search like in ansible
+            regex = '.*(?:%s).*' % term[1:]
+        elif any(c in term for c in '*?['):
+            regex = fnmatch.translate(term)
+            regex = regex[:-len('\\Z(?ms)')] if regex.endswith('\\Z(?ms)') else regex
+        else:
+            return set()
+        # one regular expression search over all names instead of loop in python
+        if self.text is None:
+            self.text = '\n'.join(self.hosts)
+        regex = re.compile('^(?:%s)$' % regex, re.M)
+        result = set(regex.findall(self.text))
+        for group in self.groups:
+            if regex.match(group):
+                result |= self.group_members(group)
+        return result
+
+    def select(self, pattern='all'):
+        """Return names of hosts that match pattern in order of inventory.
+
+        Args:
+          pattern (str): like 'web*:!web13', see module docstring
+
+        Return:
+          list: names of hosts
+
+        """
+        included = set()
+        intersections = []
+        excluded = set()
+        for term in re.split('[:%s]' % re.escape(envs.common.split_hosts), pattern):
+            term = term.strip()
+            if not term:
+                continue
+            if term.startswith('!'):
+                excluded |= self.match(term[1:])
+            elif term.startswith('&'):
+                intersections.append(self.match(term[1:]))
+            else:
+                hosts = self.match(term)
+                if not hosts:
+                    logging.warning("can't find hosts in inventory for %s", term)
+                included |= hosts
+        for hosts in intersections:
+            included &= hosts
+        included -= excluded
+        if len(included) == len(self.hosts):
+            return list(self.hosts)
+        if len(included) * 8 < len(self.hosts):
+            return sorted(included, key=self.index.get)
+        return [name for name in self.hosts if name in included]
+
+    def parents(self):
+        """Return {group: list of parent groups}."""
+        if self._parents is None:
+            self._parents = {}
+            for parent, children in self.children.iteritems():
+                for child in children:
+                    self._parents.setdefault(child, []).append(parent)
+        return self._parents
+
+    def variables(self, name):
+        """Return variables of host: 'all', groups by depth and host variables."""
+        pending = [(group, 1) for group in self.host_groups.get(name, ())]
+        parents = self.parents()
+        depth = {}
+        while pending:
+            group, level = pending.pop()
+            if depth.get(group, 0) >= level or level > len(self.groups):
+                continue
+            depth[group] = level
+            pending.extend((parent, level + 1) for parent in parents.get(group, ()))
+        # the deepest parents first, groups of host last
+        groups = sorted(depth, key=lambda g: -depth[g])
+        vars = dict(self.group_vars.get('all', {}))
+        for group in groups:
+            vars.update(self.group_vars.get(group, {}))
+        vars.update(self.host_vars.get(name, {}))
+        return vars
+
+    def connect_string(self, name):
+        """Return user@host:port of host from its host, user and port variables."""
+        if self._connection_vars is None:
+            self._connection_vars = any(
+                key in vars
+                for vars in self.host_vars.values() + self.group_vars.values()
+                for key in ('host', 'user', 'port')
+            )
+        vars = self.variables(name) if self._connection_vars else {}
+        cs = str(vars.get('host', name))
+        if 'user' in vars:
+            cs = envs.common.split_user.join((str(vars['user']), cs))
+        if 'port' in vars:
+            cs = envs.common.split_port.join((cs, str(vars['port'])))
+        self.names[cs] = name
+        return cs
+
+
+# inventory of main
+current = None
+
+
+def expand(name):
+    """Expand ranges of ini host names.
+
+    Examples:
+      >>> expand('web[01:03].example.com')
+      ['web01.example.com', 'web02.example.com', 'web03.example.com']
+      >>> expand('db[a:c]')
+      ['dba', 'dbb', 'dbc']
+
+    """
+    m = re.search(r'\[([0-9]+|[a-z]):([0-9]+|[a-z])\]', name)
+    if not m:
+        return [name]
+    start, end = m.groups()
+    head, tail = name[:m.start()], name[m.end():]
+    if start.isdigit():
+        width = len(start) if start.startswith('0') else 0
+        items = ['%0*d' % (width, i) for i in xrange(int(start), int(end) + 1)]
+    else:
+        items = [chr(i) for i in xrange(ord(start), ord(end) + 1)]
+    result = []
+    for item in items:
+        result.extend(expand(head + item + tail))
+    return result
+
+
+def parse_value(value):
+    """Convert ini value to int, float, bool or str."""
+    for convert in (int, float):
+        try:
+            return convert(value)
+        except ValueError:
+            pass
+    if value.lower() in ('true', 'yes'):
+        return True
+    if value.lower() in ('false', 'no'):
+        return False
+    return value.strip('"\'')
+
+
+def parse_ini(text):
+    """Return normalized data of ini inventory."""
+    groups = []
+    specs = {}
+    hostvars = {}
+
+    def spec(group):
+        if group not in specs:
+            specs[group] = {'hosts': [], 'vars': {}, 'children': []}
+            groups.append((group, specs[group]))
+        return specs[group]
+
+    group, kind = 'ungrouped', 'hosts'
+    for line in text.splitlines():
+        line = line.strip()
+        if not line or line[0] in '#;':
+            continue
+        if line.startswith('[') and line.endswith(']'):
+            group, _, kind = line[1:-1].partition(':')
+            kind = kind or 'hosts'
+            spec(group)
+            continue
+        if kind == 'vars':
+            key, _, value = line.partition('=')
+            spec(group)['vars'][key.strip()] = parse_value(value.strip())
+        elif kind == 'children':
+            spec(group)['children'].append(line)
+            spec(line)
+        else:
+            parts = line.split()
+            vars = {}
+            for part in parts[1:]:
+                key, _, value = part.partition('=')
+                vars[key] = parse_value(value)
+            for name in expand(parts[0]):
+                spec(group)['hosts'].append(name)
+                if vars:
+                    hostvars.setdefault(name, {}).update(vars)
+    return {'groups': groups, 'hostvars': hostvars}
+
+
+def normalize(data):
+    """Convert ansible like dict of groups into normalized data.
+
+    Return:
+      dict: {'groups': [(group, {'hosts': list, 'vars': dict, 'children': list}), ...],
+        'hostvars': {name: dict}}
+
+    """
+    groups = []
+    hostvars = {}
+    for group, spec in data.iteritems():
+        if group == '_meta':
+            for name, vars in (spec or {}).get('hostvars', {}).iteritems():
+                hostvars[name] = dict(vars)
+            continue
+        if isinstance(spec, (list, tuple)):
+            spec = {'hosts': spec}
+        spec = spec or {}
+        hosts = spec.get('hosts') or []
+        if isinstance(hosts, dict):
+            # yaml inventory: hosts with variables
+            for name, vars in hosts.iteritems():
+                if vars:
+                    hostvars.setdefault(name, {}).update(vars)
+            hosts = list(hosts)
+        groups.append((group, {
+            'hosts': [str(h) for h in hosts],
+            'vars': dict(spec.get('vars') or {}),
+            'children': list(spec.get('children') or []),
+        }))
+    return {'groups': groups, 'hostvars': hostvars}
+
+
+def ordered(pairs):
+    """object_pairs_hook of json that keeps order of groups."""
+    from collections import OrderedDict
+    return OrderedDict(pairs)
+
+
+def parse_file(filename):
+    """Parse inventory file or output of inventory script."""
+    if os.access(filename, os.X_OK) and not os.path.isdir(filename):
+        p = Popen([filename, '--list'], stdout=PIPE, stderr=PIPE)
+        out, err = p.communicate()
+        if p.returncode:
+            raise InventoryError('inventory script %s failed: %s' % (filename, err.strip()))
+        return normalize(json.loads(out, object_pairs_hook=ordered))
+    with open(filename, 'r') as f:
+        text = f.read()
+    if filename.endswith('.json'):
+        return normalize(json.loads(text, object_pairs_hook=ordered))
+    if filename.endswith(('.yaml', '.yml')):
+        import yaml
+        return normalize(yaml.safe_load(text) or {})
+    return parse_ini(text)
+
+
+def plain(value):
+    """Convert OrderedDict and another subclasses of dict and list for marshal."""
+    if isinstance(value, dict):
+        return dict((plain(k), plain(v)) for k, v in value.iteritems())
+    if isinstance(value, tuple):
+        return tuple(plain(v) for v in value)
+    if isinstance(value, list):
+        return [plain(v) for v in value]
+    return value
+
+
+def cache_file(filename):
+    """Return path to cache of parsed inventory file."""
+    key = hashlib.sha1(os.path.abspath(filename)).hexdigest()
+    return os.path.join(envs.common.home_directory, 'inventory', key)
+
+
+def load_file(filename):
+    """Return normalized data of inventory file from cache or parse it.
+
+    Args:
+      filename (str): path to ini, json or yaml file or executable script
+
+    Return:
+      dict: normalized data, see normalize
+
+    """
+    st = os.stat(filename)
+    script = os.access(filename, os.X_OK)
+    cache = cache_file(filename)
+    try:
+        with open(cache, 'rb') as f:
+            mtime, size, created, data = marshal.load(f)
+        if (mtime, size) == (st.st_mtime, st.st_size) and (
+            not script or time.time() - created < envs.common.inventory_script_ttl
+        ):
+            logging.debug('inventory %s from cache %s', filename, cache)
+            return data
+    except (IOError, EOFError, ValueError, TypeError):
+        pass
+    data = parse_file(filename)
+    if script and not envs.common.inventory_script_ttl:
+        return data
+    directory = os.path.dirname(cache)
+    temp = None
+    try:
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        fd, temp = tempfile.mkstemp(dir=directory, prefix='.' + os.path.basename(cache))
+        with os.fdopen(fd, 'wb') as f:
+            marshal.dump((st.st_mtime, st.st_size, time.time(), plain(data)), f)
+        os.rename(temp, cache)
+    except (IOError, OSError, ValueError):
+        logging.warning("can't write inventory cache %s", cache, exc_info=True)
+        if temp is not None and os.path.exists(temp):
+            os.unlink(temp)
+    return data
+
+
+def load_inventory(filenames):
+    """Load inventory files into inventory.current.
+
+    Args:
+      filenames (str or list): paths to inventory files, str is splitted by envs.common.split_hosts
+
+    Return:
+      Inventory class object
+
+    Raises:
+      InventoryError: if file can't be parsed
+
+    """
+    global current
+    if isinstance(filenames, basestring):
+        filenames = filenames.split(envs.common.split_hosts)
+    inventory = Inventory()
+    for filename in filenames:
+        filename = os.path.expanduser(filename)
+        try:
+            inventory.update(load_file(filename))
+        except (IOError, OSError, ValueError) as e:
+            raise InventoryError("can't load inventory %s: %s" % (filename, e))
+    current = inventory
+    return inventory
+
+
+def resolve_hosts(pattern='all'):
+    """Return connection strings of hosts of inventory.current that match pattern."""
+    return [current.connect_string(name) for name in current.select(pattern)]
+
+
+def connect_variables(connect_string):
+    """Return variables of host for envs.connect without host, user and port.
+
+    Args:
+      connect_string (str): connection string from envs.common.hosts
+
+    """
+    if current is None:
+        return {}
+    name = current.names.get(connect_string, connect_string)
+    if name not in current.index:
+        return {}
+    vars = current.variables(name)
+    for key in ('host', 'user', 'port'):
+        vars.pop(key, None)
+    return vars
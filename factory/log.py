@@ -0,0 +1,365 @@
+#!/usr/bin/env python
+# coding=utf-8
+"""Queue-backed logging: greenlets put records into queue, one writer writes them.
+
+With envs.common.log_queue (set it in factory.json or factory.yaml)
+handlers of root logger and of each connect logger are replaced by QueueHandler.
+QueueHandler applies levels and filters of original handlers in the greenlet
+that logs (filters use greenlet envs) and puts record into bounded queue.
+QueueListener greenlet takes all waiting records at once and writes them
+in gevent threadpool with one flush per handler per batch,
+so output greenlets don't wait for disk and terminal.
+
+Full queue blocks logging greenlet (envs.common.log_queue_policy = 'block', backpressure)
+or record is dropped ('drop') and number of dropped records is logged later.
+
+With envs.common.host_logs_dir each connect also writes own log file
+of json lines like {"time": 1700000000.0, "host": "user@host:22", "stream": "out", "message": "..."},
+see host_log_handler.
+
+"""
+
+# This file is part of https://github.com/Friz-zy/factory
+
+import os
+import re
+import glob
+import gzip
+import json
+import shutil
+import atexit
+import gevent
+from logging.handlers import RotatingFileHandler, TimedRotatingFileHandler
+from gevent.lock import Semaphore
+from gevent.queue import Queue, Full, Empty
+from main import logging, envs
+
+
+class QueueHandler(logging.Handler):
+    """Handler that sends records to QueueListener instead of writing them.
+
+    Args:
+      listener (QueueListener class object): writer of records
+      handlers (list): original handlers of logger
+
+    """
+    def __init__(self, listener, handlers):
+        logging.Handler.__init__(self)
+        self.listener = listener
+        self.handlers = handlers
+
+    def prepare(self, record):
+        """Format message and traceback now, args and exc_info can't be used later."""
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+    def emit(self, record):
+        try:
+            handlers = [h for h in self.handlers if record.levelno >= h.level and h.filter(record)]
+            if handlers:
+                self.listener.put(self.prepare(record), handlers)
+        except (KeyboardInterrupt, SystemExit):
+            raise
+        except Exception:
+            self.handleError(record)
+
+
+class QueueListener(object):
+    """One writer of records from all QueueHandlers.
+
+    Args:
+      handlers (list): original handlers of root logger, they receive warnings about dropped records
+      size (int): max number of records in queue
+      policy (str): 'block' or 'drop' records if queue is full
+      batch_size (int): max number of records written at once
+      interval (int or float): seconds between writes of batches
+
+    """
+    def __init__(self, handlers, size=10000, policy='block', batch_size=1000, interval=0.05):
+        self.handlers = handlers
+        self.queue = Queue(size)
+        self.policy = policy
+        self.batch_size = batch_size
+        self.interval = interval
+        self.dropped = 0
+        # held while batch is written in threadpool
+        self.lock = Semaphore()
+        self.writer = gevent.spawn(self.loop)
+
+    def put(self, record, handlers):
+        """Put record into queue according to policy."""
+        if self.policy == 'drop':
+            try:
+                self.queue.put_nowait((record, handlers))
+            except Full:
+                self.dropped += 1
+        else:
+            self.queue.put((record, handlers))
+
+    def get_batch(self, block=True):
+        """Return all waiting records, but no more than batch_size."""
+        batch = []
+        try:
+            if block:
+                batch.append(self.queue.get())
+            while len(batch) < self.batch_size:
+                batch.append(self.queue.get_nowait())
+        except Empty:
+            pass
+        if self.dropped:
+            record = logging.makeLogRecord({
+                'name': 'factory', 'levelno': logging.WARNING, 'levelname': 'WARNING',
+                'msg': '%s log records were dropped, log queue is full' % self.dropped,
+            })
+            batch.append((record, self.handlers))
+            self.dropped = 0
+        return batch
+
+    def loop(self):
+        """Writer greenlet."""
+        while True:
+            batch = self.get_batch()
+            with self.lock:
+                gevent.get_hub().threadpool.apply(write_batch, (batch,))
+            if len(batch) < self.batch_size:
+                # next batch accumulates while sleeping
+                gevent.sleep(self.interval)
+
+    def flush(self):
+        """Write all waiting records in current greenlet."""
+        while True:
+            batch = self.get_batch(block=False)
+            if not batch:
+                break
+            write_batch(batch)
+
+    def stop(self):
+        """Stop writer and write all waiting records after batch that is being written."""
+        with self.lock:
+            self.writer.kill()
+            self.flush()
+
+
+def write_batch(batch):
+    """Write records and flush each handler once.
+
+    Args:
+      batch (list): tuples of record and list of handlers
+
+    """
+    dirty = []
+    for record, handlers in batch:
+        for handler in handlers:
+            stream = getattr(handler, 'stream', None)
+            if stream is None or type(handler) not in (logging.StreamHandler, logging.FileHandler):
+                # FileHandler with delay or another handler,
+                # subclasses like rotating handlers need own emit
+                handler.handle(record)
+                continue
+            handler.acquire()
+            try:
+                message = handler.format(record)
+                try:
+                    stream.write('%s\n' % message)
+                except UnicodeError:
+                    stream.write(('%s\n' % message).encode('UTF-8'))
+            except Exception:
+                handler.handleError(record)
+            finally:
+                handler.release()
+            if handler not in dirty:
+                dirty.append(handler)
+    for handler in dirty:
+        handler.flush()
+
+
+listener = None
+
+
+def start_queue_logging():
+    """Replace handlers of root logger and created loggers by QueueHandlers.
+
+    Return:
+      QueueListener class object
+
+    """
+    global listener
+    if listener is not None:
+        return listener
+    handlers = logging.root.handlers[:]
+    listener = QueueListener(
+        handlers,
+        envs.common.log_queue_size,
+        envs.common.log_queue_policy,
+        envs.common.log_batch_size,
+        envs.common.log_flush_interval,
+    )
+    for logger in loggers():
+        queue_logger(logger)
+    atexit.register(stop_queue_logging)
+    return listener
+
+
+def queue_logger(logger):
+    """Replace handlers of logger by QueueHandler if queue logging is started.
+
+    Args:
+      logger (logging.logger object): logger, for example logger of connect
+
+    """
+    if listener is None:
+        return
+    handlers = [h for h in logger.handlers if not isinstance(h, QueueHandler)]
+    if not handlers:
+        return
+    for handler in handlers:
+        logger.removeHandler(handler)
+    logger.addHandler(QueueHandler(listener, handlers))
+
+
+def loggers():
+    """Return root logger and all created loggers."""
+    return [logging.root] + [
+        l for l in logging.root.manager.loggerDict.values() if isinstance(l, logging.Logger)
+    ]
+
+
+def stop_queue_logging():
+    """Write all waiting records and return original handlers to loggers."""
+    global listener
+    if listener is None:
+        return
+    listener.stop()
+    for logger in loggers():
+        for handler in logger.handlers[:]:
+            if isinstance(handler, QueueHandler):
+                logger.removeHandler(handler)
+                for h in handler.handlers:
+                    logger.addHandler(h)
+    listener = None
+
+
+class JsonFormatter(logging.Formatter):
+    """Formatter of json lines for host logs.
+
+    Stream is 'out', 'err', 'in' and so on for output of write_message_to_log
+    and 'log' for another records of connect logger.
+
+    Args:
+      host (str): connect string
+
+    """
+    def __init__(self, host):
+        logging.Formatter.__init__(self)
+        self.host = host
+
+    def format(self, record):
+        data = {
+            'time': record.created,
+            'host': self.host,
+            'stream': getattr(record, 'stream', 'log'),
+            'level': record.levelname,
+            'message': getattr(record, 'text', None),
+        }
+        if data['message'] is None:
+            data['message'] = record.getMessage()
+        if record.exc_info and not record.exc_text:
+            record.exc_text = self.formatException(record.exc_info)
+        if record.exc_text:
+            data['exception'] = record.exc_text
+        return json.dumps(data)
+
+
+def compress(filename):
+    """Gzip file into filename.gz and remove it."""
+    with open(filename, 'rb') as src:
+        dst = gzip.open(filename + '.gz', 'wb')
+        try:
+            shutil.copyfileobj(src, dst)
+        finally:
+            dst.close()
+    os.remove(filename)
+
+
+class CompressedRotatingFileHandler(RotatingFileHandler):
+    """RotatingFileHandler that keeps rotated files as name.1.gz, name.2.gz and so on."""
+    def doRollover(self):
+        if self.stream:
+            self.stream.close()
+            self.stream = None
+        if self.backupCount > 0:
+            for i in range(self.backupCount - 1, 0, -1):
+                src = '%s.%d.gz' % (self.baseFilename, i)
+                dst = '%s.%d.gz' % (self.baseFilename, i + 1)
+                if os.path.exists(src):
+                    if os.path.exists(dst):
+                        os.remove(dst)
+                    os.rename(src, dst)
+            dst = self.baseFilename + '.1'
+            if os.path.exists(dst):
+                os.remove(dst)
+            if os.path.exists(self.baseFilename):
+                os.rename(self.baseFilename, dst)
+                compress(dst)
+        if not self.delay:
+            self.stream = self._open()
+
+
+class CompressedTimedRotatingFileHandler(TimedRotatingFileHandler):
+    """TimedRotatingFileHandler that gzips rotated files and keeps backupCount of them."""
+    def doRollover(self):
+        TimedRotatingFileHandler.doRollover(self)
+        pattern = re.sub(r'([[\]*?])', r'[\1]', self.baseFilename) + '.*'
+        for filename in glob.glob(pattern):
+            if not filename.endswith('.gz'):
+                compress(filename)
+        if self.backupCount > 0:
+            # suffixes are times, so sorted names are sorted by time
+            for filename in sorted(glob.glob(pattern + '.gz'))[:-self.backupCount]:
+                os.remove(filename)
+
+
+def host_log_handler(connect_string):
+    """Return handler of json lines log file of connect.
+
+    File is join(envs.common.host_logs_dir, connect_string + '.log'),
+    it's rotated by size (envs.common.host_logs_max_bytes)
+    or by time (envs.common.host_logs_when, see logging.handlers.TimedRotatingFileHandler),
+    rotated files are gzipped if envs.common.host_logs_compress.
+
+    Args:
+      connect_string (str): user@host:port
+
+    Return:
+      logging.Handler object, None if envs.common.host_logs_dir is empty or can't be created
+
+    """
+    directory = os.path.expanduser(envs.common.host_logs_dir)
+    if not directory:
+        return None
+    try:
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+    except OSError:
+        logging.warning("can't create directory %s for host logs", directory, exc_info=True)
+        return None
+    filename = os.path.join(directory, connect_string.replace(os.sep, '_') + '.log')
+    compressed = envs.common.host_logs_compress
+    if envs.common.host_logs_when:
+        cls = CompressedTimedRotatingFileHandler if compressed else TimedRotatingFileHandler
+        handler = cls(
+            filename, when=envs.common.host_logs_when,
+            backupCount=envs.common.host_logs_backup_count, delay=True
+        )
+    else:
+        cls = CompressedRotatingFileHandler if compressed else RotatingFileHandler
+        handler = cls(
+            filename, maxBytes=envs.common.host_logs_max_bytes,
+            backupCount=envs.common.host_logs_backup_count, delay=True
+        )
+    handler.setFormatter(JsonFormatter(connect_string))
+    return handler
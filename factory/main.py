@@ -30,13 +30,16 @@ Config files:
     from envs.common.home_directory and current directories
     and --config PATH cli option
 
+  Logging config is loaded by main after parsing of cli and by import of api.
+
   Load factfiles:
-    always load if exist: factfile.py and factfile
+    load if exist: factfile.py and factfile
     from envs.common.home_directory and current directories
-    and --factfile PATH cli option
+    always or only if command can use their tasks with envs.common.lazy_factfiles
+    and always --factfile PATH cli option
 
   Load fabfile:
-    always load if exist: fabfile.py and fabfile
+    load if exist: fabfile.py and fabfile
     from envs.common.home_directory and current directories
     and --fabfile PATH cli option
 
@@ -53,73 +56,125 @@ if (major,minor) < (2,5):
     print 'Sorry, but factory requires python 2.5 or highest. Bye!'
     sys.exit(2)
 
-import imp
+import re
 import logging
-import logging.config
+import time
 import argparse
+import heapq
 from copy import copy
 
 import gevent
+from gevent.queue import Queue
 from gevent.socket import wait_read
 from state import envs, stdin_queue
 
 
-logging.basicConfig(
-    format=u'%(asctime)s  %(name)s\t%(levelname)-8s\t%(message)s',
-    datefmt='%d %b %Y %H:%M:%S',
-    stream=sys.stdout, # will be replacing by filename
-    filename= 'factory.log',
-    filemode='a',
-    level=logging.INFO,
-)
+identifier = re.compile(r'^[A-Za-z_][A-Za-z0-9_]*$')
 
+def setup_logging():
+    """Configure logging once: hardcode config and then config files.
 
-cfiles = [os.path.join(path, filename) \
-    for path in (envs.common.home_directory, '.') \
-        for filename in ('logging.%s' % frmt \
-            for frmt in ['ini', 'json', 'yaml'])
-]
+    It is called by main after parsing of cli and by api on import,
+    so fact --help and errors of cli don't touch files.
 
-for filename in cfiles:
-    if os.path.exists(filename):
+    """
+    if getattr(setup_logging, 'done', False):
+        return
+    setup_logging.done = True
+    logging.basicConfig(
+        format=u'%(asctime)s  %(name)s\t%(levelname)-8s\t%(message)s',
+        datefmt='%d %b %Y %H:%M:%S',
+        stream=sys.stdout, # will be replacing by filename
+        filename= 'factory.log',
+        filemode='a',
+        level=logging.INFO,
+    )
+
+    cfiles = find_files(
+        (envs.common.home_directory, '.'),
+        ['logging.%s' % frmt for frmt in ['ini', 'json', 'yaml']]
+    )
+
+    for filename in cfiles:
         try:
+            import logging.config as logging_config
             if '.ini' in filename:
-                logging.config.fileConfig(filename)
+                logging_config.fileConfig(filename)
             elif '.json' in filename:
                 import json
                 with open(filename, 'r') as f:
                     config = json.load(f)
-                logging.config.dictConfig(config)
+                logging_config.dictConfig(config)
             elif '.yaml' in filename:
                 import yaml
                 with open(filename, 'r') as f:
                     config = yaml.load(f)
-                logging.config.dictConfig(config)
+                logging_config.dictConfig(config)
             else:
                 logging.error("can't determine file format for %s", filename)
         except:
             logging.error("can't load logging config, used standart configuration", exc_info=True)
 
 
+def find_files(paths, names):
+    """Return existing files with one listing of each directory instead of stat of each file.
+
+    Args:
+      paths (iterable): directories
+      names (iterable): names of files
+
+    Return:
+      list: paths of existing files in order of paths and names
+
+    Examples:
+      >>> find_files(['/nonexistent', '/'], ['etc', 'nonexistent'])
+      ['/etc']
+
+    """
+    found = []
+    for path in paths:
+        try:
+            listing = set(os.listdir(path))
+        except OSError:
+            continue
+        found.extend(os.path.join(path, name) for name in names if name in listing)
+    return found
+
+
 def main():
-    logging.debug('executing main function')
-    logging.debug('arguments from cli and another locals: %s', locals())
-    # load build in operations
-    import operations
-    for key, value in operations.__dict__.iteritems():
-        if callable(value):
-            envs.common.functions[key] = value
-    load_config()
-    load_factfile()
-    load_fabfile()
+    if logging.root.isEnabledFor(logging.DEBUG):
+        logging.debug('executing main function')
+        logging.debug('arguments from cli and another locals: %s', locals())
+    # cli is parsed first, so --help and errors of cli are fast
     args = parse_cli()
+    setup_logging()
+    load_config()
     if args.config_file:
         load_config(args.config_file)
+    # load build in operations
+    import operations
+    envs.common.functions.register_module(operations)
+    # with lazy_factfiles factfiles are executed only if command can use their tasks
+    if not envs.common.lazy_factfiles or needs_factfiles(args.command):
+        load_factfile()
+        load_fabfile()
     if args.factfile:
         load_factfile(args.factfile)
     if args.fabfile:
         load_fabfile(args.fabfile)
-    if args.hosts:
+    # one writer for all logs
+    if envs.common.log_queue:
+        from log import start_queue_logging
+        start_queue_logging()
+    # --inventory
+    if args.inventory:
+        envs.common.inventory = args.inventory
+    if envs.common.inventory:
+        # --host is pattern of hosts from inventory
+        from inventory import load_inventory, resolve_hosts
+        load_inventory(envs.common.inventory)
+        envs.common.hosts = resolve_hosts(args.hosts or 'all')
+    elif args.hosts:
         envs.common.hosts = args.hosts.split(envs.common.split_hosts)
     # --user
     if args.user:
@@ -136,6 +191,33 @@ def main():
     # dry-run
     if args.dry_run:
        envs.common.dry_run = True
+    # --pool-size
+    if args.pool_size is not None:
+        envs.common.pool_size = args.pool_size
+    # --batch
+    if args.batch:
+        envs.common.batch = args.batch
+    # --max-failures
+    if args.max_failures is not None:
+        envs.common.max_failures = args.max_failures
+    # --command-timeout
+    if args.command_timeout:
+        envs.common.command_timeout = args.command_timeout
+    # --host-timeout
+    if args.host_timeout:
+        envs.common.host_timeout = args.host_timeout
+    # --refresh-facts
+    if args.refresh_facts:
+        envs.common.refresh_facts = True
+    # --agent
+    if args.use_agent:
+        envs.common.use_agent = True
+    # --aggregate
+    if args.aggregate:
+        envs.common.aggregate = True
+    # --results-file
+    if args.results_file:
+        envs.common.results_file = args.results_file
     # -r -s shortcuts
     if args.sudo:
         args.command.insert(0, 'sudo')
@@ -149,34 +231,142 @@ def main():
 
     functions_to_execute = parse_functions(args.command)
 
-    logging.debug('arguments from cli and another locals before real executing of tasks: %s', locals())
+    if logging.root.isEnabledFor(logging.DEBUG):
+        logging.debug('arguments from cli and another locals before real executing of tasks: %s', locals())
+
+    from results import collector
+    collector.clean()
+    operations.reset_transfers()
+    # facts and uploads files are read once and written once per run
+    from facts import reset_facts, flush_facts
+    reset_facts()
+    from uploads import reset_uploads, flush_uploads
+    reset_uploads()
+    # probes of dry run are memoized for one run
+    if envs.common.dry_run:
+        from dry_operations import reset_probes
+        reset_probes()
 
     # start of stdin loop
     if envs.common.interactive:
         logging.debug('starting global stdin loop')
         sloop = gevent.spawn(stdin_loop)
 
-    if not envs.common.parallel:
-        logging.debug('hosts will be processed one by one')
-        for host in envs.common.hosts:
-            logging.debug('host %s, functions %s', host, functions_to_execute)
-            run_tasks_on_host(host, functions_to_execute, copy(envs.common), copy(envs.connect))
-    else:
-        threads = []
-        logging.debug('hosts will be processed in parallel')
+    try:
+        if not envs.common.parallel:
+            logging.debug('hosts will be processed one by one')
+            for host in envs.common.hosts:
+                logging.debug('host %s, functions %s', host, functions_to_execute)
+                run_tasks_on_host(host, functions_to_execute, copy(envs.common), copy(envs.connect))
+        else:
+            logging.debug('hosts will be processed in parallel')
+            run_hosts_in_parallel(envs.common.hosts, functions_to_execute)
+
+        # collapsed results of all hosts
+        if envs.common.aggregate:
+            collector.summary()
+        if envs.common.results_file:
+            collector.write(envs.common.results_file)
+    finally:
+        # finish stdin loop
+        if envs.common.interactive:
+            logging.debug('finishing global stdin loop')
+            sloop.kill()
+
+        # stop agents and close ssh ControlMaster sockets even if task failed
+        from agent import close_agents
+        close_agents()
+        operations.close_control_masters()
+        flush_facts()
+        flush_uploads()
+
+        # write all waiting log records
+        if envs.common.log_queue:
+            from log import stop_queue_logging
+            stop_queue_logging()
+
+def run_hosts_in_parallel(hosts, tasks):
+    """Execute tasks on hosts in parallel via gevent pool.
+
+    Hosts are processed by rolling batches of envs.common.batch size:
+    next batch starts only after previous one is finished.
+    Not more than envs.common.pool_size hosts are processed at once.
+    New hosts are not started after envs.common.max_failures hosts failed.
 
-        for host in envs.common.hosts:
-            logging.debug('host %s, functions %s', host, functions_to_execute)
+    Args:
+      hosts (list): list of connection strings like user@host:port
+      tasks (list): list of tuples of functions with args and kwargs
+
+    Return:
+      int: number of failed hosts
+
+    """
+    if logging.root.isEnabledFor(logging.DEBUG):
+        logging.debug('executing run_hosts_in_parallel function')
+        logging.debug('arguments and another locals: %s', locals())
+    from gevent.pool import Pool
+    pool = Pool(envs.common.pool_size or None)
+    max_failures = envs.common.max_failures
+    failures = []
+
+    def check(thread):
+        if not thread.successful() or thread.value:
+            failures.append(thread)
+
+    batches = split_batches(hosts, envs.common.batch)
+    for number, batch in enumerate(batches, 1):
+        start = time.time()
+        threads = []
+        for host in batch:
+            if max_failures is not None and len(failures) >= max_failures:
+                break
+            logging.debug('host %s, functions %s', host, tasks)
             # args and kwargs for run_tasks_on_host()
-            args = (host, functions_to_execute, copy(envs.common), copy(envs.connect))
+            args = (host, tasks, copy(envs.common), copy(envs.connect))
             kwargs = {}
-            threads.append(gevent.spawn(run_tasks_on_host, *args, **kwargs))
+            thread = pool.spawn(run_tasks_on_host, *args, **kwargs)
+            thread.link(check)
+            threads.append(thread)
         gevent.joinall(threads)
+        # link callbacks are called by hub after joining
+        gevent.sleep(0)
+        logging.info(
+            'batch %s/%s: %s of %s hosts processed in %.3f seconds, %s failed in total',
+            number, len(batches), len(threads), len(batch), time.time() - start, len(failures)
+        )
+        if max_failures is not None and len(failures) >= max_failures:
+            logging.error('%s hosts failed, new hosts will not be started', len(failures))
+            break
+    return len(failures)
 
-    # finish stdin loop
-    if envs.common.interactive:
-        logging.debug('finishing global stdin loop')
-        sloop.kill()
+
+def split_batches(hosts, batch=''):
+    """Split list of hosts to batches.
+
+    Args:
+      hosts (list): list of connection strings
+      batch (str or int): size of batch as number of hosts or percent of all hosts like '10%',
+        one batch with all hosts if empty
+
+    Return:
+      list: list of lists of connection strings
+
+    Examples:
+      >>> split_batches(['a', 'b', 'c'], '50%')
+      [['a', 'b'], ['c']]
+      >>> split_batches(['a', 'b', 'c'], 1)
+      [['a'], ['b'], ['c']]
+
+    """
+    batch = str(batch).strip()
+    if not batch or not hosts:
+        return [list(hosts)]
+    if batch.endswith('%'):
+        size = -(-len(hosts) * int(batch[:-1]) // 100)
+    else:
+        size = int(batch)
+    size = max(size, 1)
+    return [list(hosts[i:i + size]) for i in xrange(0, len(hosts), size)]
 
 
 def load_config(config_file=''):
@@ -191,18 +381,18 @@ def load_config(config_file=''):
       config_file (str): path to config file
 
     """
-    logging.debug('executing load_config function')
-    logging.debug('arguments from cli and another locals: %s', locals())
+    if logging.root.isEnabledFor(logging.DEBUG):
+        logging.debug('executing load_config function')
+        logging.debug('arguments from cli and another locals: %s', locals())
 
     # processing config file
     if config_file:
         cfiles = [config_file]
     else:
-        cfiles = [os.path.join(path, filename) \
-            for path in (envs.common.home_directory, '.') \
-                for filename in ('factory.%s' % frmt \
-                    for frmt in ['ini', 'json', 'yaml'])
-        ]
+        cfiles = find_files(
+            (envs.common.home_directory, '.'),
+            ['factory.%s' % frmt for frmt in ['ini', 'json', 'yaml']]
+        )
 
     for filename in cfiles:
         if os.path.exists(filename):
@@ -244,25 +434,22 @@ def load_factfile(factfile=''):
       factfile (str): path to factfile
 
     """
-    logging.debug('executing load_factfile function')
-    logging.debug('arguments from cli and another locals: %s', locals())
+    if logging.root.isEnabledFor(logging.DEBUG):
+        logging.debug('executing load_factfile function')
+        logging.debug('arguments from cli and another locals: %s', locals())
 
     # processing factfile
     if factfile:
         cfiles = [factfile]
     else:
-        cfiles = [os.path.join(path, filename) \
-            for path in (envs.common.home_directory, '.') \
-                for filename in ('factfile', 'factfile.py')
-        ]
+        cfiles = find_files((envs.common.home_directory, '.'), ('factfile', 'factfile.py'))
 
     for filename in cfiles:
         if os.path.exists(filename):
             logging.debug('factfile: %s', filename)
-            factfile = imp.load_source('factfile', filename)
-            for key, value in factfile.__dict__.iteritems():
-                if callable(value):
-                    envs.common.functions[key] = value
+            from factfiles import load_source
+            factfile = load_source('factfile', filename)
+            envs.common.functions.register_module(factfile)
 
     logging.debug('global environment: %s', envs.common)
 
@@ -279,37 +466,56 @@ def load_fabfile(fabfile=''):
       fabfile (str): path to fabfile
 
     """
-    logging.debug('executing load_fabfile function')
-    logging.debug('arguments from cli and another locals: %s', locals())
+    if logging.root.isEnabledFor(logging.DEBUG):
+        logging.debug('executing load_fabfile function')
+        logging.debug('arguments from cli and another locals: %s', locals())
 
     # processing fabfile
     if fabfile:
         cfiles = [fabfile]
     else:
-        cfiles = [os.path.join(path, filename) \
-            for path in (envs.common.home_directory, '.') \
-                for filename in ('fabfile', 'fabfile.py')
-        ]
+        cfiles = find_files((envs.common.home_directory, '.'), ('fabfile', 'fabfile.py'))
 
     for filename in cfiles:
         if os.path.exists(filename):
             logging.debug('fabfile: %s', filename)
-            import tempfile
-            with open(filename, 'r') as fab:
-                src = fab.read().replace('fabric', 'factory')
-                temp = tempfile.NamedTemporaryFile()
-                temp.write(src)
-                temp.flush()
-                fabfile = imp.load_source('fabfile', temp.name)
-                temp.close()
-            for key, value in fabfile.__dict__.iteritems():
-                if callable(value):
-                    envs.common.functions[key] = value
+            from factfiles import load_source, install_fabric_importer
+            # fabric imports of fabfile are imports of factory
+            install_fabric_importer()
+            fabfile = load_source('fabfile', filename)
+            envs.common.functions.register_module(fabfile)
 
     logging.debug('global environment: %s', envs.common)
 
 
 
+def needs_factfiles(l_arguments):
+    """Check if command can use tasks from factfiles or fabfiles.
+
+    Task names are identifiers, so arguments like 'echo "hello world!"'
+    and names of built-in operations don't need factfiles.
+
+    Args:
+      l_arguments (list): list of tasks for executing from cli
+
+    Return:
+      bool: True if one of arguments can be name of task from factfile
+
+    Examples:
+      >>> envs.common.functions['run'] = None
+      >>> needs_factfiles(['run', 'uname -a', 'use_sudo=True'])
+      False
+      >>> needs_factfiles(['deploy:master'])
+      True
+
+    """
+    for argument in l_arguments:
+        name = argument.split(envs.common.split_function)[0]
+        if name not in envs.common.functions and identifier.match(name):
+            return True
+    return False
+
+
 def parse_cli():
     """Use argparse for command line.
 
@@ -319,7 +525,9 @@ def parse_cli():
       namespace: like Namespace(foo='FOO', x=None)
 
     """
-    logging.debug('parsing %s', sys.argv)
+    # logging isn't configured yet: module level logging.debug would call basicConfig
+    if logging.root.isEnabledFor(logging.DEBUG):
+        logging.debug('parsing %s', sys.argv)
     parser = argparse.ArgumentParser(
         formatter_class=argparse.RawTextHelpFormatter,
         prog='fact',
@@ -347,12 +555,20 @@ Warning: don't use command arg1{1}arg2 format""".format(
         '-H', '--host', dest='hosts',
         nargs='?',
         help='''connection strings like user%shost%sport
+  or pattern of hosts with --inventory
   default is %s''' % (
             envs.common.split_user,
             envs.common.split_port,
             envs.common.hosts
         )
     )
+    parser.add_argument(
+        '-i', '--inventory', dest='inventory',
+        action='append',
+        help='''ini, json or yaml inventory file or executable
+  inventory script, then --host is pattern of hosts
+  like 'web*:!web13', default is all hosts'''
+    )
     parser.add_argument(
         '-r', dest='run', action='store_true',
         help='execute run() with given arguments'
@@ -412,6 +628,51 @@ Warning: don't use command arg1{1}arg2 format""".format(
         action='store_true', default=False,
         help='''check system without actually running operations'''
     )
+    parser.add_argument(
+        '--pool-size', dest='pool_size', type=int,
+        help='''max number of hosts processed at once
+  in parallel mode, default is unlimited'''
+    )
+    parser.add_argument(
+        '--batch', dest='batch',
+        help='''process hosts by rolling batches of this size
+  in parallel mode, number of hosts or percent like 10%%'''
+    )
+    parser.add_argument(
+        '--max-failures', dest='max_failures', type=int,
+        help='''don't start new hosts after this number
+  of failed hosts in parallel mode'''
+    )
+    parser.add_argument(
+        '--command-timeout', dest='command_timeout', type=float,
+        help='''kill each command after this number
+  of seconds, default is unlimited'''
+    )
+    parser.add_argument(
+        '--host-timeout', dest='host_timeout', type=float,
+        help='''kill all tasks on host after this number
+  of seconds, default is unlimited'''
+    )
+    parser.add_argument(
+        '--refresh-facts', dest='refresh_facts',
+        action='store_true', default=False,
+        help='''ignore and rewrite cached host facts'''
+    )
+    parser.add_argument(
+        '--agent', dest='use_agent',
+        action='store_true', default=False,
+        help='''execute commands via long-lived python agent on hosts'''
+    )
+    parser.add_argument(
+        '--aggregate', dest='aggregate',
+        action='store_true', default=False,
+        help='''don't print output of each host, print one summary per distinct result with its hosts'''
+    )
+    parser.add_argument(
+        '--results-file', dest='results_file',
+        default='',
+        help='''write stdout, stderr and status of each host and groups of hosts with identical results into json file'''
+    )
     return parser.parse_args()
 
 
@@ -443,61 +704,72 @@ def parse_functions(l_arguments):
     logging.debug('executing parse_functions function')
     logging.debug('arguments %s', l_arguments)
 
-    functions = []
-    tasks = []
-
-    # an implicit execution
-    logging.debug('checking first argument')
-    zero = l_arguments[0].split(envs.common.split_function)[0]
-    if zero not in envs.common.functions.keys():
-        logging.warning('can not find function, executing built-in run')
-        l_arguments.insert(0, 'run')
-        logging.debug('new arguments %s', l_arguments)
+    # grammar
+    functions = envs.common.functions
+    split_function = envs.common.split_function
+    split_args = envs.common.split_args
 
-    # step 1: split all to lists of functions with args
-    logging.debug('spliting all arguments to lists of functions with args')
+    # one pass: each argument starts new task or is argument of current task
+    tasks = []
+    current = None
     for f in l_arguments:
-        if f in envs.common.functions.keys():
-            functions.append([f])
-        elif envs.common.split_function in f:
-            function, args = f.split(envs.common.split_function)
-            if function in envs.common.functions.keys():
-                functions.append([function])
-                functions[-1].extend(args.split(envs.common.split_args))
-            else:
-                functions[-1].append(f)
+        if f in functions:
+            current = (f, [])
         else:
-            # NOTE: functions[-1].extend(args.split(envs.common.split_args))
-            # don't uses in this case
-            functions[-1].append(f)
-    logging.debug('functions %s', functions)
-
-    # step 2: parse args and kwargs for each function
-    logging.debug('parsing args and kwargs for each function')
-    for f in functions:
-        fnct = f[0]
-        args = f[1:]
-        kwargs = {}
-        for a in args[::-1]:
-            e = a.find('=')
-            if e != (-1 or 0) and a[e-1] not in envs.common.arithmetic_symbols:
-                k, v = a.split('=')
-                k = k.strip()
-                v = v.strip()
-                kwargs[k] = v
-                args.pop()
+            function, sep, args = f.partition(split_function)
+            if sep and function in functions:
+                current = (function, args.split(split_args))
+            elif current is None:
+                # an implicit execution
+                logging.warning('can not find function, executing built-in run')
+                current = ('run', [f])
             else:
-                break
-        tasks.append((fnct, args, kwargs))
+                # NOTE: current[1].extend(args.split(split_args))
+                # don't uses in this case
+                current[1].append(f)
+                continue
+        tasks.append(current)
+
+    tasks = [(fnct, args, split_kwargs(args)) for fnct, args in tasks]
     logging.debug('tasks %s', tasks)
 
     return tasks
 
+
+def split_kwargs(args):
+    """Move trailing key=value arguments into kwargs.
+
+    Args:
+      args (list): arguments of task, kwargs are removed from it
+
+    Return:
+      dict: kwargs
+
+    Examples:
+      >>> args = ['a', 'x>=1', 'b=2', 'c = 3']
+      >>> sorted(split_kwargs(args).items()), args
+      ([('b', '2'), ('c', '3')], ['a', 'x>=1'])
+
+    """
+    kwargs = {}
+    symbols = envs.common.arithmetic_symbols
+    while args:
+        a = args[-1]
+        e = a.find('=')
+        if e == -1 or a[e-1] in symbols:
+            break
+        k, sep, v = a.partition('=')
+        kwargs[k.strip()] = v.strip()
+        args.pop()
+    return kwargs
+
 def run_tasks_on_host(connect_string, tasks, common_env, connect_env, con_args=''):
     """Set greenlet envs, open connect to host and executed tasks.
 
     Use set_connect_env context manager for set connect args.
     And then executed tasks for this host.
+    Tasks are ordered by their dependencies (see decorators.depends),
+    with envs.common.parallel each task starts right after its dependencies.
     Hack for greenlets:
       common_env its copy of envs.common
       connect_env its copy of envs.connect
@@ -509,30 +781,237 @@ def run_tasks_on_host(connect_string, tasks, common_env, connect_env, con_args='
       connect_env (AttributedDict class object): global class instance for connect environment
       con_args (str): options for ssh
 
+    Return:
+      int: 0 if all tasks were executed, TIMEOUT_STATUS if tasks were killed
+        after envs.common.host_timeout seconds
+
     """
     envs.common = common_env
     envs.connect = connect_env
-    logging.debug('executing run_tasks_on_host function')
-    logging.debug('arguments for executing and another locals: %s', locals())
+    if logging.root.isEnabledFor(logging.DEBUG):
+        logging.debug('executing run_tasks_on_host function')
+        logging.debug('arguments for executing and another locals: %s', locals())
     from context_managers import set_connect_env
-    with set_connect_env(connect_string, con_args):
-        #TODO: checking first connection via ssh
-        if envs.common.parallel:
-            gevent.sleep(0)
-            logging.debug('tasks will be processed in parallel')
-            threads = []
-            for function, args, kwargs in tasks:
-                args = (function, args, kwargs,
-                        copy(envs.common),
-                        copy(envs.connect)
-                )
-                threads.append(gevent.spawn(run_task, *args))
-            gevent.joinall(threads)
-        else:
-            logging.debug('tasks will be processed one by one')
-            for function, args, kwargs in tasks:
-                run_task(function, args, kwargs, copy(envs.common), copy(envs.connect))
+    from operations import TIMEOUT_STATUS, reset_distributions, release_distributions
+    from results import collector
+    threads = []
+    reset_distributions(connect_string)
+    collector.start(connect_string)
+    # local commands of tasks like scp are results of this host too
+    envs.common.results_host = connect_string
+    # wall-clock budget for all tasks on this host
+    budget = gevent.Timeout(envs.common.host_timeout or None)
+    budget.start()
+    try:
+        with set_connect_env(connect_string, con_args):
+            #TODO: checking first connection via ssh
+            tasks, dependencies = resolve_dependencies(tasks)
+            if envs.common.parallel:
+                gevent.sleep(0)
+                logging.debug('tasks will be processed in parallel')
+                run_tasks_graph(tasks, dependencies, threads)
+            else:
+                logging.debug('tasks will be processed one by one')
+                for i in topological_order(tasks, dependencies):
+                    function, args, kwargs = tasks[i]
+                    run_task(function, args, kwargs, copy(envs.common), copy(envs.connect))
+    except gevent.Timeout as e:
+        if e is not budget:
+            raise
+        logging.error('tasks on host %s were killed after %s seconds timeout',
+                      connect_string, envs.common.host_timeout)
+        # run() kills commands of killed tasks
+        gevent.killall(threads)
+        collector.finish(connect_string, TIMEOUT_STATUS)
+        return TIMEOUT_STATUS
+    except Exception as e:
+        collector.finish(connect_string, 1, '%s: %s' % (type(e).__name__, e))
+        raise
+    finally:
+        budget.cancel()
+        # children of this host in push distribution tree don't wait for it anymore
+        release_distributions(connect_string)
+    return 0
+
+
+def resolve_dependencies(tasks):
+    """Find dependencies of each task and add missing ones.
+
+    Dependencies are names of tasks from depends attribute of task function,
+    see decorators.depends. Task waits for all tasks with this name,
+    dependencies that are not in tasks are added to the end without arguments.
+
+    Args:
+      tasks (list): list of tuples of functions with args and kwargs
 
+    Return:
+      tuple:
+        list: tasks with added dependencies
+        list: sets of indexes of tasks that must be finished before each task
+
+    """
+    tasks = list(tasks)
+    indexes = {}
+    for i, task in enumerate(tasks):
+        indexes.setdefault(task[0], []).append(i)
+    dependencies = []
+    i = 0
+    while i < len(tasks):
+        function = envs.common.functions.get(tasks[i][0])
+        deps = set()
+        for name in getattr(function, 'depends', ()):
+            if name not in indexes:
+                logging.debug('adding task %s as dependency of %s', name, tasks[i][0])
+                tasks.append((name, [], {}))
+                indexes[name] = [len(tasks) - 1]
+            deps.update(indexes[name])
+        deps.discard(i)
+        dependencies.append(deps)
+        i += 1
+    return tasks, dependencies
+
+
+def dependency_graph(dependencies):
+    """Return reverse edges and indegree counts of dependencies.
+
+    Args:
+      dependencies (list): sets of indexes of tasks that must be finished before each task
+
+    Return:
+      tuple:
+        list: lists of indexes of tasks that wait for each task
+        list: number of dependencies of each task
+
+    """
+    dependents = [[] for deps in dependencies]
+    for i, deps in enumerate(dependencies):
+        for j in deps:
+            dependents[j].append(i)
+    return dependents, [len(deps) for deps in dependencies]
+
+
+def topological_order(tasks, dependencies):
+    """Return indexes of tasks so that each task follows its dependencies.
+
+    Order of command line is kept for independent tasks:
+    the ready task with the lowest index always goes first.
+
+    Args:
+      tasks (list): list of tuples of functions with args and kwargs
+      dependencies (list): sets of indexes of tasks that must be finished before each task
+
+    Return:
+      list: indexes of tasks
+
+    Raises:
+      ValueError: if dependencies are circular
+
+    """
+    dependents, indegree = dependency_graph(dependencies)
+    # sorted list is already a heap
+    ready = [i for i, count in enumerate(indegree) if not count]
+    order = []
+    while ready:
+        i = heapq.heappop(ready)
+        order.append(i)
+        for j in dependents[i]:
+            indegree[j] -= 1
+            if not indegree[j]:
+                heapq.heappush(ready, j)
+    if len(order) < len(tasks):
+        raise ValueError('circular dependencies between tasks %s' % ', '.join(
+            tasks[i][0] for i, count in enumerate(indegree) if count
+        ))
+    return order
+
+
+def run_tasks_graph(tasks, dependencies, threads):
+    """Execute tasks concurrently, each task starts right after its dependencies.
+
+    After execution critical path, the chain of dependencies that defined
+    the total time, is written to log.
+
+    Args:
+      tasks (list): list of tuples of functions with args and kwargs
+      dependencies (list): sets of indexes of tasks that must be finished before each task
+      threads (list): spawned greenlets are appended to it, so caller can kill them
+
+    """
+    # check before executing of any task
+    topological_order(tasks, dependencies)
+    dependents, indegree = dependency_graph(dependencies)
+    started = {}
+    finished = {}
+    spawned = {}
+    done = Queue()
+    failed = None
+
+    def timed_task(i, *args):
+        started[i] = time.time()
+        try:
+            run_task(*args)
+        finally:
+            finished[i] = time.time()
+
+    def start(i):
+        function, args, kwargs = tasks[i]
+        args = (i, function, args, kwargs,
+                copy(envs.common),
+                copy(envs.connect)
+        )
+        spawned[i] = gevent.spawn(timed_task, *args)
+        spawned[i].link(lambda thread: done.put(i))
+        threads.append(spawned[i])
+
+    for i, count in enumerate(indegree):
+        if not count:
+            start(i)
+    running = len(spawned)
+    while running:
+        i = done.get()
+        running -= 1
+        # host is failed if one of tasks is failed, dependent tasks will not be started
+        if not spawned[i].successful():
+            if failed is None:
+                failed = spawned[i]
+            continue
+        if failed is not None:
+            continue
+        for j in dependents[i]:
+            indegree[j] -= 1
+            if not indegree[j]:
+                start(j)
+                running += 1
+    if failed is not None:
+        raise failed.exception
+    log_critical_path(tasks, dependencies, started, finished)
+
+
+def log_critical_path(tasks, dependencies, started, finished):
+    """Write to log chain of dependencies that finished last.
+
+    Args:
+      tasks (list): list of tuples of functions with args and kwargs
+      dependencies (list): sets of indexes of tasks that must be finished before each task
+      started (dict): start time of each task by index
+      finished (dict): finish time of each task by index
+
+    """
+    if not finished:
+        return
+    path = [max(finished, key=finished.get)]
+    while True:
+        deps = [i for i in dependencies[path[-1]] if i in finished]
+        if not deps:
+            break
+        path.append(max(deps, key=finished.get))
+    path.reverse()
+    logging.info(
+        'critical path: %s, %.3f seconds, all tasks took %.3f seconds',
+        ' -> '.join('%s (%.3f)' % (tasks[i][0], finished[i] - started[i]) for i in path),
+        finished[path[-1]] - started[path[0]],
+        max(finished.itervalues()) - min(started.itervalues())
+    )
 
 
 def run_task(function, args, kwargs, common_env, connect_env):
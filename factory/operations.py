@@ -7,17 +7,63 @@
 from __future__ import with_statement
 
 import os
+import re
 from copy import copy
+from errno import EAGAIN, EWOULDBLOCK
+from signal import SIGTERM, SIGKILL
 from shlex import split
+from pipes import quote
 from getpass import getpass
 from shutil import copy2, copytree
+import time
+import hashlib
+import posixpath
 import gevent
+from gevent.event import AsyncResult
+from gevent.queue import Queue, Empty
 from gevent.socket import wait_read, timeout
 from gevent.subprocess import Popen, PIPE, STDOUT
-from main import envs, stdin_queue
-from context_managers import set_connect_env
+from main import logging, envs, stdin_queue
+from context_managers import set_connect_env, hide
+from agent import AgentError, AgentTimeout
+from results import collector
 
-def run(command, use_sudo=False, user='', group='', freturn=False, err_to_out=False, input=None, force=False, **kwargs):
+newlines = re.compile('[\r\n]')
+
+# return code of command killed by timeout, the same as in coreutils timeout
+TIMEOUT_STATUS = 124
+
+
+class Status(int):
+    """Return code with name, it is equal to its int value."""
+    def __new__(cls, value, name):
+        status = int.__new__(cls, value)
+        status.name = name
+        return status
+
+    def __repr__(self):
+        return self.name
+
+    __str__ = __repr__
+
+
+# status of push that was skipped because host already has the same content
+UNCHANGED = Status(0, 'UNCHANGED')
+# state of push via distribute: {(src, dst, content hash): {'checksums': dict, 'hosts': {connect_string: AsyncResult}}}
+distributions = {}
+# connect strings of hosts that finished all tasks
+released = set()
+# sha256 of local files for one run: {path: ((mtime, size), sha256)}
+file_checksums = {}
+# compress and decompress commands for envs.common.transfer_compression
+compressors = {
+    'gzip': ('gzip -c', 'gzip -dc'),
+    'zstd': ('zstd -q -c', 'zstd -q -dc'),
+}
+# max count of not consumed chunks of run(stream=True)
+STREAM_QUEUE_SIZE = 16
+
+def run(command, use_sudo=False, user='', group='', freturn=False, err_to_out=False, input=None, force=False, timeout=None, stream=False, out_file=None, **kwargs):
     """Execute command on host via ssh or subprocess.
 
     TODO: check on windows - maybe it will not work on it
@@ -42,29 +88,33 @@ def run(command, use_sudo=False, user='', group='', freturn=False, err_to_out=Fa
       err_to_out (bool): redirect stderr to stdout if True, default is False
       input (str or tuple of str): str will be flushed to stdin after executed command, default is None
       force (bool): executing full operations even if envs.common.dry_run is True
+      timeout (int or float): seconds before killing of command, default is envs.common.command_timeout
+      stream (bool): return CommandStream iterator over stdout chunks instead of accumulated stdout, default is False
+      out_file (file object or int): write stdout into file object or file descriptor instead of accumulating it
       **kwargs (dict): add only for supporting dry-run replacing
 
     Return:
-      str if freturn is False: string that contained all stdout messages
+      CommandStream if stream is True: iterator over stdout chunks with status and sumerr attributes
+      str if freturn is False: string that contained all stdout messages, empty if out_file is used
       tuple if freturn is True:
-        string that contained all stdout messages
+        string that contained all stdout messages, empty if out_file is used
         string that contained all stderr
-        int that mean return code of command
+        int that mean return code of command, TIMEOUT_STATUS if command was killed by timeout
 
     """
     # hack for dry-run
     if envs.common.dry_run and not force:
         from dry_operations import run
-        return run(command, use_sudo, user, group, freturn, err_to_out, input, **kwargs)
+        return run(command, use_sudo, user, group, freturn, err_to_out, input, timeout=timeout,
+                   stream=stream, out_file=out_file, **kwargs)
 
     logger = envs.connect.logger
     interactive = envs.common.interactive
     parallel = envs.common.parallel
-    host_string = ''.join((envs.connect.user,
-                           '@',
-                           envs.connect.host))
-    logger.debug('executing run function')
-    logger.debug('arguments for executing and another locals: %s', locals())
+    debug = logger.isEnabledFor(logging.DEBUG)
+    if debug:
+        logger.debug('executing run function')
+        logger.debug('arguments for executing and another locals: %s', locals())
 
     command = command_patching_for_sudo(command, use_sudo, user, group)
 
@@ -74,23 +124,42 @@ def run(command, use_sudo=False, user='', group='', freturn=False, err_to_out=Fa
     stderr = PIPE
     if err_to_out:
         stderr = STDOUT
-    logger.debug('stderr: %s', stderr)
+    if debug:
+        logger.debug('stderr: %s', stderr)
+    if timeout is None:
+        timeout = envs.common.command_timeout
+    # long-lived agent on host, see agent module
+    agent = getattr(envs.connect, 'agent', None)
+    if agent is not None and agent.alive and not stream and out_file is None:
+        try:
+            result = agent_run(agent, command, input, timeout, err_to_out)
+        except AgentTimeout:
+            # command may be still running on host, so it isn't repeated via ssh
+            logger.error('command was killed after %s seconds timeout', timeout)
+            result = ('', '', TIMEOUT_STATUS)
+        except AgentError:
+            logger.warning('agent has failed, used plain ssh', exc_info=debug)
+            result = None
+        if result is not None:
+            sumout, sumerr, status = result
+            if not force:
+                collector.add(sumout, sumerr, status)
+            if freturn:
+                return (sumout, sumerr, status)
+            return sumout
+    # own process group for killing command with all its children
+    new_pgrp = os.name != 'nt' and bool(timeout or envs.common.host_timeout)
+    preexec_fn = os.setpgrp if new_pgrp else None
     # open new connect
     if envs.connect.host in envs.common.localhost:
-        logger.debug('executing command %s with shell=True', command)
-        p = Popen(command, stdout=PIPE, stderr=stderr, stdin=PIPE, shell=True)
+        if debug:
+            logger.debug('executing command %s with shell=True', command)
+        p = Popen(command, stdout=PIPE, stderr=stderr, stdin=PIPE, shell=True, preexec_fn=preexec_fn)
     else:
-        scommand = [
-            envs.common.ssh_binary,
-            envs.common.ssh_port_option,
-            str(envs.connect.port),
-            host_string,
-        ]
-        scommand += envs.common.ssh_args.split()
-        scommand += envs.connect.con_args.split()
-        scommand += [command]
-        logger.debug('executing command %s', scommand)
-        p = Popen(scommand, stdout=PIPE, stderr=stderr, stdin=PIPE)
+        scommand = ssh_command(command)
+        if debug:
+            logger.debug('executing command %s', scommand)
+        p = Popen(scommand, stdout=PIPE, stderr=stderr, stdin=PIPE, preexec_fn=preexec_fn)
     # flush input
     if input:
         if type(input) is str:
@@ -99,48 +168,303 @@ def run(command, use_sudo=False, user='', group='', freturn=False, err_to_out=Fa
             s = str(s)
             if s[-1] not in ('\n', '\r'):
                 s += '\n'
-            logger.debug('flushing input %s', s)
+            if debug:
+                logger.debug('flushing input %s', s)
             p.stdin.write(s)
             p.stdin.flush()
-    # run another command
-    if parallel:
-        gevent.sleep(0)
-        logger.debug('run another command with gevent.sleep(0)')
-    # processing std loop
     threads = []
-    if interactive:
-        args = (p, copy(envs.common), copy(envs.connect))
-        gin = gevent.spawn(in_loop, *args)
-        logger.debug('executing in_loop with args %s', args)
-        threads.append(gin)
-
-    args = (p, copy(envs.common), copy(envs.connect))
-    gout = gevent.spawn(out_loop, *args)
-    logger.debug('executing out_loop with args %s', args)
-    threads.append(gout)
-
-    if not err_to_out:
-        args = (p, copy(envs.common), copy(envs.connect), True)
-        gerr = gevent.spawn(out_loop, *args)
-        logger.debug('executing err_loop with args %s', args)
-        threads.append(gerr)
-
-    gevent.joinall(threads)
-    logger.debug('child process has terminated with status %s', p.returncode)
-    #TODO: check returncode if returncode==None
-    sumout = gout.value
-    sumerr = gerr.value if not err_to_out else ''
-    status = p.returncode
-    if p.poll() is None:
-        p.terminate()
-        p.kill()
+    gin = None
+    gerr = None
+    sink = None
+    if stream:
+        chunks = Queue(STREAM_QUEUE_SIZE)
+        sink = chunks.put
+    elif out_file is not None:
+        sink = file_sink(out_file)
+    try:
+        # run another command
+        if parallel:
+            gevent.sleep(0)
+            if debug:
+                logger.debug('run another command with gevent.sleep(0)')
+        # processing std loop
+        if interactive:
+            args = (p, copy(envs.common), copy(envs.connect))
+            gin = gevent.spawn(in_loop, *args)
+            if debug:
+                logger.debug('executing in_loop with args %s', args)
+            threads.append(gin)
+
+        args = (p, copy(envs.common), copy(envs.connect), False, sink)
+        gout = gevent.spawn(out_loop, *args)
+        if debug:
+            logger.debug('executing out_loop with args %s', args)
+        threads.append(gout)
+
+        if not err_to_out:
+            args = (p, copy(envs.common), copy(envs.connect), True)
+            gerr = gevent.spawn(out_loop, *args)
+            if debug:
+                logger.debug('executing err_loop with args %s', args)
+            threads.append(gerr)
+    except:
+        reap_command(p, threads, new_pgrp)
+        raise
+
+    if stream:
+        # end of stream
+        gout.link(lambda g: gevent.spawn(chunks.put, None))
+        return CommandStream(p, chunks, threads, gin, gerr, timeout, new_pgrp)
+
+    status = wait_command(p, threads, gin, timeout, new_pgrp)
+    sumout = gout.value or ''
+    sumerr = (gerr.value or '') if gerr is not None else ''
+    if not force:
+        collector.add(sumout, sumerr, status)
     if freturn:
-        logger.debug('return sumout %s, sumerr %s, status %s', sumout, sumerr, status)
+        if debug:
+            logger.debug('return sumout %s, sumerr %s, status %s', sumout, sumerr, status)
         return (sumout, sumerr, status)
-    logger.debug('return sumout %s', sumout)
+    if debug:
+        logger.debug('return sumout %s', sumout)
     return sumout
 
 
+class CommandStream(object):
+    """Iterator over stdout chunks of command started by run(stream=True).
+
+    Output is not accumulated: out_loop puts chunks into bounded queue,
+    so slow consumer pauses reading of command output.
+    After the end of iteration status and sumerr attributes are set
+    like in tuple returned by run(freturn=True).
+
+    """
+    def __init__(self, p, chunks, threads, gin, gerr, timeout=None, group=False):
+        self.p = p
+        self.chunks = chunks
+        self.threads = threads
+        self.gin = gin
+        self.gerr = gerr
+        self.group = group
+        self.deadline = time.time() + timeout if timeout else None
+        self.status = None
+        self.sumerr = ''
+        self.exhausted = False
+
+    def remaining(self):
+        """Return seconds before timeout, None if there is no timeout."""
+        if self.deadline is None:
+            return None
+        return max(self.deadline - time.time(), 0)
+
+    def __iter__(self):
+        try:
+            while True:
+                try:
+                    chunk = self.chunks.get(timeout=self.remaining())
+                except Empty:
+                    # timeout, close() will kill command
+                    break
+                if chunk is None:
+                    self.exhausted = True
+                    break
+                yield chunk
+        finally:
+            self.close()
+
+    def close(self):
+        """Wait for command termination and set status and sumerr attributes.
+
+        Command is killed if stream wasn't read to the end.
+
+        """
+        if self.status is not None:
+            return
+        # out_loop of not exhausted stream is blocked on full queue
+        timeout = self.remaining() if self.exhausted else 0
+        self.status = wait_command(self.p, self.threads, self.gin, timeout, self.group)
+        self.sumerr = (self.gerr.value or '') if self.gerr is not None else ''
+
+
+def file_sink(out_file):
+    """Return function that writes chunks of output to file.
+
+    Args:
+      out_file (file object or int): file object or file descriptor
+
+    Return:
+      function: function(chunk)
+
+    """
+    if not isinstance(out_file, (int, long)):
+        return out_file.write
+    def write(chunk):
+        while chunk:
+            chunk = chunk[os.write(out_file, chunk):]
+    return write
+
+
+def wait_command(p, threads, gin=None, timeout=None, group=False):
+    """Wait for command output loops, kill command after timeout and reap it.
+
+    Args:
+      p (Popen object): executing command
+      threads (list): in_loop and out_loop greenlets of command
+      gin (greenlet object): in_loop greenlet, it waits for stdin forever, so it is killed, not joined
+      timeout (int or float): seconds before killing of command, default is None that means forever
+      group (bool): kill all process group of command if True, default is False
+
+    Return:
+      int: return code of command, TIMEOUT_STATUS if command was killed by timeout
+
+    """
+    logger = envs.connect.logger
+    try:
+        loops = [t for t in threads if t is not gin]
+        finished = gevent.joinall(loops, timeout=timeout)
+        if len(finished) < len(loops):
+            logger.error('command was killed after %s seconds timeout', timeout)
+            kill_process(p, group)
+            # out_loop returns already read output after killing
+            gevent.killall(loops)
+            return TIMEOUT_STATUS
+        logger.debug('child process has terminated with status %s', p.returncode)
+        #TODO: check returncode if returncode==None
+        return p.returncode
+    finally:
+        # reap command and its loops even if waiting was interrupted
+        reap_command(p, threads, group)
+
+
+def reap_command(p, threads, group=False):
+    """Kill command if it is still running and kill its loops.
+
+    Args:
+      p (Popen object): executing command
+      threads (list): in_loop and out_loop greenlets of command
+      group (bool): kill all process group of command if True, default is False
+
+    """
+    if p.poll() is None:
+        kill_process(p, group)
+    gevent.killall([t for t in threads if not t.ready()])
+
+
+def kill_process(p, group=False):
+    """Kill command and wait for its termination.
+
+    SIGTERM is sent first, SIGKILL after one second.
+
+    Args:
+      p (Popen object): executing command
+      group (bool): kill all process group of command if True, default is False
+
+    """
+    logger = envs.connect.logger
+    logger.debug('killing process %s', p.pid)
+    for sig in (SIGTERM, SIGKILL):
+        try:
+            if group:
+                os.killpg(p.pid, sig)
+            elif sig == SIGTERM:
+                p.terminate()
+            else:
+                p.kill()
+        except OSError:
+            # already terminated
+            pass
+        if p.wait(timeout=1) is not None:
+            break
+    p.wait()
+
+
+def ssh_command(command=None, tty=True):
+    """Build ssh command line for current envs.connect.
+
+    Multiplexing options from envs.connect.control_args are added,
+    so all commands for one connect go through one ssh ControlMaster socket.
+
+    Args:
+      command (str): command for executing on host, default is None
+      tty (bool): keep -t options of envs.common.ssh_args, default is True,
+        binary streams like tar archives must be transferred without tty
+
+    Return:
+      list: ssh command with arguments
+
+    """
+    scommand = [
+        envs.common.ssh_binary,
+        envs.common.ssh_port_option,
+        str(envs.connect.port),
+        ''.join((envs.connect.user, '@', envs.connect.host)),
+    ]
+    ssh_args = envs.common.ssh_args.split()
+    if not tty:
+        # -t, -tt, ...
+        ssh_args = [a for a in ssh_args if a.strip('t') != '-']
+    scommand += ssh_args
+    scommand += envs.connect.con_args.split()
+    scommand += getattr(envs.connect, 'control_args', [])
+    if command is not None:
+        scommand.append(command)
+    return scommand
+
+
+def control_master_args():
+    """Return ssh options for ControlMaster socket of current envs.connect.
+
+    Socket is opened by the first ssh command for this connect
+    and closed by ssh after envs.common.ssh_control_persist seconds of idle
+    or by close_control_masters() function.
+
+    Return:
+      list: ssh options, empty if multiplexing is disabled or can't be used
+
+    """
+    logger = envs.connect.logger
+    if not envs.common.ssh_multiplexing or os.name == 'nt':
+        return []
+    control_path = envs.common.ssh_control_path or os.path.join(
+        envs.common.home_directory, 'sockets', '%C'
+    )
+    directory = os.path.dirname(control_path)
+    if directory and not os.path.isdir(directory):
+        try:
+            os.makedirs(directory, 0700)
+        except OSError:
+            logger.warning("can't create directory %s for ssh sockets", directory, exc_info=True)
+            return []
+    return [
+        '-o', 'ControlMaster=auto',
+        '-o', 'ControlPath=%s' % control_path,
+        '-o', 'ControlPersist=%s' % envs.common.ssh_control_persist,
+    ]
+
+
+def close_control_masters():
+    """Close ssh ControlMaster sockets of all connects from state.connects."""
+    from context_managers import connects
+    logging.debug('executing close_control_masters function')
+    processes = []
+    with open(os.devnull, 'w') as devnull:
+        for connect in connects.values():
+            control_args = connect.get('control_args')
+            if not control_args:
+                continue
+            scommand = [
+                envs.common.ssh_binary,
+                envs.common.ssh_port_option,
+                str(connect['port']),
+            ]
+            scommand += control_args
+            scommand += ['-O', 'exit', ''.join((connect['user'], '@', connect['host']))]
+            logging.debug('executing command %s', scommand)
+            processes.append(Popen(scommand, stdout=devnull, stderr=devnull, stdin=devnull))
+        for p in processes:
+            p.wait()
+
+
 def write_message_to_log(message='', prefix=''):
     """Write message to info log.
 
@@ -151,9 +475,12 @@ def write_message_to_log(message='', prefix=''):
     """
     logger = envs.connect.logger
     try:
-        logger.info('%s%s', prefix, unicode(message, "UTF-8"))
+        message = unicode(message, "UTF-8", "replace")
     except TypeError:
-        logger.info('%s%s', prefix, message)
+        pass
+    # stream and text are used by json lines host logs
+    extra = {'stream': prefix.rstrip(': ') or 'log', 'text': message}
+    logger.info('%s%s', prefix, message, extra=extra)
 
 
 def command_patching_for_sudo(command, use_sudo=False, user='', group=''):
@@ -170,36 +497,45 @@ def command_patching_for_sudo(command, use_sudo=False, user='', group=''):
 
     """
     logger = envs.connect.logger
+    debug = logger.isEnabledFor(logging.DEBUG)
     # run as root
-    logger.debug('case use_sudo')
+    if debug:
+        logger.debug('case use_sudo')
     if use_sudo:
         if not envs.connect.check_is_root:
             if 'sudo' not in command.split():
                 command = " ".join(('sudo -S', command))
-        logger.debug('command: %s', command)
+        if debug:
+            logger.debug('command: %s', command)
     # switching user
-    logger.debug('case user')
+    if debug:
+        logger.debug('case user')
     if user:
         if 'sudo' not in command.split():
             command = " ".join(('sudo -S -u %s -s' % user, command))
         else:
             command.replace('sudo', 'sudo -u %s' % user)
-        logger.debug('command: %s', command)
+        if debug:
+            logger.debug('command: %s', command)
     # switching group
-    logger.debug('case group')
+    if debug:
+        logger.debug('case group')
     if group:
         if 'sudo' not in command.split():
             command = " ".join(('sudo -S -g %s -s' % group, command))
         else:
             command.replace('sudo', 'sudo -g %s' % group)
-        logger.debug('command: %s', command)
+        if debug:
+            logger.debug('command: %s', command)
     return command
 
 
-def out_loop(p, common_env, connect_env, err=False):
+def out_loop(p, common_env, connect_env, err=False, sink=None):
     """Loop for command stdout or stderr.
 
     Check executing command stdout or stderr and put messages to log and sys.stdout.
+    Output is read by chunks of envs.common.read_chunk_size bytes via os.read
+    and split to lines over the buffer, so big outputs don't cost a loop iteration per byte.
 
     Hack for greenlets:
       common_env its copy of envs.common
@@ -209,14 +545,15 @@ def out_loop(p, common_env, connect_env, err=False):
       p (Popen object): executing command
       common_env (AttributedDict class object): global class instance for global options
       connect_env (AttributedDict class object): global class instance for connect environment
+      err (bool): process stderr instead of stdout if True, default is False
+      sink (function): function(chunk) that receives chunks of output instead of accumulating them
 
     Return:
-      str: string that contained all stdout or stderr messages
+      str: string that contained all stdout or stderr messages, empty if sink is used
 
     """
     line = ''
-    char = ' '
-    sumout = ''
+    chunks = []
     win = os.name == 'nt'
     stdout=p.stdout
     prefix='out: '
@@ -226,75 +563,103 @@ def out_loop(p, common_env, connect_env, err=False):
     envs.common = common_env
     envs.connect = connect_env
     logger = envs.connect.logger
-    logger.debug('executing out_loop function')
-    logger.debug('arguments for executing and another locals: %s', locals())
-    while char or p.poll() is None:
-        logger.debug('new iteration of reading stdout')
-        try:
-            # wait_read doesn't work on windows
-            if win:
-                timer = gevent.Timeout.start_new(0.01)
-                char = stdout.read(1)
-                timer.cancel()
-                ready = True
-            else:
-                wait_read(stdout.fileno(), 0.01)
-                char = stdout.read(1)
+    debug = logger.isEnabledFor(logging.DEBUG)
+    if debug:
+        logger.debug('executing out_loop function')
+        logger.debug('arguments for executing and another locals: %s', locals())
+    size = envs.common.read_chunk_size
+    try:
+        fd = stdout.fileno()
+    except AttributeError:
+        if err:
+            logger.error("can't process stderr", exc_info=True)
+        else:
+            logger.error("can't process stdout", exc_info=True)
+        return ''
+    try:
+        while True:
+            # output written before termination will be read by this iteration
+            finished = p.poll() is not None
+            try:
+                # wait_read doesn't work on windows
+                if win:
+                    timer = gevent.Timeout.start_new(0.01)
+                    chunk = stdout.read(1)
+                    timer.cancel()
+                else:
+                    if not finished:
+                        wait_read(fd, 0.01)
+                    chunk = os.read(fd, size)
                 ready = True
-        except (gevent.Timeout, timeout):
-            ready = False
-            char = ''
-        except AttributeError:
-            if err:
-                logger.error("can't process stderr", exc_info=True)
-            else:
-                logger.error("can't process stdout", exc_info=True)
-            return ''
-        if ready:
-            if char:
-                sumout += char
-                # remove \n because logger sum it too
-                if char not in ('\n', '\r'):
-                    line += char
-                elif line:
-                    write_message_to_log(line, prefix)
-                    line = ''
+            except (gevent.Timeout, timeout):
+                ready = False
+                chunk = ''
+            except OSError as e:
+                if e.errno not in (EAGAIN, EWOULDBLOCK):
+                    raise
+                ready = False
+                chunk = ''
+            if ready:
+                if chunk:
+                    if sink:
+                        sink(chunk)
+                    else:
+                        chunks.append(chunk)
+                    # remove \n because logger sum it too
+                    lines = newlines.split(line + chunk)
+                    line = lines.pop()
+                    for l in lines:
+                        if l:
+                            write_message_to_log(l, prefix)
+                else:
+                    if line:
+                        write_message_to_log(line, prefix)
+                        line = ''
+                    if p.poll() is None:
+                        # end of file, but process is still alive
+                        gevent.sleep(0.01)
             else:
                 if line:
-                    write_message_to_log(line, prefix)
-                    line = ''
-        else:
-            if line:
-                # passwords
-                for e in ('[sudo]', 'password', 'Password'):
-                    if e in line and envs.common.ask_passwd:
-                        p.stdin.write(
-                            getpass(
-                                '{}{}{} {}{}\n'.format(
-                                envs.connect.user,
-                                envs.common.split_user,
-                                envs.connect.host,
-                                prefix,
-                                line
+                    # passwords
+                    for e in ('[sudo]', 'password', 'Password'):
+                        if e in line and envs.common.ask_passwd:
+                            p.stdin.write(
+                                getpass(
+                                    '{}{}{} {}{}\n'.format(
+                                    envs.connect.user,
+                                    envs.common.split_user,
+                                    envs.connect.host,
+                                    prefix,
+                                    line
+                                    )
                                 )
                             )
-                        )
-                        p.stdin.write('\n')
-                        p.stdin.flush()
-                        break
-                else:
-                    write_message_to_log(line, prefix)
-                #TODO: y\n
-                line = ''
-            continue
-    logger.debug('return sumout %s', sumout)
+                            p.stdin.write('\n')
+                            p.stdin.flush()
+                            break
+                    else:
+                        write_message_to_log(line, prefix)
+                    #TODO: y\n
+                    line = ''
+            if finished and not chunk:
+                break
+    except gevent.GreenletExit:
+        # killed by timeout, return already read output
+        if debug:
+            logger.debug('out_loop was killed')
+        if line:
+            write_message_to_log(line, prefix)
+    sumout = ''.join(chunks)
+    if debug:
+        logger.debug('return sumout %s', sumout)
     return sumout
 
 
 def in_loop(p, common_env, connect_env):
     """Loop for command stdin.
 
-    Check global stdin queue and put lines from it to command stdin.
+    Wait for messages in global stdin queue and put them to command stdin.
+    Loop is killed by run() after command termination.
 
     Hack for greenlets:
       common_env its copy of envs.common
@@ -310,32 +675,175 @@ def in_loop(p, common_env, connect_env):
     envs.common = common_env
     envs.connect = connect_env
     logger = envs.connect.logger
-    logger.debug('executing in_loop function')
-    logger.debug('arguments for executing and another locals: %s', locals())
+    debug = logger.isEnabledFor(logging.DEBUG)
+    if debug:
+        logger.debug('executing in_loop function')
+        logger.debug('arguments for executing and another locals: %s', locals())
     while p.poll() is None:
-        logger.debug('new iteration of reading global messaging queue')
+        # sleep without cpu usage until new messages
+        lines = stdin_queue.wait(lin)
+        lin += len(lines)
         try:
-            if stdin_queue.qsize() > lin:
-                queue = stdin_queue.copy()
-                qs = queue.qsize()
-                logger.debug('local queue %s with len %s', queue, qs)
-                for i, l in enumerate(queue):
-                    if i >= lin:
-                        # TODO: crossystem end of line \n \r \nr
-                        logger.debug('flush %s to stdin', l)
-                        write_message_to_log(l.rstrip(), 'in: ')
-                        p.stdin.write(l)
-                        p.stdin.flush()
-                    if queue.qsize() == 0:
-                        break
-                lin = qs
-        except AttributeError:
+            for l in lines:
+                # TODO: crossystem end of line \n \r \nr
+                if debug:
+                    logger.debug('flush %s to stdin', l)
+                write_message_to_log(l.rstrip(), 'in: ')
+                p.stdin.write(l)
+                p.stdin.flush()
+        except (AttributeError, IOError, OSError):
             #logger.warning("can't process global stdin", exc_info=True)
             break
-        gevent.sleep(0)
 
 
-def sudo(command, user='', group='', freturn=False, err_to_out=False, input=None, **kwargs):
+def run_many(commands, use_sudo=False, user='', group='', err_to_out=False, force=False, timeout=None, **kwargs):
+    """Execute commands one by one in one shell session on host.
+
+    One envs.common.default_shell process (via one ssh connection for host)
+    reads all commands from stdin, so each command doesn't pay for own process and ssh channel.
+    Output of commands is separated by sentinel lines with random token
+    and exit status of each command.
+    Each command is executed in subshell, so exit or cd don't affect next commands.
+    Commands can't read stdin, their output is written to log line by line while session works.
+    After timeout commands that have been finished keep their output and status,
+    the rest get TIMEOUT_STATUS.
+
+    Args:
+      commands (list): commands for executing
+      use_sudo (bool): running each command with sudo prefix if True and current user not root, default is False
+      user (str): username for sudo -u prefix
+      group (str): group for sudo -g prefix
+      err_to_out (bool): redirect stderr to stdout if True, default is False
+      force (bool): executing full operations even if envs.common.dry_run is True
+      timeout (int or float): seconds before killing of session, default is envs.common.command_timeout
+      **kwargs (dict): add only for supporting dry-run replacing
+
+    Return:
+      list: tuple for each command like run with freturn=True returns:
+        string that contained all stdout messages
+        string that contained all stderr
+        int that mean return code of command, TIMEOUT_STATUS if command was killed by timeout
+
+    """
+    # hack for dry-run
+    if envs.common.dry_run and not force:
+        run = load_runtime_operation('run')
+        return [run(c, use_sudo, user, group, True, err_to_out, timeout=timeout, **kwargs) for c in commands]
+
+    logger = envs.connect.logger
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug('executing run_many function')
+        logger.debug('arguments for executing and another locals: %s', locals())
+    commands = [command_patching_for_sudo(c, use_sudo, user, group) for c in commands]
+    token = 'factory-' + os.urandom(16).encode('hex')
+    script = []
+    for i, command in enumerate(commands):
+        # subshell like separate run, commands must not read script from stdin of shell
+        script.append('( %s\n) < /dev/null%s' % (command, ' 2>&1' if err_to_out else ''))
+        script.append("__status=$?; printf '%s:%d:%%d\\n' $__status; printf '%s:%d:\\n' >&2" % (
+            token, i, token, i
+        ))
+    script = '\n'.join(script) + '\n'
+
+    if timeout is None:
+        timeout = envs.common.command_timeout
+    new_pgrp = os.name != 'nt' and bool(timeout or envs.common.host_timeout)
+    preexec_fn = os.setpgrp if new_pgrp else None
+    if envs.connect.host in envs.common.localhost:
+        scommand = split(envs.common.default_shell)
+    else:
+        scommand = ssh_command(envs.common.default_shell, tty=False)
+    write_message_to_log('%s commands in one session' % len(commands), 'in: ')
+    p = Popen(scommand, stdout=PIPE, stderr=PIPE, stdin=PIPE, preexec_fn=preexec_fn)
+    outs = [[] for c in commands]
+    errs = [[] for c in commands]
+    codes = [None] * len(commands)
+
+    def feed():
+        p.stdin.write(script)
+        p.stdin.close()
+
+    def read(stream, chunks, err, common_env, connect_env):
+        envs.common = common_env
+        envs.connect = connect_env
+        marker = token + ':'
+        i = 0
+        if not err:
+            write_message_to_log(commands[0], 'in: ')
+        for line in iter(stream.readline, ''):
+            pos = line.find(marker)
+            text = line if pos == -1 else line[:pos]
+            if text and i < len(commands):
+                chunks[i].append(text)
+                write_output_to_log(*(('', text) if err else (text,)))
+            if pos == -1:
+                continue
+            # sentinel line: token:index:status
+            index, code = line[pos + len(marker):].rstrip('\r\n').split(':', 1)
+            i = int(index) + 1
+            if not err:
+                codes[i - 1] = int(code)
+                if i < len(commands):
+                    write_message_to_log(commands[i], 'in: ')
+
+    gin = gevent.spawn(feed)
+    threads = [gin]
+    for stream, chunks, err in ((p.stdout, outs, False), (p.stderr, errs, True)):
+        threads.append(gevent.spawn(read, stream, chunks, err, copy(envs.common), copy(envs.connect)))
+    status = wait_command(p, threads, gin, timeout or None, new_pgrp)
+    if status is None:
+        status = p.wait()
+
+    results = []
+    for out, err, code in zip(outs, errs, codes):
+        out, err = ''.join(out), ''.join(err)
+        if code is None:
+            # session has been finished or killed before the end of this command
+            code = status
+        if not force:
+            collector.add(out, err, code)
+        results.append((out, err, code))
+    return results
+
+
+def agent_run(agent, command, input=None, timeout=None, err_to_out=False):
+    """Execute command via agent and write its output to log.
+
+    Args:
+      agent (Agent class object): agent of envs.connect
+      command (str): command for executing
+      input (str or tuple of str): str will be flushed to stdin of command, default is None
+      timeout (int or float): seconds before killing of command, default is None that means forever
+      err_to_out (bool): redirect stderr to stdout if True, default is False
+
+    Return:
+      tuple: sumout, sumerr, status like run with freturn=True
+
+    """
+    if type(input) is str:
+        input = [input]
+    data = ''
+    for s in input or ():
+        s = str(s)
+        if s[-1] not in ('\n', '\r'):
+            s += '\n'
+        data += s
+    sumout, sumerr, status = agent.run(command, data, timeout, err_to_out)
+    if status == TIMEOUT_STATUS and timeout:
+        envs.connect.logger.error('command was killed after %s seconds timeout', timeout)
+    write_output_to_log(sumout, sumerr)
+    return sumout, sumerr, status
+
+
+def write_output_to_log(sumout, sumerr=''):
+    """Write already collected stdout and stderr of command to log line by line."""
+    for prefix, text in (('out: ', sumout), ('err: ', sumerr)):
+        for line in newlines.split(text):
+            if line:
+                write_message_to_log(line, prefix)
+
+
+def sudo(command, user='', group='', freturn=False, err_to_out=False, input=None, timeout=None, **kwargs):
     """sudo is alias for run(use_sudo=True).
 
     Args:
@@ -345,6 +853,7 @@ def sudo(command, user='', group='', freturn=False, err_to_out=False, input=None
       freturn (bool): return tuple if True, else return str, default is False
       err_to_out (bool): redirect stderr to stdout if True, default is False
       input (str): str will be flushed to stdin after executed command, default is None
+      timeout (int or float): seconds before killing of command, default is envs.common.command_timeout
       **kwargs (dict): add only for supporting dry-run replacing
 
     Return:
@@ -352,18 +861,19 @@ def sudo(command, user='', group='', freturn=False, err_to_out=False, input=None
       tuple if freturn is True:
         string that contained all stdout messages
         string that contained all stderr
-        int that mean return code of command
+        int that mean return code of command, TIMEOUT_STATUS if command was killed by timeout
 
     """
     run = load_runtime_operation('run')
 
     logger = envs.connect.logger
-    logger.debug('executing sudo function')
-    logger.debug('arguments for executing and another locals: %s', locals())
-    return run(command, use_sudo=True, user=user, group=group, freturn=freturn, err_to_out=err_to_out, input=input, **kwargs)
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug('executing sudo function')
+        logger.debug('arguments for executing and another locals: %s', locals())
+    return run(command, use_sudo=True, user=user, group=group, freturn=freturn, err_to_out=err_to_out, input=input, timeout=timeout, **kwargs)
 
 
-def local(command, use_sudo=False, user='', group='', freturn=False, err_to_out=False, input=None, **kwargs):
+def local(command, use_sudo=False, user='', group='', freturn=False, err_to_out=False, input=None, timeout=None, **kwargs):
     """Execute command on localhost using current implementation of run function.
 
     Args:
@@ -374,6 +884,7 @@ def local(command, use_sudo=False, user='', group='', freturn=False, err_to_out=
       freturn (bool): return tuple if True, else return str, default is False
       err_to_out (bool): redirect stderr to stdout if True, default is False
       input (str): str will be flushed to stdin after executed command, default is None
+      timeout (int or float): seconds before killing of command, default is envs.common.command_timeout
       **kwargs (dict): add only for supporting dry-run replacing
 
     Return:
@@ -381,16 +892,17 @@ def local(command, use_sudo=False, user='', group='', freturn=False, err_to_out=
       tuple if freturn is True:
         string that contained all stdout messages
         string that contained all stderr
-        int that mean return code of command
+        int that mean return code of command, TIMEOUT_STATUS if command was killed by timeout
 
     """
     run = load_runtime_operation('run')
 
     logger = envs.connect.logger
-    logger.debug('executing local function')
-    logger.debug('arguments for executing and another locals: %s', locals())
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug('executing local function')
+        logger.debug('arguments for executing and another locals: %s', locals())
     with set_connect_env('localhost', envs.connect.con_args):
-        return run(command, use_sudo=use_sudo, user=user, group=group, freturn=freturn, err_to_out=err_to_out, input=input, **kwargs)
+        return run(command, use_sudo=use_sudo, user=user, group=group, freturn=freturn, err_to_out=err_to_out, input=input, timeout=timeout, **kwargs)
 
 
 def check_is_root():
@@ -401,8 +913,9 @@ def check_is_root():
 
     """
     logger = envs.connect.logger
-    logger.debug('executing check_is_root function')
-    logger.debug('arguments for executing and another locals: %s', locals())
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug('executing check_is_root function')
+        logger.debug('arguments for executing and another locals: %s', locals())
     out, err, status = run('id -u', freturn=True, force=True)
     logger.debug('out %s, err %s, status %s', out, err, status)
     if not status:
@@ -413,36 +926,82 @@ def check_is_root():
     return False
 
 
-def push(src, dst='~/', pull=False, **kwargs):
+def gather_facts():
+    """Get cheap host facts via one command.
+
+    Each fact is printed as name=value, so host without one of commands
+    still reports the others.
+
+    Return:
+      dict: {'uid': int, 'uname': str, 'hostname': str}, None if uid is unknown
+
+    """
+    logger = envs.connect.logger
+    logger.debug('executing gather_facts function')
+    out, err, status = run('echo uid=$(id -u); echo uname=$(uname -s); echo hostname=$(uname -n)',
+                           freturn=True, force=True)
+    logger.debug('out %s, err %s, status %s', out, err, status)
+    facts = {}
+    for line in out.splitlines():
+        name, sep, value = line.strip().partition('=')
+        if sep and value and name in ('uid', 'uname', 'hostname'):
+            facts[name] = value
+    try:
+        facts['uid'] = int(facts['uid'])
+    except (KeyError, ValueError):
+        return None
+    return facts
+
+def push(src, dst='~/', pull=False, fanout=None, sync=False, delete=False, tar=None, cache=None, **kwargs):
     """Copying file or directory.
 
     Copy local file or directory to another host or another localhost place.
     Uses shutil.copy2 and shutil.copytree on localhost and scp (by default)
     with -r option.
+    With fanout hosts receive src from each other, see distribute.
+    With sync only changed files of directory are copied, see sync_directories.
+    With tar directories are transferred as one tar stream, see tar_transfer.
+    With cache push is skipped if host already has the same content, see cached_push.
 
     Args:
       src (str): local file or directory
       dst (str): destination path, default is '~/'
       pull (bool): copy file from another host to localhost if True, default is False
+      fanout (int): number of hosts that receive src from each host,
+        default is envs.common.push_fanout, 0 means push from controller to each host
+      sync (bool): copy only new and changed files of src directory, default is False
+      delete (bool): remove files of dst that are not in src if sync is True, default is False
+      tar (bool): transfer directories as one compressed tar stream instead of scp -r,
+        default is envs.common.push_tar
+      cache (bool): skip push if host already has the same content, default is envs.common.upload_cache
       **kwargs (dict): add only for supporting dry-run replacing
 
     Return:
       int that mean return code of command:
         exception? 0 : errno on localhost
         status of subprocess with scp
+        UNCHANGED (equal to 0) if push was skipped
 
     """
     # hack for dry-run
     if envs.common.dry_run:
         from dry_operations import push
-        return push(src, dst, pull, **kwargs)
+        return push(src, dst, pull, cache=cache, **kwargs)
+
+    if cache is None:
+        cache = envs.common.upload_cache
+    if cache and not pull and not sync:
+        return cached_push(src, dst, fanout=fanout, tar=tar, **kwargs)
 
     logger = envs.connect.logger
     host_string = ''.join((envs.connect.user,
                            '@',
                            envs.connect.host))
-    logger.debug('executing push function')
-    logger.debug('arguments for executing and another locals: %s', locals())
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug('executing push function')
+        logger.debug('arguments for executing and another locals: %s', locals())
+    if sync:
+        return sync_directories(src, dst, pull, delete, **kwargs)
     if envs.connect.host in envs.common.localhost:
         logger.debug('used shutil.copy*')
         if os.path.exists(src):
@@ -469,20 +1028,33 @@ def push(src, dst='~/', pull=False, **kwargs):
             logger.error("%s path does not exists", src)
             return 2 # errno.ENOENT
     else:
+        if fanout is None:
+            fanout = envs.common.push_fanout
+        if fanout and not pull:
+            return distribute(src, dst, fanout, **kwargs)
+        if tar is None:
+            tar = envs.common.push_tar
+        if tar:
+            manifest = remote_manifest(src) if pull else local_manifest(src)
+            if manifest is not None:
+                logger.debug('used tar stream')
+                return tar_transfer(src, dst, manifest, pull, nest=True)
+            logger.debug('%s is not a directory, used scp', src)
         logger.debug('used factory.run')
         if pull:
-            command = '-r' + host_string + ':' + src + ' ' + dst
+            paths = [host_string + ':' + src, dst]
         else:
-            command = '-r' + src + ' ' + host_string + ':' + dst
-        command = ''.join((
+            paths = [src, host_string + ':' + dst]
+        command = [
             envs.common.scp_binary,
             envs.common.scp_port_option,
             str(envs.connect.port),
-            host_string,
             envs.common.scp_args,
             envs.connect.con_args,
-            command
-        ))
+        ]
+        command += getattr(envs.connect, 'control_args', [])
+        command += ['-r'] + paths
+        command = ' '.join([c for c in command if c])
 
         # open new connect
         logger.debug('run command: %s', command)
@@ -491,6 +1063,560 @@ def push(src, dst='~/', pull=False, **kwargs):
         logger.debug('return status: %s', status)
         return status
 
+def cached_push(src, dst, **kwargs):
+    """Push src only if dst on host has another content.
+
+    Sha256 of pushed content is stored in index (see uploads module)
+    by src and dst, if index contains the same hash for them push is skipped.
+    With envs.common.upload_check sha256 sums are checked on host too,
+    so content changed on host is pushed again for one more cheap command.
+
+    Args:
+      src (str): local file or directory
+      dst (str): destination path
+      **kwargs (dict): arguments for push
+
+    Return:
+      int that mean return code of command: UNCHANGED if push was skipped, else status of push
+
+    """
+    from uploads import save_upload
+    logger = envs.connect.logger
+    if not os.path.exists(src):
+        return push(src, dst, cache=False, **kwargs)
+    checksums = local_checksums(src)
+    if is_unchanged(src, dst, checksums):
+        logger.info('%s is unchanged, push is skipped', dst)
+        return UNCHANGED
+    status = push(src, dst, cache=False, **kwargs)
+    if status == 0:
+        save_upload(src, upload_path(src, dst), content_hash(checksums))
+    return status
+
+
+def upload_path(src, dst):
+    """Return normalized dst, basename of src is added if dst ends with '/'."""
+    if dst.endswith('/'):
+        dst = posixpath.join(dst, os.path.basename(src.rstrip('/')))
+    return posixpath.normpath(dst)
+
+
+def is_unchanged(src, dst, checksums):
+    """Check that dst on host has content of src.
+
+    Args:
+      src (str): local file or directory
+      dst (str): destination path, basename of src is added if it ends with '/'
+      checksums (dict): local_checksums of src
+
+    Return:
+      bool: True if index contains the same hash and envs.common.upload_check is False
+        or sha256 sums on host are equal
+
+    """
+    from uploads import load_upload
+    path = upload_path(src, dst)
+    if load_upload(src, path) != content_hash(checksums):
+        return False
+    if not envs.common.upload_check:
+        return True
+    # scp puts src into existing directory
+    return remote_checksums(path, os.path.basename(src.rstrip('/'))) == checksums
+
+
+def content_hash(checksums):
+    """Return one sha256 for local_checksums of file or directory."""
+    sha = hashlib.sha256()
+    for name in sorted(checksums):
+        sha.update('%s %s\n' % (checksums[name], name))
+    return sha.hexdigest()
+
+
+def sync_directories(src, dst, pull=False, delete=False, **kwargs):
+    """Copy only new and changed files from src directory to dst directory.
+
+    Manifests with size and mtime of each file are built on both sides:
+    files with equal size and mtime are unchanged, files with equal size
+    and another mtime are compared by sha256 sums (envs.common.hash_binary on host).
+    Changed files are transferred by tar over ssh, so rsync isn't required on host,
+    tar keeps mtime and next sync of them is cheap.
+    push is used if src is not a directory.
+
+    Args:
+      src (str): directory on source side (localhost for push, host for pull)
+      dst (str): directory on destination side, it will be created if it doesn't exist
+      pull (bool): copy from host to localhost if True, default is False
+      delete (bool): remove files of dst that are not in src, default is False
+      **kwargs (dict): add only for supporting dry-run replacing
+
+    Return:
+      int that mean return code of command: 0 if all files were copied,
+        status of subprocess with tar or rm
+
+    """
+    logger = envs.connect.logger
+    local_host = envs.connect.host in envs.common.localhost
+    # remote side of source and destination
+    src_remote = pull and not local_host
+    dst_remote = not pull and not local_host
+    source = remote_manifest(src) if src_remote else local_manifest(src)
+    if source is None:
+        logger.debug('%s is not a directory, used push', src)
+        return push(src, dst, pull, fanout=0, cache=False, **kwargs)
+    target = (remote_manifest(dst) if dst_remote else local_manifest(dst)) or {}
+
+    changed = []
+    candidates = []
+    for name, (size, mtime) in source.iteritems():
+        if name not in target or target[name][0] != size:
+            changed.append(name)
+        elif target[name][1] != mtime:
+            candidates.append(name)
+    if candidates:
+        src_sums = remote_hashes(src, candidates) if src_remote else local_hashes(src, candidates)
+        dst_sums = remote_hashes(dst, candidates) if dst_remote else local_hashes(dst, candidates)
+        changed += [n for n in candidates if src_sums.get(n) is None or src_sums.get(n) != dst_sums.get(n)]
+    deleted = [n for n in target if n not in source] if delete else []
+    logger.info('sync %s to %s: %s changed, %s deleted, %s unchanged files',
+                src, dst, len(changed), len(deleted), len(source) - len(changed))
+
+    status = 0
+    if local_host:
+        for name in changed:
+            path = os.path.join(dst, name)
+            if not os.path.isdir(os.path.dirname(path)):
+                os.makedirs(os.path.dirname(path))
+            copy2(os.path.join(src, name), path)
+        for name in deleted:
+            os.remove(os.path.join(dst, name))
+        return status
+    for names in batches(sorted(changed)):
+        status = tar_transfer(src, dst, source, pull, names)
+        if status != 0:
+            return status
+    for names in batches(sorted(deleted)):
+        files = ' '.join(quote(n) for n in names)
+        if pull:
+            for name in names:
+                os.remove(os.path.join(dst, name))
+        else:
+            command = 'cd {0} && rm -f -- {1}'.format(remote_path(dst), files)
+            sumout, sumerr, status = run(command, freturn=True)
+            if status != 0:
+                return status
+    return status
+
+
+def tar_transfer(src, dst, manifest, pull=False, names=None, nest=False):
+    """Transfer files of directory as one tar stream over one ssh channel.
+
+    Stream is compressed by envs.common.transfer_compression ('gzip' or 'zstd')
+    if it is set, binaries must exist on both sides.
+    Speed in files and bytes (before compression) per second is written to log.
+
+    Args:
+      src (str): directory on source side (localhost for push, host for pull)
+      dst (str): directory on destination side, it will be created if it doesn't exist
+      manifest (dict): local_manifest or remote_manifest of src
+      pull (bool): copy from host to localhost if True, default is False
+      names (list): relative paths of files, default is None that means all directory
+      nest (bool): extract into dst/basename(src) if dst is existing directory like scp -r does,
+        default is False
+
+    Return:
+      int that mean return code of command: status of subprocess with tar pipeline
+
+    """
+    logger = envs.connect.logger
+    compression = envs.common.transfer_compression
+    if compression and compression not in compressors:
+        logger.warning('unknown transfer_compression %s, stream will not be compressed', compression)
+    compress, decompress = compressors.get(compression, ('', ''))
+    files = ' '.join(quote(n) for n in names) if names else '.'
+    pack = 'tar cf - -C {0} -- {1}'
+    unpack = 'tar xf - -C {0}'
+    if pull:
+        if nest and os.path.isdir(dst):
+            dst = os.path.join(dst, os.path.basename(src.rstrip('/')))
+        if not os.path.isdir(dst):
+            os.makedirs(dst)
+        remote = pipeline((pack.format(remote_path(src), files), compress))
+        command = pipeline((
+            ' '.join(ssh_command(quote(remote), tty=False)),
+            decompress,
+            unpack.format(quote(dst))
+        ))
+    else:
+        if nest:
+            target = 't={0}; [ -d "$t" ] && t="$t"/{1}; '.format(
+                remote_path(dst), quote(os.path.basename(src.rstrip('/')))
+            )
+        else:
+            target = 't={0}; '.format(remote_path(dst))
+        remote = target + 'mkdir -p "$t" || exit 1; ' + pipeline((decompress, unpack.format('"$t"')))
+        command = pipeline((
+            pack.format(quote(src), files),
+            compress,
+            ' '.join(ssh_command(quote(remote), tty=False))
+        ))
+    start = time.time()
+    sumout, sumerr, status = local(command, freturn=True)
+    elapsed = max(time.time() - start, 0.001)
+    if status == 0:
+        count = len(names) if names else len(manifest)
+        size = sum(manifest[n][0] for n in (names or manifest) if n in manifest)
+        logger.info('transferred %s files, %s bytes in %.3f seconds: %.1f files/s, %.2f MB/s',
+                    count, size, elapsed, count / elapsed, size / elapsed / 1024 / 1024)
+    return status
+
+
+def pipeline(commands):
+    """Join commands by pipes, status is status of the first failed command like with pipefail.
+
+    sh has no pipefail (dash for example), so statuses of all commands
+    except the last one are written into temporary file.
+
+    Args:
+      commands (iterable): shell commands, empty ones are skipped
+
+    Return:
+      str: shell command
+
+    """
+    commands = [c for c in commands if c]
+    if len(commands) < 2:
+        return ''.join(commands)
+    head = ' | '.join('{ %s || echo $? >> "$f"; }' % c for c in commands[:-1])
+    return 'f=$(mktemp) || exit 1; %s | %s; s=$?; e=$(head -n 1 "$f"); rm -f "$f"; exit ${e:-$s}' % (
+        head, commands[-1]
+    )
+
+
+def batches(names, size=500):
+    """Split list of file names to lists that fit to command line."""
+    return [names[i:i + size] for i in range(0, len(names), size)]
+
+
+def remote_path(path):
+    """Quote path for shell on host, leading ~/ is expanded by host shell."""
+    if path == '~':
+        return '"$HOME"'
+    if path.startswith('~/'):
+        return '"$HOME"/' + quote(path[2:])
+    return quote(path)
+
+
+def local_manifest(path):
+    """Return size and mtime of each file of local directory.
+
+    Args:
+      path (str): local directory
+
+    Return:
+      dict: {'relative/path': (size, mtime)}, None if path is not a directory
+
+    """
+    if not os.path.isdir(path):
+        return None
+    manifest = {}
+    for root, dirs, names in os.walk(path):
+        for name in names:
+            full = os.path.join(root, name)
+            stat = os.stat(full)
+            manifest[os.path.relpath(full, path).replace(os.sep, '/')] = (stat.st_size, int(stat.st_mtime))
+    return manifest
+
+
+def remote_manifest(path):
+    """Return size and mtime of each file of directory on host.
+
+    Command is executed even if envs.common.dry_run is True.
+
+    Args:
+      path (str): directory on host
+
+    Return:
+      dict: like local_manifest, None if path is not a directory
+
+    """
+    command = '[ -d {0} ] && cd {0} && find . -type f -exec stat -c "%s %Y %n" {{}} +'.format(remote_path(path))
+    with hide('stdout'):
+        sumout, sumerr, status = run(command, freturn=True, force=True)
+    if status != 0:
+        return None
+    manifest = {}
+    for line in sumout.splitlines():
+        if line.strip():
+            size, mtime, name = line.split(' ', 2)
+            manifest[name[2:]] = (int(size), int(mtime))
+    return manifest
+
+
+def local_hashes(path, names):
+    """Return sha256 sums of files of local directory.
+
+    Args:
+      path (str): local directory
+      names (list): relative paths of files
+
+    Return:
+      dict: {'relative/path': sha256}
+
+    """
+    sums = {}
+    for name in names:
+        sums[name] = local_checksums(os.path.join(path, name))['.']
+    return sums
+
+
+def remote_hashes(path, names):
+    """Return sha256 sums of files of directory on host.
+
+    Command is executed even if envs.common.dry_run is True.
+
+    Args:
+      path (str): directory on host
+      names (list): relative paths of files
+
+    Return:
+      dict: {'relative/path': sha256}, files that can't be read are missed
+
+    """
+    sums = {}
+    for part in batches(names):
+        command = 'cd {0} && {1} -- {2}'.format(
+            remote_path(path),
+            envs.common.hash_binary,
+            ' '.join(quote(n) for n in part)
+        )
+        with hide('stdout'):
+            sumout, sumerr, status = run(command, freturn=True, force=True)
+        for line in sumout.splitlines():
+            if line.strip():
+                sha, name = line.split(None, 1)
+                sums[name.lstrip('*')] = sha
+    return sums
+
+
+def distribute(src, dst, fanout, **kwargs):
+    """Copy file or directory to host from another host of envs.common.hosts.
+
+    Hosts form a tree by their order in envs.common.hosts:
+    first fanout hosts receive src from controller and each host
+    forwards it to next fanout hosts, so fanout=1 is a pipeline.
+    Controller uploads src only to seed hosts, the rest is copied
+    between hosts via scp with envs.common.push_hop_args,
+    so parent hosts must be able to ssh to children (agent forwarding for example).
+    Sha256 sums are checked on each host, host receives src from controller
+    if its parent has failed or checking has failed.
+
+    Args:
+      src (str): local file or directory
+      dst (str): full destination path, basename of src is added if it ends with '/'
+      fanout (int): number of hosts that receive src from each host
+      **kwargs (dict): add only for supporting dry-run replacing
+
+    Return:
+      int that mean return code of command: status of subprocess with scp,
+        1 if sha256 sums are not equal
+
+    """
+    logger = envs.connect.logger
+    cs = envs.connect.connect_string
+    hosts = envs.common.hosts
+    if cs not in hosts:
+        logger.debug('%s is not in envs.common.hosts, push from controller', cs)
+        return push(src, dst, fanout=0, cache=False, **kwargs)
+    if dst.endswith('/'):
+        dst = posixpath.join(dst, os.path.basename(src.rstrip('/')))
+    # src can be rendered for each host, hosts with another content form another tree
+    checksums = local_checksums(src)
+    key = (src, dst, content_hash(checksums))
+    distribution = distributions.setdefault(key, {'checksums': checksums, 'hosts': {}})
+    results = distribution['hosts']
+    result = results.setdefault(cs, AsyncResult())
+    status = None
+    try:
+        index = hosts.index(cs)
+        if index >= fanout:
+            parent = hosts[index // fanout - 1]
+            parent_result = results.setdefault(parent, AsyncResult())
+            if parent in released and not parent_result.ready():
+                # parent has finished its tasks without this push
+                parent_result.set(False)
+            logger.debug('waiting for %s on %s', dst, parent)
+            if parent_result.get():
+                status = forward(parent, dst)
+                if status == 0 and not check_checksums(dst, distribution['checksums']):
+                    status = 1
+            if status != 0:
+                logger.warning("can't receive %s from %s, push from controller", dst, parent)
+        if status != 0:
+            status = push(src, dst, fanout=0, cache=False, **kwargs)
+            if status == 0 and not check_checksums(dst, distribution['checksums']):
+                status = 1
+    finally:
+        # children of this host are waiting for result
+        result.set(status == 0)
+    return status
+
+
+def forward(parent, path):
+    """Copy path from parent host to current host via scp on parent.
+
+    Args:
+      parent (str): connect string of host with path
+      path (str): file or directory on parent host
+
+    Return:
+      int that mean return code of command: status of subprocess with scp
+
+    """
+    # target path is expanded by shell on parent and then by shell on current host
+    if path.startswith('~/'):
+        remote = '~/' + quote(path[2:])
+    else:
+        remote = quote(path)
+    target = quote(''.join((envs.connect.user, '@', envs.connect.host, ':', remote)))
+    command = [
+        envs.common.scp_binary,
+        envs.common.scp_port_option,
+        str(envs.connect.port),
+        envs.common.push_hop_args,
+        '-r', remote_path(path), target
+    ]
+    command = ' '.join([c for c in command if c])
+    with set_connect_env(parent):
+        sumout, sumerr, status = run(command, freturn=True)
+    return status
+
+
+def release_distributions(connect_string):
+    """Mark host as finished, its children will not wait for it anymore.
+
+    Args:
+      connect_string (str): [user@]host[:port] from envs.common.hosts
+
+    """
+    released.add(connect_string)
+    for distribution in distributions.itervalues():
+        result = distribution['hosts'].get(connect_string)
+        if result is not None and not result.ready():
+            result.set(False)
+
+
+def reset_transfers():
+    """Forget distributions and local sha256 sums of previous run."""
+    distributions.clear()
+    released.clear()
+    file_checksums.clear()
+
+
+def reset_distributions(connect_string):
+    """Forget results of previous pushes to host before new tasks.
+
+    Args:
+      connect_string (str): [user@]host[:port] from envs.common.hosts
+
+    """
+    released.discard(connect_string)
+    for distribution in distributions.itervalues():
+        result = distribution['hosts'].get(connect_string)
+        if result is not None and result.ready():
+            del distribution['hosts'][connect_string]
+
+
+def local_checksums(path):
+    """Return sha256 sums of local file or all files of directory.
+
+    Sums are reused for files with the same mtime and size during one run.
+
+    Args:
+      path (str): local file or directory
+
+    Return:
+      dict: {'./relative/path': sha256} for directory, {'.': sha256} for file
+
+    """
+    files = []
+    if os.path.isdir(path):
+        for root, dirs, names in os.walk(path):
+            for name in names:
+                full = os.path.join(root, name)
+                files.append(('./' + os.path.relpath(full, path).replace(os.sep, '/'), full))
+    else:
+        files.append(('.', path))
+    checksums = {}
+    for name, full in files:
+        st = os.stat(full)
+        stamp = (st.st_mtime, st.st_size)
+        cached = file_checksums.get(full)
+        if cached is not None and cached[0] == stamp:
+            checksums[name] = cached[1]
+            continue
+        sha = hashlib.sha256()
+        with open(full, 'rb') as f:
+            for block in iter(lambda: f.read(envs.common.read_chunk_size), ''):
+                sha.update(block)
+            # don't block another greenlets on big files
+            gevent.sleep(0)
+        checksums[name] = sha.hexdigest()
+        file_checksums[full] = (stamp, checksums[name])
+    return checksums
+
+
+def remote_checksums(path, name=None):
+    """Return sha256 sums of file or all files of directory on host.
+
+    Command is executed even if envs.common.dry_run is True.
+
+    Args:
+      path (str): file or directory on host
+      name (str): sums of path/name are returned if path is directory,
+        like scp -r puts files into existing directory, default is None
+
+    Return:
+      dict: like local_checksums, None if command has failed
+
+    """
+    command = 'p={0}; '.format(remote_path(path))
+    if name:
+        command += '[ -d "$p" ] && p="$p"/{0}; '.format(quote(name))
+    command += '[ -d "$p" ] && cd "$p" && find . -type f -exec {0} {{}} + || {0} "$p"'.format(
+        envs.common.hash_binary
+    )
+    with hide('stdout'):
+        sumout, sumerr, status = run(command, freturn=True, force=True)
+    if status != 0:
+        return None
+    checksums = {}
+    for line in sumout.splitlines():
+        if line.strip():
+            sha, name = line.split(None, 1)
+            name = name.lstrip('*')
+            checksums[name if name.startswith('./') else '.'] = sha
+    return checksums
+
+
+def check_checksums(path, checksums):
+    """Compare sha256 sums of path on host with expected.
+
+    Args:
+      path (str): file or directory on host
+      checksums (dict): expected sums from local_checksums
+
+    Return:
+      bool: True if sums are equal
+
+    """
+    logger = envs.connect.logger
+    if remote_checksums(path) != checksums:
+        logger.error('sha256 sums of %s are not equal to local ones', path)
+        return False
+    logger.debug('sha256 sums of %s are ok', path)
+    return True
+
+
 def pull(src, dst='.', **kwargs):
     """Alias for push(pull=False).
 
@@ -508,16 +1634,18 @@ def pull(src, dst='.', **kwargs):
     push = load_runtime_operation('push')
 
     logger = envs.connect.logger
-    logger.debug('executing pull function')
-    logger.debug('arguments for executing and another locals: %s', locals())
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug('executing pull function')
+        logger.debug('arguments for executing and another locals: %s', locals())
     return push(src, dst, True, **kwargs)
 
 
 def get(src, dst='.', **kwargs):
     """Alias for pull()"""
     logger = envs.connect.logger
-    logger.debug('executing get function')
-    logger.debug('arguments for executing and another locals: %s', locals())
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug('executing get function')
+        logger.debug('arguments for executing and another locals: %s', locals())
     return pull(src, dst, **kwargs)
 
 
@@ -526,12 +1654,13 @@ def put(src, dst='~/', **kwargs):
     push = load_runtime_operation('push')
 
     logger = envs.connect.logger
-    logger.debug('executing put function')
-    logger.debug('arguments for executing and another locals: %s', locals())
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug('executing put function')
+        logger.debug('arguments for executing and another locals: %s', locals())
     return push(src, dst, **kwargs)
 
 
-def run_script(local_file, binary=None, freturn=False, err_to_out=False, input=None, **kwargs):
+def run_script(local_file, binary=None, freturn=False, err_to_out=False, input=None, timeout=None, **kwargs):
     """Excecute script using current implementation of run function.
 
     Execute "binary < local_file" on localhost or via ssh.
@@ -543,6 +1672,7 @@ def run_script(local_file, binary=None, freturn=False, err_to_out=False, input=N
       freturn (bool): return tuple if True, else return str, default is False
       err_to_out (bool): redirect stderr to stdout if True, default is False
       input (str): str will be flushed to stdin after executed command, default is None
+      timeout (int or float): seconds before killing of command, default is envs.common.command_timeout
       **kwargs (dict): add only for supporting dry-run replacing
 
 
@@ -551,19 +1681,17 @@ def run_script(local_file, binary=None, freturn=False, err_to_out=False, input=N
       tuple if freturn is True:
         string that contained all stdout messages
         string that contained all stderr
-        int that mean return code of command
+        int that mean return code of command, TIMEOUT_STATUS if command was killed by timeout
     """
     # hack for dry-run
     if envs.common.dry_run:
         from dry_operations import run_script
-        return run_script(local_file, binary, freturn, err_to_out, input, **kwargs)
+        return run_script(local_file, binary, freturn, err_to_out, input, timeout=timeout, **kwargs)
 
     logger = envs.connect.logger
-    host_string = ''.join((envs.connect.user,
-                           '@',
-                           envs.connect.host))
-    logger.debug('executing run_script function')
-    logger.debug('arguments for executing and another locals: %s', locals())
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug('executing run_script function')
+        logger.debug('arguments for executing and another locals: %s', locals())
     if not binary:
         logger.debug('trying get binary from script file')
         try:
@@ -583,19 +1711,11 @@ def run_script(local_file, binary=None, freturn=False, err_to_out=False, input=N
     command = binary + " < " + local_file
 
     if not envs.connect.host in envs.common.localhost:
-        command = ''.join((
-            envs.common.ssh_binary,
-            envs.common.ssh_port_option,
-            str(envs.connect.port),
-            host_string,
-            envs.common.ssh_args,
-            envs.connect.con_args,
-            command
-        ))
+        command = ' '.join(ssh_command(binary)) + " < " + local_file
 
     # open new connect
     logger.debug('run command: %s', command)
-    return local(command, freturn=freturn, err_to_out=err_to_out, input=input, **kwargs)
+    return local(command, freturn=freturn, err_to_out=err_to_out, input=input, timeout=timeout, **kwargs)
 
 
 def open_shell(command=None, shell='/bin/bash -i', **kwargs):
@@ -612,8 +1732,9 @@ def open_shell(command=None, shell='/bin/bash -i', **kwargs):
     run = load_runtime_operation('run')
 
     logger = envs.connect.logger
-    logger.debug('executing open_shell function')
-    logger.debug('arguments for executing and another locals: %s', locals())
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug('executing open_shell function')
+        logger.debug('arguments for executing and another locals: %s', locals())
     run(shell, err_to_out=True, input=command, **kwargs)
 
 
@@ -630,5 +1751,5 @@ def load_runtime_operation(fname):
     try:
         fname = envs.common.functions[fname]
     except KeyError:
-        from operations import fname
+        fname = globals()[fname]
     return fname
@@ -0,0 +1,152 @@
+#!/usr/bin/env python
+# coding=utf-8
+"""Collector of command results of all hosts.
+
+With envs.common.aggregate (--aggregate) or envs.common.results_file (--results-file)
+run collects stdout, stderr and status of each command of tasks per host.
+Hosts with identical results are grouped by hash of results,
+so 500 hosts with the same output give one summary instead of 500 copies of it.
+
+"""
+
+# This file is part of https://github.com/Friz-zy/factory
+
+from __future__ import with_statement
+
+import sys
+import json
+import hashlib
+from main import logging, envs
+
+
+class ResultsCollector(object):
+    """Results of commands per host.
+
+    Attributes:
+      hosts (dict): {connect_string: {'sumout': str, 'sumerr': str, 'status': int}}
+      order (list): connect strings in order of start of tasks
+
+    """
+    def __init__(self):
+        self.hosts = {}
+        self.order = []
+
+    @property
+    def enabled(self):
+        return bool(envs.common.aggregate or envs.common.results_file)
+
+    def start(self, connect_string):
+        """Start collecting of results for host.
+
+        Args:
+          connect_string (str): [user@]host[:port] from envs.common.hosts
+
+        """
+        if not self.enabled:
+            return
+        if connect_string not in self.hosts:
+            self.order.append(connect_string)
+        self.hosts[connect_string] = {'sumout': '', 'sumerr': '', 'status': 0}
+
+    def add(self, sumout, sumerr, status):
+        """Add result of command to host whose tasks are executed.
+
+        Host is envs.common.results_host, so output of local commands
+        of its tasks (scp for example) is its output too.
+        Status of host is status of last failed command.
+
+        """
+        host = envs.common.results_host or getattr(envs.connect, 'connect_string', None)
+        result = self.hosts.get(host)
+        if result is None:
+            return
+        result['sumout'] += sumout
+        result['sumerr'] += sumerr
+        if status:
+            result['status'] = status
+
+    def finish(self, connect_string, status=0, error=''):
+        """Set status of host after the end of its tasks.
+
+        Args:
+          connect_string (str): [user@]host[:port] from envs.common.hosts
+          status (int): status of tasks, it replaces status of commands if not zero
+          error (str): message of task exception
+
+        """
+        result = self.hosts.get(connect_string)
+        if result is None:
+            return
+        if status:
+            result['status'] = status
+        if error:
+            result['sumerr'] += error + '\n'
+
+    def groups(self):
+        """Group hosts with identical results.
+
+        Return:
+          list: dicts with hash, hosts, sumout, sumerr and status, the biggest groups first
+
+        """
+        groups = {}
+        for cs in self.order:
+            result = self.hosts[cs]
+            key = hashlib.sha1('\0'.join((
+                result['sumout'], result['sumerr'], str(result['status'])
+            ))).hexdigest()
+            if key not in groups:
+                groups[key] = dict(result, hash=key, hosts=[])
+            groups[key]['hosts'].append(cs)
+        return sorted(groups.values(), key=lambda g: -len(g['hosts']))
+
+    def summary(self, stream=None):
+        """Write one collapsed summary per distinct result.
+
+        Args:
+          stream (file object): default is sys.stdout
+
+        """
+        stream = stream or sys.stdout
+        for group in self.groups():
+            stream.write('%s hosts, status %s: %s\n' % (
+                len(group['hosts']), group['status'], ', '.join(group['hosts'])
+            ))
+            for prefix, text in (('out: ', group['sumout']), ('err: ', group['sumerr'])):
+                for line in text.splitlines():
+                    if line:
+                        stream.write('  %s%s\n' % (prefix, line))
+        stream.flush()
+
+    def write(self, filename):
+        """Write results of all hosts and groups into json file.
+
+        Args:
+          filename (str): path to file
+
+        """
+        data = {
+            'hosts': dict((cs, decode(result)) for cs, result in self.hosts.iteritems()),
+            'groups': [decode(group) for group in self.groups()],
+        }
+        try:
+            with open(filename, 'w') as f:
+                json.dump(data, f, indent=2)
+        except (IOError, OSError, ValueError):
+            logging.error("can't write results into %s", filename, exc_info=True)
+
+    def clean(self):
+        self.hosts = {}
+        self.order = []
+
+
+def decode(result):
+    """Return copy of result with unicode output, bytes that aren't utf-8 are replaced."""
+    result = dict(result)
+    for key in ('sumout', 'sumerr'):
+        if isinstance(result[key], str):
+            result[key] = result[key].decode('utf-8', 'replace')
+    return result
+
+
+collector = ResultsCollector()
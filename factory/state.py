@@ -8,8 +8,21 @@ Attributes:
       interactive (bool): False if --non-interactive given, else True
       show_errors (bool): copy factory warnings and errors into stdout (works with and without interactive mode), default is False
       parallel (bool): True if --parallel given, else False
+      pool_size (int): max number of hosts processed at once in parallel mode, default is 0 that means unlimited
+      batch (str): size of rolling batch of hosts in parallel mode like '10' or '10%', default is '' that means all hosts
+      max_failures (int): don't start new hosts after this number of failed hosts in parallel mode,
+        default is None that means unlimited
+      command_timeout (int or float): seconds before killing of each command, default is None that means unlimited
+      host_timeout (int or float): seconds before killing of all tasks on host, default is None that means unlimited
+        commands are started in own process group if one of timeouts is set,
+        so ssh can't ask passwords from tty
+      aggregate (bool): print one summary per distinct result of hosts instead of output of each host,
+        True if --aggregate given, default is False
+      results_file (str): path to json file with results of all hosts, default is '' that means no file
+      results_host (str): connect string of host whose tasks are executed, results of commands
+        are added to it even if they are executed on localhost like scp, default is None
       ask_passwd (bool): open secure invite shell for passwords, default is False
-      functions (dict): dict with all functions, default is {}
+      functions (TaskRegistry class object): dict with all tasks, default is empty TaskRegistry
       localhost (tuple): tuple with all names and ip of localhost, default is ['localhost', '127.0.0.1', socket.gethostname()]
       split_function (str): splitter between function and args, default is ':'
       split_args (str): splitter between args, default is ','
@@ -22,9 +35,31 @@ Attributes:
       ssh_port (int or str): ssh port for connections, default is '22'
       ssh_port_option (str): ssh port option, default is '-p'
       ssh_args (str): ssh additional arguments, default is '-tt'
+      ssh_multiplexing (bool): share one ssh ControlMaster socket between all commands of connect, default is True
+      ssh_control_path (str): path to ControlMaster socket,
+        default is '' that means join(home_directory, 'sockets', '%C')
+      ssh_control_persist (int): seconds of idle before ControlMaster socket closing, default is 60
+      use_agent (bool): start long-lived python helper on each host and execute commands via it,
+        plain ssh is used if agent can't be started, default is False
+      agent_python (str): python binary on hosts for agent, default is 'python3'
+      agent_timeout (int or float): seconds of waiting for agent start, default is 5
       scp_binary (str): path to scp binary, default is 'scp'
       scp_port_option (str): scp port option, default is '-P'
       scp_args (str): scp additional arguments, default is ''
+      push_fanout (int): number of hosts that receive push from each host (and from controller),
+        default is 0 that means push from controller to each host, see operations.distribute
+      push_hop_args (str): scp arguments for copying between hosts, default is '-o BatchMode=yes'
+      hash_binary (str): binary for checking sha256 sums of files on hosts, default is 'sha256sum'
+      push_tar (bool): transfer directories by push and pull as one tar stream over ssh instead of scp -r,
+        default is False
+      transfer_compression (str): compression of tar streams, 'gzip', 'zstd' or '', default is 'gzip'
+      upload_cache (bool): skip push if host already has the same content, default is True
+      upload_check (bool): check sha256 sums on host before skipping of push, default is True,
+        push is skipped without it if index has the same content even if file on host is changed
+      uploads_file (str): path to index of pushed content, default is '' that means join(home_directory, 'uploads.json')
+      inventory (str or list): paths to inventory files, default is '' that means hosts from envs.common.hosts,
+        see inventory module
+      inventory_script_ttl (int or float): seconds of caching of output of inventory scripts, default is 0
       user (str): username for ssh login, default is current user (via getuser())
       hosts (tuple): tuple with connection strings like user@host:port, default is ['localhost']
       home_directory (str): path to default factory directory,
@@ -35,6 +70,29 @@ Attributes:
       which_binary (str): binary for checking executing binary in dry-run mod, default is 'which',
         for windows 'where.exe' can be used manually
       test_binary (str): binary for checking file or directory existing in dry-run mod, default is 'test -e'
+      read_chunk_size (int): max size of one read from command stdout or stderr, default is 65536
+      log_queue (bool): write logs by one writer greenlet via bounded queue, see log module, default is False
+      log_queue_size (int): max number of records in log queue, default is 10000
+      log_queue_policy (str): 'block' logging greenlet or 'drop' record if log queue is full, default is 'block'
+      log_batch_size (int): max number of records written at once, default is 1000
+      log_flush_interval (int or float): seconds between writes of batches of records, default is 0.05
+      code_cache (bool): cache compiled code of factfiles and fabfiles, see factfiles module, default is True
+      code_cache_dir (str): directory for compiled code, default is '' that means join(home_directory, 'code')
+      lazy_factfiles (bool): don't load factfiles and fabfiles from envs.common.home_directory and current directories
+        if command uses only built-in operations, default is False, so factfiles can override
+        built-in operations and set envs.common on import
+      host_logs_dir (str): directory for json lines log file of each connect string,
+        default is '' that means no host logs, see log.host_log_handler
+      host_logs_only (bool): don't write output of hosts into factory.log if host logs are enabled, default is False
+      host_logs_max_bytes (int): rotate host log after this size, default is 10485760, 0 means no rotation
+      host_logs_when (str): rotate host log by time instead of size, 'S', 'M', 'H', 'D', 'midnight' or 'W0'-'W6',
+        default is ''
+      host_logs_backup_count (int): number of kept rotated host logs, default is 5
+      host_logs_compress (bool): gzip rotated host logs, default is False
+      facts_cache (bool): cache host facts (uid, uname, hostname) between runs, default is True
+      facts_file (str): path to facts cache, default is '' that means join(home_directory, 'facts.json')
+      facts_ttl (int): seconds before cached facts expiration, default is 3600
+      refresh_facts (bool): ignore and rewrite cached facts, True if --refresh-facts given, default is False
 
     connect (AttributedDict class object): global class instance for connect environment
       connect_string (str): [user@]host[:port]
@@ -43,9 +101,14 @@ Attributes:
       port (str): port for connect
       con_args (str): options for ssh
       logger (logging.logger object): logger object for this connect
+      control_args (list): ssh options for ControlMaster socket, empty for localhost
+      agent (Agent class object): long-lived helper on host if envs.common.use_agent is True, else None
+      facts (dict): uid, uname and hostname of host, cached between runs
       check_is_root (bool): True if connected as root, else False
+      vars (dict): variables of host from inventory without host, user and port
 
-  stdin_queue (gevent queue object): global queue for sys.stdin messages in interactive mode, default is gevent.queue.Queue()
+  stdin_queue (BroadcastQueue class object): global append-only log of sys.stdin messages in interactive mode,
+    each command reads all messages from it via own cursor
   connects (dict): dict with already exists envs.connect, used only by set_connect_env context manager
 
 """
@@ -53,30 +116,69 @@ Attributes:
 # This file is part of https://github.com/Friz-zy/factory
 
 from os.path import join, expanduser
-import gevent.queue
+from gevent.event import Event
 from gevent.local import local
 from socket import gethostname
 from getpass import getuser
 
 
+class SharedDict(dict):
+    """Storage of AttributedDict that can be shared between its copies."""
+    shared = False
+
+
 class AttributedDict(dict):
+    """dict with access to items as to attributes.
+
+    Copies made by copy.copy share storage with original
+    until one of them is modified (copy on write),
+    so greenlets can inherit envs without duplicating of them.
+
+    """
     def __init__(self, dict={}):
         self.__dict__ = dict
 
     def __str__(self):
         return str(self.__dict__)
 
+    def __copy__(self):
+        storage = self.__dict__
+        if type(storage) is not SharedDict:
+            storage = SharedDict(storage)
+            object.__setattr__(self, '__dict__', storage)
+        storage.shared = True
+        new = dict.__new__(type(self))
+        object.__setattr__(new, '__dict__', storage)
+        return new
+
+    def _storage(self):
+        """Return own storage for modification, copy shared one before."""
+        storage = self.__dict__
+        if getattr(storage, 'shared', False):
+            storage = SharedDict(storage)
+            object.__setattr__(self, '__dict__', storage)
+        return storage
+
+    def __setattr__(self, key, value):
+        if key == '__dict__':
+            object.__setattr__(self, key, value)
+        else:
+            self._storage()[key] = value
+
+    def __delattr__(self, key):
+        del self._storage()[key]
+
     def __getitem__(self,key):
         return self.__dict__[key]
 
     def __setitem__(self,key,value):
-        self.__dict__[key] = value
+        self._storage()[key] = value
 
     def __delitem__(self, item):
-        del self.__dict__[item]
+        del self._storage()[item]
 
     def update(self, dict):
-        self.__dict__.update(dict)
+        self._storage().update(dict)
 
     def clean(self):
         self.__dict__ = {}
@@ -85,6 +187,76 @@ class AttributedDict(dict):
         self.__dict__ = dict
 
 
+class TaskRegistry(dict):
+    """Index of tasks: {name: function} with O(1) lookup by name.
+
+    Only tasks are registered from modules: functions and classes defined in module
+    and objects marked by decorators.task, so imported helpers like
+    copy or Popen are not tasks.
+
+    """
+    def register(self, name, function):
+        self[name] = function
+
+    def register_module(self, module):
+        """Register tasks of module.
+
+        Args:
+          module (module object): operations, factfile, fabfile and so on
+
+        """
+        name = module.__name__
+        for key, value in module.__dict__.iteritems():
+            if key.startswith('__') or not callable(value):
+                continue
+            if getattr(value, 'task', False) is True or getattr(value, '__module__', None) == name:
+                self[key] = value
+
+
+class BroadcastQueue(object):
+    """Append-only log of messages with per-subscriber cursors.
+
+    Every subscriber reads all messages from the first one,
+    waiting subscribers are woken up by one event per message.
+
+    """
+    def __init__(self):
+        self.messages = []
+        self.event = Event()
+
+    def __len__(self):
+        return len(self.messages)
+
+    def __iter__(self):
+        return iter(self.messages)
+
+    def qsize(self):
+        return len(self.messages)
+
+    def put_nowait(self, message):
+        self.messages.append(message)
+        # wake up waiting subscribers
+        event, self.event = self.event, Event()
+        event.set()
+
+    put = put_nowait
+
+    def wait(self, cursor=0, timeout=None):
+        """Wait for messages after cursor.
+
+        Args:
+          cursor (int): number of already read messages
+          timeout (int or float): max seconds of waiting, default is None that means forever
+
+        Return:
+          list: new messages, empty if timeout is expired
+
+        """
+        if cursor >= len(self.messages):
+            self.event.wait(timeout)
+        return self.messages[cursor:]
+
+
 # default variables
 envs = local()
 
@@ -93,8 +265,16 @@ envs.common = AttributedDict(
     'interactive': True,
     'show_errors': False,
     'parallel': False,
+    'pool_size': 0,
+    'batch': '',
+    'max_failures': None,
+    'command_timeout': None,
+    'host_timeout': None,
+    'aggregate': False,
+    'results_file': '',
+    'results_host': None,
     'ask_passwd': False,
-    'functions': {},
+    'functions': TaskRegistry(),
     'localhost': [
         'localhost',
         '127.0.0.1',
@@ -114,9 +294,23 @@ envs.common = AttributedDict(
      'ssh_port': 22,
      'ssh_port_option': '-p',
      'ssh_args': '-tt',
+     'ssh_multiplexing': True,
+     'ssh_control_path': '',
+     'ssh_control_persist': 60,
+     'use_agent': False,
+     'agent_python': 'python3',
+     'agent_timeout': 5,
      'scp_binary': 'scp',
      'scp_port_option': '-P',
      'scp_args': '',
+     'push_fanout': 0,
+     'push_hop_args': '-o BatchMode=yes',
+     'hash_binary': 'sha256sum',
+     'push_tar': False,
+     'transfer_compression': 'gzip',
+     'upload_cache': True,
+     'upload_check': True,
+     'uploads_file': '',
      'user': getuser(),
      'hosts': ['localhost'],
      'home_directory': join(expanduser('~'), '.factory'),
@@ -124,10 +318,31 @@ envs.common = AttributedDict(
      'dry_run': False,
      'which_binary': 'which',
      'test_binary': 'test -e',
+     'read_chunk_size': 65536,
+     'log_queue': False,
+     'log_queue_size': 10000,
+     'log_queue_policy': 'block',
+     'log_batch_size': 1000,
+     'log_flush_interval': 0.05,
+     'code_cache': True,
+     'code_cache_dir': '',
+     'inventory': '',
+     'inventory_script_ttl': 0,
+     'lazy_factfiles': False,
+     'host_logs_dir': '',
+     'host_logs_only': False,
+     'host_logs_max_bytes': 10485760,
+     'host_logs_when': '',
+     'host_logs_backup_count': 5,
+     'host_logs_compress': False,
+     'facts_cache': True,
+     'facts_file': '',
+     'facts_ttl': 3600,
+     'refresh_facts': False,
      }
 )
 
 envs.connect = AttributedDict()
 
-stdin_queue = gevent.queue.Queue()
+stdin_queue = BroadcastQueue()
 connects = {}
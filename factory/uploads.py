@@ -0,0 +1,128 @@
+#!/usr/bin/env python
+# coding=utf-8
+"""Index of content pushed to hosts.
+
+Index is stored in json file envs.common.uploads_file
+(default is join(envs.common.home_directory, 'uploads.json'))
+as {'user@host:port:dst\\tsrc': {'time': timestamp, 'sha256': hash}},
+so push of the same content to the same place can be skipped.
+
+File is read once per run and new entries are written once by flush_uploads
+at the end of run like facts file, see facts module.
+
+"""
+
+# This file is part of https://github.com/Friz-zy/factory
+
+import os
+import time
+import atexit
+from main import logging, envs
+from facts import read_json, write_json, merge_json
+
+
+# index of current run: cache is content of file, changed are not written entries
+cache = None
+cache_filename = None
+changed = {}
+
+
+def uploads_file():
+    """Return path to uploads index file."""
+    return envs.common.uploads_file or os.path.join(envs.common.home_directory, 'uploads.json')
+
+
+def cached_uploads():
+    """Return index of file, it's read once per run."""
+    global cache, cache_filename
+    if cache is None or cache_filename != uploads_file():
+        flush_uploads()
+        cache_filename = uploads_file()
+        cache = read_json(cache_filename)
+    return cache
+
+
+def reset_uploads():
+    """Write changed entries and forget content of file, next run reads it again."""
+    global cache
+    flush_uploads()
+    cache = None
+
+
+def flush_uploads():
+    """Merge changed entries into index file once."""
+    if not changed:
+        return
+    merge_json(cache_filename, changed)
+    changed.clear()
+
+
+atexit.register(flush_uploads)
+
+
+def upload_key(src, dst):
+    """Return index key of src pushed to dst on current host.
+
+    Args:
+      src (str): local file or directory
+      dst (str): destination path with basename of src if it's directory
+
+    """
+    return ''.join((
+        envs.connect.user, envs.common.split_user,
+        envs.connect.host, envs.common.split_port,
+        str(envs.connect.port), ':', dst, '\t', os.path.abspath(src)
+    ))
+
+
+def load_upload(src, dst):
+    """Return hash of content that was pushed from src to dst of current host.
+
+    Args:
+      src (str): local file or directory
+      dst (str): destination path
+
+    Return:
+      str: sha256, None if dst isn't in index
+
+    """
+    key = upload_key(src, dst)
+    entry = cached_uploads().get(key)
+    if not entry:
+        return None
+    logging.debug('%s was pushed with sha256 %s', key, entry['sha256'])
+    return entry['sha256']
+
+
+def save_upload(src, dst, sha256):
+    """Save hash of content that was pushed from src to dst of current host.
+
+    Args:
+      src (str): local file or directory
+      dst (str): destination path
+      sha256 (str): hash of content
+
+    """
+    entry = {'time': time.time(), 'sha256': sha256}
+    key = upload_key(src, dst)
+    cached_uploads()[key] = entry
+    changed[key] = entry
+
+
+def invalidate_uploads(connect_string=None):
+    """Remove entries of host or all entries from index.
+
+    Args:
+      connect_string (str): user@host:port, all entries will be removed if None
+
+    """
+    global cache
+    flush_uploads()
+    index = read_json(uploads_file())
+    if connect_string is None:
+        index = {}
+    else:
+        prefix = connect_string + ':'
+        index = dict((k, v) for k, v in index.iteritems() if not k.startswith(prefix))
+    write_json(uploads_file(), index)
+    cache = None
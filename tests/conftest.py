@@ -24,6 +24,20 @@ path_to_factory = os.path.abspath(os.path.join(
 sys.path.insert(0, path_to_factory)
 
 
+@pytest.fixture(autouse=True)
+def home_directory(tmpdir_factory, monkeypatch):
+    """Keep facts, uploads, code and inventory caches of tests out of real ~/.factory.
+
+    HOME is changed too for factory started by tests as subprocess.
+
+    """
+    from factory.state import envs
+    home = str(tmpdir_factory.mktemp('home'))
+    monkeypatch.setenv('HOME', home)
+    monkeypatch.setattr(envs.common, 'home_directory', os.path.join(home, '.factory'))
+    return envs.common.home_directory
+
+
 @pytest.fixture()
 def a(tmpdir):
     a = str(tmpdir.join('a'))
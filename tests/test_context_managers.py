@@ -113,3 +113,75 @@ def test_issue_1(capsys):
                 out, err = capsys.readouterr()
                 assert out.count('in: echo 222') == 1
                 assert out.count('out: 222') == 1
+
+
+def test_with_set_connect_env_control_master(tmpdir):
+    hack()
+    from factory.operations import ssh_command
+    with set_common_env(home_directory=str(tmpdir)):
+        with set_connect_env('user@test:111111'):
+            assert 'ControlMaster=auto' in envs.connect.control_args
+            assert 'ControlPath=%s' % tmpdir.join('sockets', '%C') in envs.connect.control_args
+            assert tmpdir.join('sockets').check(dir=True)
+            assert ssh_command('uptime')[-1] == 'uptime'
+            assert ssh_command('uptime')[-3:-1] == envs.connect.control_args[-2:]
+        with set_connect_env('localhost'):
+            assert envs.connect.control_args == []
+
+
+def test_gather_facts_without_one_of_commands(monkeypatch):
+    hack()
+    import factory.operations
+    def run(command, **kwargs):
+        return 'uid=0\nuname=\nhostname=\n', 'sh: 1: uname: not found\nsh: 1: uname: not found', 0
+    monkeypatch.setattr(factory.operations, 'run', run)
+    with set_connect_env('localhost'):
+        assert factory.operations.gather_facts() == {'uid': 0}
+
+
+def test_with_set_connect_env_cached_facts(tmpdir, monkeypatch):
+    hack()
+    import factory.operations
+    facts_file = str(tmpdir.join('facts.json'))
+    calls = []
+    gather_facts = factory.operations.gather_facts
+    def counted():
+        calls.append(1)
+        return gather_facts()
+    monkeypatch.setattr(factory.operations, 'gather_facts', counted)
+    with set_common_env(facts_file=facts_file):
+        with set_connect_env('localhost'):
+            assert envs.connect.facts['hostname']
+            assert envs.connect.check_is_root == (envs.connect.facts['uid'] == 0)
+        hack()
+        with set_connect_env('localhost'):
+            assert envs.connect.facts['hostname']
+        assert len(calls) == 1
+        # facts file is written once at the end of run
+        import json
+        from factory.facts import flush_facts, reset_facts
+        assert not tmpdir.join('facts.json').check()
+        flush_facts()
+        assert len(json.loads(tmpdir.join('facts.json').read())) == 1
+        reset_facts()
+        hack()
+        with set_connect_env('localhost'):
+            pass
+        assert len(calls) == 1
+        hack()
+        with set_common_env(refresh_facts=True):
+            with set_connect_env('localhost'):
+                pass
+        assert len(calls) == 2
+
+
+def test_copy_on_write_envs():
+    hack()
+    from copy import copy
+    common = copy(envs.common)
+    assert common.__dict__ is envs.common.__dict__
+    with set_common_env(test=True):
+        assert envs.common.test == True
+        assert 'test' not in common.__dict__
+    common.test1 = True
+    assert 'test1' not in envs.common.__dict__
@@ -86,6 +86,52 @@ class TestAPI:
         assert "out:" in out
 
 
+    def test_should_batch_and_memoize_probes(self, monkeypatch):
+        hack()
+        import gevent
+        from copy import copy
+        from factory import dry_operations, operations
+        from factory.api import set_connect_env, envs
+        calls = []
+        original = operations.run_many
+        def run_many(commands, **kwargs):
+            calls.append(list(commands))
+            return original(commands, **kwargs)
+        monkeypatch.setattr(operations, 'run_many', run_many)
+        dry_operations.reset_probes()
+        with set_connect_env('localhost'):
+            common, connect = envs.common, envs.connect
+            def job(command):
+                envs.common, envs.connect = copy(common), copy(connect)
+                return dry_operations.probe([command])
+            jobs = [gevent.spawn(job, c) for c in ('which echo', 'which ls', 'which echo')]
+            gevent.joinall(jobs)
+            assert dry_operations.probe(['which ls', 'test -e /'])[2] == 0
+        # one session for probes of all greenlets, known probes are not executed again
+        assert calls == [['which echo', 'which ls'], ['test -e /']]
+        assert jobs[0].value[0].strip().endswith('/echo')
+        assert jobs[0].value == jobs[2].value
+        # run overridden by user executes probes
+        commands = []
+        def run(command, **kwargs):
+            commands.append(command)
+            return ('', '', 0)
+        monkeypatch.setitem(envs.common.functions, 'run', run)
+        with set_connect_env('localhost'):
+            assert dry_operations.probe(['which cat']) == ('', '', 0)
+        assert commands == ['which cat; ']
+
+    def test_should_return_dry_stream_like_command_stream(self):
+        hack()
+        from factory import dry_operations
+        from factory.api import set_connect_env
+        dry_operations.reset_probes()
+        with set_connect_env('localhost'):
+            stream = dry_operations.run('echo hi', stream=True, sumout='hi\n', sumerr='err', status=3)
+            assert list(stream) == ['hi\n']
+            stream.close()
+            assert (stream.status, stream.sumerr) == (3, 'err')
+
 class TestArgParsing:
     def test_should_set_dry_run(self, capsys):
         hack()
@@ -124,6 +124,313 @@ class TestArgParsing:
         out, err = capfd.readouterr()
         assert out.rfind('out: hello') < out.rfind('out: world!')
 
+    def test_should_process_hosts_by_batches(self, tmpdir, capsys):
+        hack()
+        import logging
+        logfile = str(tmpdir.join('factory.log'))
+        handler = logging.FileHandler(logfile)
+        logging.root.addHandler(handler)
+        sys.argv = ['factory.py', '-p', '-H', 'localhost,127.0.0.1', '--batch', '50%', '--pool-size', '1', "run", "echo 'hello world!'"]
+        try:
+            factory.main.main()
+        finally:
+            logging.root.removeHandler(handler)
+            handler.close()
+        # set defaults back
+        factory.main.envs.common.hosts = ['localhost']
+        factory.main.envs.common.batch = ''
+        factory.main.envs.common.pool_size = 0
+        out, err = capsys.readouterr()
+        assert out.count('hello world!') == 4
+        with open(logfile, 'r') as f:
+            log = f.read()
+        assert 'batch 1/2: 1 of 1 hosts processed' in log
+        assert 'batch 2/2: 1 of 1 hosts processed' in log
+
+    def test_should_stop_after_max_failures(self, capsys):
+        hack()
+        factory.main.envs.common.functions['fail'] = lambda: 1 / 0
+        hosts = ['localhost', '127.0.0.1', 'localhost']
+        try:
+            with factory.context_managers.set_common_env(parallel=True, batch=1, max_failures=2):
+                failed = factory.main.run_hosts_in_parallel(hosts, [('fail', [], {})])
+        finally:
+            del factory.main.envs.common.functions['fail']
+        assert failed == 2
+        assert factory.main.split_batches(hosts, '50%') == [hosts[:2], hosts[2:]]
+
+    def test_should_close_control_masters_after_failed_task(self, monkeypatch):
+        hack()
+        closed = []
+        monkeypatch.setattr(factory.operations, 'close_control_masters', lambda: closed.append(1))
+        factory.main.envs.common.functions['fail'] = lambda: 1 / 0
+        sys.argv = ['factory.py', 'fail']
+        try:
+            with pytest.raises(ZeroDivisionError):
+                factory.main.main()
+        finally:
+            del factory.main.envs.common.functions['fail']
+        assert closed == [1]
+
+    def test_should_run_tasks_by_dependencies(self, capsys):
+        hack()
+        import gevent
+        from factory.api import depends
+        log = []
+        def task(name, delay=0):
+            def f():
+                log.append(name + ' start')
+                gevent.sleep(delay)
+                log.append(name + ' end')
+            f.__name__ = name
+            return f
+        functions = {
+            'update': task('update', 0.2),
+            'upload': task('upload', 0.1),
+            'restart': depends('update', 'upload')(task('restart')),
+            'check': depends('restart')(task('check')),
+        }
+        factory.main.envs.common.functions.update(functions)
+        try:
+            with factory.context_managers.set_common_env(parallel=True):
+                factory.main.run_tasks_on_host('localhost', [('check', [], {}), ('update', [], {}), ('upload', [], {})],
+                                               copy(factory.main.envs.common), copy(factory.main.envs.connect))
+            assert log[:2] == ['update start', 'upload start']
+            assert log.index('restart start') > log.index('update end')
+            assert log.index('check start') > log.index('restart end')
+            del log[:]
+            with factory.context_managers.set_common_env(parallel=False):
+                factory.main.run_tasks_on_host('localhost', [('check', [], {})],
+                                               copy(factory.main.envs.common), copy(factory.main.envs.connect))
+            assert [l for l in log if l.endswith('start')] == ['update start', 'upload start', 'restart start', 'check start']
+            functions['update'].depends = ('check',)
+            with pytest.raises(ValueError):
+                factory.main.run_tasks_on_host('localhost', [('check', [], {})],
+                                               copy(factory.main.envs.common), copy(factory.main.envs.connect))
+            tasks = [(name, [], {}) for name in 'abcde']
+            assert factory.main.topological_order(tasks, [set(), set([3]), set(), set(), set([0])]) == [0, 2, 3, 1, 4]
+        finally:
+            for name in functions:
+                del factory.main.envs.common.functions[name]
+
+    def test_should_distribute_push_by_tree(self, tmpdir, monkeypatch, capsys):
+        hack()
+        import gevent
+        import factory.operations as operations
+        from factory.state import AttributedDict
+        from factory.api import set_connect_env
+        src = tmpdir.mkdir('src $dir')
+        src.join('a').write('a')
+        src.mkdir('b').join('c').write('c')
+        with set_connect_env('localhost'):
+            checksums = operations.local_checksums(str(src))
+            assert sorted(checksums) == ['./a', './b/c']
+            assert operations.remote_checksums(str(src)) == checksums
+            assert operations.remote_checksums(str(src.join('a'))) == operations.local_checksums(str(src.join('a')))
+        hosts = ['h%s' % i for i in range(7)]
+        uploads = []
+        forwards = []
+        def push(src, dst, fanout=None, **kwargs):
+            uploads.append(envs.connect.host)
+            return 1 if envs.connect.host == 'h1' else 0
+        def forward(parent, path):
+            forwards.append((parent, envs.connect.host))
+            return 0
+        monkeypatch.setattr(operations, 'push', push)
+        monkeypatch.setattr(operations, 'forward', forward)
+        monkeypatch.setattr(operations, 'check_checksums', lambda path, checksums: True)
+        envs = factory.main.envs
+        def distribute(host, common):
+            envs.common = common
+            envs.connect = AttributedDict({'connect_string': host, 'host': host, 'logger': factory.main.logging.root})
+            return operations.distribute(str(src), '/tmp/', 2)
+        with factory.context_managers.set_common_env(hosts=hosts):
+            # children are started before parents
+            threads = [gevent.spawn(distribute, host, copy(envs.common)) for host in reversed(hosts)]
+            gevent.joinall(threads)
+            assert len(operations.distributions) == 1
+            # changed src is distributed by another tree
+            src.join('a').write('changed')
+            distribute('h0', copy(envs.common))
+            assert len(operations.distributions) == 2
+        operations.reset_transfers()
+        assert [t.value for t in reversed(threads)] == [0, 1, 0, 0, 0, 0, 0]
+        # h1 has failed, so its children receive src from controller
+        assert sorted(uploads) == ['h0', 'h0', 'h1', 'h4', 'h5']
+        assert sorted(forwards) == [('h0', 'h2'), ('h0', 'h3'), ('h2', 'h6')]
+
+    def test_should_sync_directories(self, tmpdir, capsys):
+        hack()
+        import os
+        from factory.api import push, pull, set_connect_env, set_common_env
+        # ssh that executes command on localhost
+        ssh = tmpdir.join('ssh')
+        ssh.write('#!/bin/sh\nfor a; do last=$a; done\nexec sh -c "$last"\n')
+        ssh.chmod(0o755)
+        src = tmpdir.mkdir('src')
+        src.join('a').write('a')
+        src.mkdir('b c').join('d').write('d')
+        dst = tmpdir.join('dst')
+        back = tmpdir.join('back')
+        with set_common_env(ssh_binary=str(ssh), facts_cache=False, ssh_multiplexing=False):
+            with set_connect_env('remote'):
+                assert push(str(src), str(dst), sync=True) == 0
+                assert dst.join('b c', 'd').read() == 'd'
+                os.utime(str(src.join('a')), (1, 1))
+                src.join('a').write('A')
+                os.utime(str(src.join('a')), (1, 1))
+                dst.join('extra').write('extra')
+                assert push(str(src), str(dst), sync=True, delete=True) == 0
+                assert dst.join('a').read() == 'A'
+                assert not dst.join('extra').exists()
+                assert pull(str(dst), str(back), sync=True) == 0
+                assert sorted(os.listdir(str(back))) == ['a', 'b c']
+            with set_connect_env('localhost'):
+                src.join('new').write('new')
+                assert push(str(src), str(back), sync=True) == 0
+                assert back.join('new').read() == 'new'
+        out, err = capsys.readouterr()
+        assert '1 changed, 1 deleted' in out
+
+    def test_should_transfer_directories_by_tar(self, tmpdir, capsys):
+        hack()
+        import os
+        from factory.api import push, pull, set_connect_env, set_common_env
+        # ssh that executes command on localhost
+        ssh = tmpdir.join('ssh')
+        ssh.write('#!/bin/sh\nfor a; do last=$a; done\nexec sh -c "$last"\n')
+        ssh.chmod(0o755)
+        src = tmpdir.mkdir('src')
+        for i in range(100):
+            src.join(str(i)).write(str(i))
+        dst = tmpdir.mkdir('dst')
+        with set_common_env(ssh_binary=str(ssh), facts_cache=False, ssh_multiplexing=False):
+            with set_connect_env('remote'):
+                # existing directory, like scp -r
+                assert push(str(src), str(dst), tar=True) == 0
+                assert dst.join('src', '99').read() == '99'
+                with set_common_env(transfer_compression=''):
+                    assert pull(str(src), str(tmpdir.join('back')), tar=True) == 0
+                assert sorted(os.listdir(str(tmpdir.join('back')))) == sorted(os.listdir(str(src)))
+                # failure of tar before ssh isn't masked by status of the last command
+                manifest = factory.operations.local_manifest(str(src))
+                assert factory.operations.tar_transfer(str(src), str(dst), manifest, names=['missing']) != 0
+        out, err = capsys.readouterr()
+        assert 'transferred 100 files, 190 bytes' in out
+
+    def test_should_skip_unchanged_push(self, tmpdir, capsys):
+        hack()
+        import json
+        import factory.uploads
+        from factory.api import push, set_connect_env, set_common_env
+        from factory.operations import UNCHANGED
+        src = tmpdir.join('src')
+        src.write('content')
+        dst = tmpdir.join('dst')
+        with set_common_env(uploads_file=str(tmpdir.join('uploads.json'))):
+            with set_connect_env('localhost'):
+                assert push(str(src), str(dst)) is not UNCHANGED
+                assert push(str(src), str(dst)) is UNCHANGED
+                with set_common_env(dry_run=True):
+                    assert push(str(src), str(dst)) is UNCHANGED
+                # another src to the same dst has own entry
+                other = tmpdir.join('other')
+                other.write('content')
+                assert push(str(other), str(dst)) is not UNCHANGED
+                # remote check finds changed content
+                dst.write('changed')
+                status = push(str(src), str(dst))
+                assert status == 0 and status is not UNCHANGED
+                assert dst.read() == 'content'
+                # index only
+                dst.write('changed')
+                with set_common_env(upload_check=False):
+                    assert push(str(src), str(dst)) is UNCHANGED
+            # index is written once at the end of run
+            assert not tmpdir.join('uploads.json').check()
+            factory.uploads.flush_uploads()
+            assert len(json.loads(tmpdir.join('uploads.json').read())) == 2
+        out, err = capsys.readouterr()
+        assert "dry-out: '%s' is unchanged" % dst in out
+
+    def test_should_run_many_commands_in_one_session(self, tmpdir, capsys):
+        hack()
+        from factory.api import run, run_many, set_connect_env, set_common_env
+        commands = ['echo a; echo b >&2', 'printf noeol', 'exit 3', 'echo last']
+        with set_connect_env('localhost'):
+            results = run_many(commands)
+            assert results == [run(c, freturn=True) for c in commands]
+            assert results[1] == ('noeol', '', 0)
+            assert results[2][2] == 3
+            # commands don't read script of session
+            assert run_many(['cat', 'echo last']) == [('', '', 0), ('last\n', '', 0)]
+            # finished commands keep output and status after timeout
+            from factory.operations import TIMEOUT_STATUS
+            results = run_many(['echo done', 'echo started; sleep 5', 'echo never'], timeout=0.5)
+            assert results == [('done\n', '', 0), ('started\n', '', TIMEOUT_STATUS), ('', '', TIMEOUT_STATUS)]
+        ssh = tmpdir.join('ssh')
+        ssh.write('#!/bin/sh\nfor a; do last=$a; done\nexec sh -c "$last"\n')
+        ssh.chmod(0o755)
+        with set_common_env(ssh_binary=str(ssh), facts_cache=False, ssh_multiplexing=False):
+            with set_connect_env('remote'):
+                assert run_many(commands, err_to_out=True)[0] == ('a\nb\n', '', 0)
+
+    def test_should_execute_commands_via_agent(self, tmpdir, capsys):
+        hack()
+        import gevent
+        from factory.api import run, envs, set_connect_env, set_common_env
+        ssh = tmpdir.join('ssh')
+        ssh.write('#!/bin/sh\nfor a; do last=$a; done\nexec sh -c "$last"\n')
+        ssh.chmod(0o755)
+        with set_common_env(ssh_binary=str(ssh), facts_cache=False, ssh_multiplexing=False,
+                            use_agent=True, agent_python=sys.executable):
+            with set_connect_env('remote'):
+                agent = envs.connect.agent
+                assert agent is not None
+                assert run('echo hello; echo error >&2; exit 3', freturn=True) == ('hello\n', 'error\n', 3)
+                assert run('cat', input='input') == 'input\n'
+                # requests are multiplexed over one pipe
+                start = time.time()
+                def task(i, common, connect):
+                    envs.common, envs.connect = common, connect
+                    return run('sleep 0.5; echo %s' % i)
+                threads = [gevent.spawn(task, i, copy(envs.common), copy(envs.connect)) for i in range(10)]
+                gevent.joinall(threads)
+                assert time.time() - start < 3
+                assert [t.value for t in threads] == ['%s\n' % i for i in range(10)]
+                path = str(tmpdir.join('file'))
+                agent.write(path, 'data', 0o600)
+                assert agent.read(path) == 'data'
+                assert agent.stat(path)['size'] == 4
+                assert agent.stat(path + 'missed') is None
+                assert len(agent.hash(path)) == 64
+                # command is killed on host after timeout
+                from factory.operations import TIMEOUT_STATUS
+                start = time.time()
+                assert run('sleep 3; echo late', freturn=True, timeout=0.5) == ('', '', TIMEOUT_STATUS)
+                assert time.time() - start < 2
+                # and controller doesn't wait for response forever
+                import factory.agent
+                grace = factory.agent.RESPONSE_GRACE
+                factory.agent.RESPONSE_GRACE = -0.4
+                start = time.time()
+                try:
+                    assert run('sleep 3', freturn=True, timeout=0.5) == ('', '', TIMEOUT_STATUS)
+                finally:
+                    factory.agent.RESPONSE_GRACE = grace
+                assert time.time() - start < 0.4
+                with pytest.raises(factory.agent.AgentTimeout):
+                    agent.request('run', deadline=0.1, command='sleep 1')
+                assert agent.alive
+                agent.close()
+                # fallback to plain ssh
+                assert run('echo hello') == 'hello\n'
+            hack()
+            with set_common_env(agent_python='missed-python', agent_timeout=1):
+                with set_connect_env('remote'):
+                    assert envs.connect.agent is None
+                    assert run('echo hello') == 'hello\n'
+
     def test_should_execute_factfile(self, tmpdir, factfile, capsys):
         hack()
         sys.argv = ['factory.py', '--factfile', factfile, 'hello_fact']
@@ -189,6 +496,205 @@ class TestFeedback:
         out, err = p.communicate()
         assert out.find("out: hello world!", (out.find("out: hello world!") + 1)) != -1
 
+    def test_should_broadcast_stdin_to_all_commands(self):
+        import gevent
+        from factory.state import BroadcastQueue
+        queue = BroadcastQueue()
+        assert queue.wait(0, timeout=0.01) == []
+        readers = [gevent.spawn(queue.wait, 0) for i in range(2)]
+        gevent.sleep(0)
+        queue.put_nowait('hello\n')
+        gevent.joinall(readers, timeout=1)
+        assert [r.value for r in readers] == [['hello\n'], ['hello\n']]
+        queue.put_nowait('world\n')
+        assert queue.wait(1) == ['world\n']
+        assert queue.wait(0) == ['hello\n', 'world\n']
+
+    def test_should_aggregate_results_of_hosts(self, tmpdir, capsys):
+        hack()
+        import json
+        results = str(tmpdir.join('results.json'))
+        sys.argv = ['factory.py', '--parallel', '--aggregate', '--results-file', results,
+                    '--host', 'localhost,127.0.0.1', 'run', 'echo same']
+        factory.main.main()
+        out, err = capsys.readouterr()
+        # output of each host is collapsed
+        assert '@localhost out: same' not in out
+        assert '2 hosts, status 0: localhost, 127.0.0.1' in out
+        assert '  out: same' in out
+        with open(results) as f:
+            data = json.load(f)
+        assert data['hosts']['127.0.0.1'] == {'sumout': 'same\n', 'sumerr': '', 'status': 0}
+        assert len(data['groups']) == 1
+        # local commands of tasks and output that isn't utf-8
+        from factory.api import run, local
+        def mixed():
+            local('echo local')
+            run("printf '\\377\\n'")
+        factory.main.envs.common.functions['mixed'] = mixed
+        sys.argv = ['factory.py', '--results-file', results, '--host', '127.0.0.1', 'mixed']
+        try:
+            factory.main.main()
+        finally:
+            del factory.main.envs.common.functions['mixed']
+        with open(results) as f:
+            data = json.load(f)
+        assert data['hosts'].keys() == ['127.0.0.1']
+        assert data['hosts']['127.0.0.1']['sumout'] == u'local\n\ufffd\n'
+        factory.main.envs.common.aggregate = False
+        factory.main.envs.common.results_file = ''
+        factory.main.envs.common.hosts = ['localhost']
+
+    def test_should_write_logs_via_queue(self, capsys):
+        hack()
+        from factory import log
+        factory.main.envs.common.log_queue = True
+        sys.argv = ['factory.py', 'run', 'for i in 1 2 3; do echo queued $i; done']
+        try:
+            factory.main.main()
+        finally:
+            factory.main.envs.common.log_queue = False
+        assert log.listener is None
+        out, err = capsys.readouterr()
+        assert out.index('out: queued 1') < out.index('out: queued 3')
+        with open('factory.log', 'r') as f:
+            assert "out: queued 3" in f.readlines()[-1]
+
+    def test_should_drop_logs_if_queue_is_full(self):
+        import logging
+        from StringIO import StringIO
+        from factory.log import QueueHandler, QueueListener
+        stream = StringIO()
+        handler = logging.StreamHandler(stream)
+        listener = QueueListener([handler], size=2, policy='drop', interval=0)
+        logger = logging.getLogger('test_queue_drop')
+        logger.propagate = False
+        logger.addHandler(QueueHandler(listener, [handler]))
+        for i in range(5):
+            logger.warning('record %s', i)
+        # bad arguments are reported by handleError like by another handlers
+        logging.raiseExceptions, raise_exceptions = False, logging.raiseExceptions
+        try:
+            logger.warning('record %d', 'bad')
+        finally:
+            logging.raiseExceptions = raise_exceptions
+        listener.stop()
+        assert stream.getvalue().splitlines() == [
+            'record 0', 'record 1', '3 log records were dropped, log queue is full'
+        ]
+
+    def test_should_write_json_logs_of_hosts(self, tmpdir):
+        hack()
+        import json
+        directory = tmpdir.join('hosts')
+        factory.main.envs.common.host_logs_dir = str(directory)
+        sys.argv = ['factory.py', '--host', 'json@localhost:2222', 'run', 'echo json log']
+        try:
+            factory.main.main()
+        finally:
+            factory.main.envs.common.host_logs_dir = ''
+        with open(str(directory.join('json@localhost:2222.log'))) as f:
+            lines = [json.loads(l) for l in f]
+        assert {'in', 'out'} <= set(l['stream'] for l in lines)
+        # output of gather_facts is written before it
+        out = [l for l in lines if l['message'] == 'json log'][0]
+        assert out['host'] == 'json@localhost:2222'
+        assert out['stream'] == 'out'
+        assert isinstance(out['time'], float)
+
+    def test_should_compress_rotated_logs_of_hosts(self, tmpdir):
+        import gzip
+        import logging
+        from factory.log import CompressedRotatingFileHandler
+        filename = str(tmpdir.join('host.log'))
+        handler = CompressedRotatingFileHandler(filename, maxBytes=10, backupCount=2)
+        logger = logging.getLogger('test_rotation')
+        logger.propagate = False
+        logger.addHandler(handler)
+        for i in range(4):
+            logger.warning('record %s', i)
+        handler.close()
+        assert sorted(tmpdir.listdir()) == [
+            tmpdir.join('host.log'), tmpdir.join('host.log.1.gz'), tmpdir.join('host.log.2.gz')
+        ]
+        assert gzip.open(filename + '.1.gz').read() == 'record 2\n'
+        assert gzip.open(filename + '.2.gz').read() == 'record 1\n'
+
+    def test_should_rotate_logs_of_hosts_via_queue(self, tmpdir):
+        import logging
+        from factory.log import QueueHandler, QueueListener, CompressedRotatingFileHandler
+        filename = str(tmpdir.join('host.log'))
+        handler = CompressedRotatingFileHandler(filename, maxBytes=10, backupCount=2)
+        listener = QueueListener([handler], interval=0)
+        logger = logging.getLogger('test_queue_rotation')
+        logger.propagate = False
+        logger.addHandler(QueueHandler(listener, [handler]))
+        for i in range(4):
+            logger.warning('record %s', i)
+        listener.stop()
+        handler.close()
+        assert sorted(tmpdir.listdir()) == [
+            tmpdir.join('host.log'), tmpdir.join('host.log.1.gz'), tmpdir.join('host.log.2.gz')
+        ]
+
+    def test_should_select_hosts_from_inventory(self, tmpdir):
+        from factory.inventory import load_inventory, resolve_hosts, connect_variables
+        filename = str(tmpdir.join('hosts'))
+        with open(filename, 'w') as f:
+            f.write("lb1\n"
+                    "[web]\n"
+                    "web[09:14] role=web\n"
+                    "[web:vars]\n"
+                    "role=frontend\n"
+                    "tier=1\n"
+                    "[db]\n"
+                    "db1 user=postgres port=2222 host=10.0.0.5\n"
+                    "[prod:children]\n"
+                    "web\n"
+                    "db\n"
+                    "[prod:vars]\n"
+                    "tier=0\n")
+        with factory.context_managers.set_common_env(home_directory=str(tmpdir)):
+            inventory = load_inventory(filename)
+            assert inventory.select('web*:!web13') == ['web09', 'web10', 'web11', 'web12', 'web14']
+            assert inventory.select('prod:&db') == ['db1']
+            assert inventory.select('ungrouped') == ['lb1']
+            assert resolve_hosts('db') == ['postgres@10.0.0.5:2222']
+            assert connect_variables('postgres@10.0.0.5:2222') == {'tier': 0}
+            # host variables override group variables, children override parents
+            assert inventory.variables('web10') == {'role': 'web', 'tier': 1}
+            # the second load is from cache
+            assert len(tmpdir.join('inventory').listdir()) == 1
+            assert load_inventory(filename).select('all') == inventory.select('all')
+            # nested variables of json are cached too
+            filename = str(tmpdir.join('hosts.json'))
+            with open(filename, 'w') as f:
+                f.write('{"web": {"hosts": ["a"], "vars": {"cfg": {"x": 1}}}}')
+            assert load_inventory(filename).variables('a') == {'cfg': {'x': 1}}
+            assert load_inventory(filename).variables('a') == {'cfg': {'x': 1}}
+            assert len(tmpdir.join('inventory').listdir()) == 2
+
+    def test_should_execute_on_hosts_of_inventory(self, tmpdir, capsys):
+        hack()
+        import json
+        script = tmpdir.join('inventory.py')
+        with open(str(script), 'w') as f:
+            f.write("#!/bin/sh\necho %s\n" % json.dumps(json.dumps({
+                'local': {'hosts': ['localhost', '127.0.0.1'], 'vars': {'greeting': 'hi'}},
+            })))
+        script.chmod(0755)
+        sys.argv = ['factory.py', '-i', str(script), '-H', 'local:!127.0.0.1', 'run', 'echo inventory']
+        try:
+            factory.main.main()
+            # variables of host don't replace attributes of envs.connect
+            with factory.context_managers.set_connect_env('localhost'):
+                assert factory.main.envs.connect.vars == {'greeting': 'hi'}
+        finally:
+            factory.main.envs.common.inventory = ''
+        out, err = capsys.readouterr()
+        assert 'localhost out: inventory' in out
+        assert '127.0.0.1 out' not in out
+
     def test_should_write_logs(self):
         hack()
         sys.argv = ['factory.py', "run", "echo 'hello world!'"]
@@ -205,6 +711,16 @@ class TestFeedback:
         with open('factory.log', 'r') as f:
             assert "out: hello world!" in f.readlines()[-1]
 
+    def test_should_write_logs_without_logging_config(self, tmpdir):
+        import os
+        from subprocess import Popen, PIPE
+        main = os.path.join(os.path.dirname(factory.__file__), 'main.py')
+        env = dict(os.environ, HOME=str(tmpdir))
+        p = Popen([sys.executable, main, 'echo hi'], cwd=str(tmpdir), env=env, stdout=PIPE, stderr=PIPE)
+        out, err = p.communicate()
+        assert 'out: hi' in out
+        assert 'out: hi' in tmpdir.join('factory.log').read()
+
     def test_should_work_with_unicode(self, capsys):
         hack()
         sys.argv = ['factory.py', "echo 'привет, мир!'"]
@@ -212,6 +728,66 @@ class TestFeedback:
         out, err = capsys.readouterr()
         assert u"out: привет, мир!" in out
 
+    def test_should_read_big_output(self, capsys):
+        hack()
+        from factory.api import run, set_connect_env
+        with set_connect_env('localhost'):
+            out = run("python -c \"import sys; sys.stdout.write(('x' * 99 + '\\n') * 2000 + 'last')\"")
+        assert out == ('x' * 99 + '\n') * 2000 + 'last'
+        out, err = capsys.readouterr()
+        assert out.count('out: ' + 'x' * 99 + '\n') == 2000
+        assert 'out: last' in out
+
+    def test_should_kill_command_after_timeout(self, capsys):
+        hack()
+        from factory.api import run, set_connect_env
+        from factory.operations import TIMEOUT_STATUS
+        start = time.time()
+        with set_connect_env('localhost'):
+            out, err, status = run('echo early; sleep 5 & wait; echo late', freturn=True, timeout=0.5)
+        assert time.time() - start < 3
+        assert status == TIMEOUT_STATUS
+        assert out.strip() == 'early'
+
+    def test_should_stream_command_output(self, capsys):
+        hack()
+        import tempfile
+        from factory.api import run, set_connect_env
+        with set_connect_env('localhost'):
+            stream = run('seq 1 100000; echo error >&2; exit 3', stream=True)
+            assert ''.join(stream).split() == [str(i) for i in range(1, 100001)]
+            assert stream.status == 3
+            assert stream.sumerr.strip() == 'error'
+            # early stop kills command
+            start = time.time()
+            stream = run('echo first; sleep 5; echo second', stream=True)
+            assert next(iter(stream)).strip() == 'first'
+            stream.close()
+            assert time.time() - start < 3
+            with tempfile.TemporaryFile() as f:
+                out, err, status = run('seq 1 3', freturn=True, out_file=f)
+                f.seek(0)
+                assert f.read().split() == ['1', '2', '3']
+            assert out == ''
+            assert status == 0
+
+    def test_should_kill_tasks_after_host_timeout(self, capsys):
+        hack()
+        from factory.operations import TIMEOUT_STATUS
+        sys.argv = ['factory.py', '--host-timeout', '0.5', 'run', 'sleep 5']
+        start = time.time()
+        factory.main.main()
+        # set defaults back
+        factory.main.envs.common.host_timeout = None
+        assert time.time() - start < 3
+        with factory.context_managers.set_common_env(host_timeout=0.5, parallel=True):
+            status = factory.main.run_tasks_on_host(
+                'localhost', [('run', ['sleep 5'], {}), ('run', ['sleep 5'], {})],
+                factory.main.envs.common, factory.main.envs.connect
+            )
+        assert status == TIMEOUT_STATUS
+        assert time.time() - start < 5
+
     def test_should_write_command_stderr_to_sys_stdout(self, capsys):
         hack()
         sys.argv = ['factory.py', 'run:qwertyuiop,err_to_out=True']
@@ -285,6 +861,56 @@ class TestLoadFilesFromHomeDirectory:
         out, err = capsys.readouterr()
         assert "this if factfile" in out
 
+    def test_should_load_factfile_only_for_its_tasks(self, tmpdir, capsys):
+        hack()
+        marker = tmpdir.join('loaded')
+        with open(str(tmpdir.join('factfile.py')), 'w') as f:
+            f.write("open(%r, 'a').write('x')\ndef lazy_task():\n    pass\n" % str(marker))
+        with factory.context_managers.set_common_env(home_directory=str(tmpdir)):
+            sys.argv = ['factory.py', 'run', "echo 'hello world!'"]
+            with factory.context_managers.set_common_env(lazy_factfiles=True):
+                factory.main.main()
+                assert not marker.check()
+                sys.argv = ['factory.py', 'lazy_task']
+                factory.main.main()
+                assert marker.read() == 'x'
+            # factfile is loaded by default, it can override built-in operations
+            sys.argv = ['factory.py', 'run', "echo 'hello world!'"]
+            factory.main.main()
+            assert marker.read() == 'xx'
+
+    def test_should_cache_compiled_factfile(self, tmpdir, factfile, monkeypatch):
+        from factory import factfiles
+        cache = tmpdir.join('code')
+        with factory.context_managers.set_common_env(code_cache_dir=str(cache)):
+            assert factfiles.load_source('factfile', factfile).hello_fact
+            assert len(cache.listdir()) == 1
+            def fail(*args):
+                raise AssertionError('factfile is compiled again')
+            monkeypatch.setattr(factfiles, 'compile', fail, raising=False)
+            assert factfiles.load_source('factfile', factfile).hello_fact
+            # touched, but not changed file
+            tmpdir.join('factfile.py').setmtime(1)
+            assert factfiles.load_source('factfile', factfile).hello_fact
+            monkeypatch.undo()
+            with open(factfile, 'a') as f:
+                f.write('def changed():\n    pass\n')
+            assert factfiles.load_source('factfile', factfile).changed
+
+    def test_should_register_only_tasks_of_factfile(self, tmpdir):
+        from factory import factfiles
+        from factory.state import TaskRegistry
+        filename = str(tmpdir.join('factfile.py'))
+        with open(filename, 'w') as f:
+            f.write("from copy import copy\n"
+                    "from factory.api import task\n"
+                    "from os.path import join\n"
+                    "join = task(join)\n"
+                    "def deploy():\n    pass\n")
+        registry = TaskRegistry()
+        registry.register_module(factfiles.load_source('factfile', filename))
+        assert sorted(registry) == ['deploy', 'join']
+
     def test_should_load_fabfile(self, tmpdir, fabfile, capsys):
         hack()
         sys.argv = ['factory.py', 'hello_fab']